@@ -23,6 +23,12 @@
             The assumption is that no points that are outside of this geometric
             neighborhood will be closer to the vertex than those that are inside
             the neighborhood.
+            The "kdtree" neighborhood mode avoids this assumption by searching a
+            cKDTree built once per iteration, which gives complete neighborhoods
+            in O(n*log(n)) and does not need the triangulation at all.
+            The "topology" neighborhood mode uses the precomputed adjacency of the
+            triangulation (see mesh_topology.py), so no point location is done
+            while iterating and n_degree really adds rings of neighbors.
             
         - Subsampling methodology
             - Currently, the inefficiency of the Delaunay triangulation is worked around
@@ -36,11 +42,33 @@
     required for the operations of this algorithm.
     
 ''' 
-from scipy.spatial import Delaunay
 from scipy.spatial import ConvexHull
+from scipy.spatial import cKDTree
 import numpy as np
+import hashlib
 import math
+import os
 import sys
+import instrumentation
+from cloud_io import load_xyz_points
+from cloud_io import precision_dtype
+from cloud_io import write_xyz
+from mesh_topology import MeshTopology
+from mesh_topology import as_topology
+from mesh_topology import csr_from_pairs
+from mesh_topology import csr_matrix
+from mesh_topology import csr_to_padded
+from normal_estimation import NormalCache
+from subsampling import subsample_points
+from surface_mesher import local_surface_mesh
+from triangulation_cache import CACHE_DIR
+from triangulation_cache import cached_delaunay
+
+# largest fraction of active points for which only those are moved
+ACTIVE_FRACTION = 0.5
+
+# points whose neighborhoods and offsets are computed at a time
+CHUNK_POINTS = 8192
 
 ''' 
 Function: neighborhood_radius
@@ -80,8 +108,9 @@ def calc_normal(v, degree, tri, points):
         extra = []
         for n in neighbors:
             if (n != -1):
-                extra.append(tri.neighbors[triangle])
-        neighbors = np.append(neighbors, np.unique(extra))
+                extra.append(tri.neighbors[n])
+        if (extra):
+            neighbors = np.union1d(neighbors, np.concatenate(extra))
                                
     # prepare to average their normals
     normal_sum = [0, 0, 0]
@@ -114,154 +143,838 @@ def calc_normal(v, degree, tri, points):
 
 
 '''
-Function:   run_bilateral_denoising
-Use:        to execute this algorithm from another script
+Function:   bilateral_iteration
+Use:        move every point once using the original per-point loop
+Parameters...
+points: array of the current point positions
+tri: Delaunay triangulation of the points
+n_degree: how many levels of neighbors to include in normal calculations
+out: array the new positions are written to, allocated if not given
 '''
-def run_bilateral_denoising(testing):
+def bilateral_iteration(points, tri, n_degree, out=None):
+    new_points = np.empty_like(points) if out is None else out
+    index = 0
+    # algorithm parameters, set for each vertex below
+    sigma_c = 0 
+    sigma_s = 0
+    # progress is reported about every 2% of the points
+    bar_step = max(points.shape[0] // 50, 1)
+    neighbors_visited = 0
+    instrumentation.progress("bilateral", 0, points.shape[0])
+    
+    for p in points:
+        # calculate normal
+        normal, neighbor_points = calc_normal(p, n_degree, tri, points)
+        # calculate sigma_c...................
+        sigma_c = neighborhood_radius(p, tri, points)
+        # get neighbor points
+        neighbors = []
+        neighbors_visited += len(neighbor_points)
+        for y in neighbor_points:
+            v = points[y]
+            dist = np.linalg.norm(p-v)
+            if (dist < 2*sigma_c):
+                neighbors.append(v)
+        # calculate sigma_s....................
+        average_offset = 0
+        offsets = []
+        # calculate average offset
+        for n in neighbors:
+            t = np.linalg.norm([x * np.dot((n - p), normal) for x in normal])
+            t = math.sqrt(t*t)
+            average_offset += t
+            offsets.append(t)
+        if (len(neighbors) != 0):
+            average_offset /= len(neighbors)
+        # calculate standard deviation
+        o_sum = 0
+        for o in offsets:
+            o_sum += (o - average_offset) * (o - average_offset)
+        if (len(offsets)):
+            o_sum /= len(offsets)
+        sigma_s = math.sqrt(o_sum)
+        # enforce a bottom bound on sigma_c
+        minimum = 1.0e-12
+        if (sigma_s < minimum):
+            sigma_s = minimum
+        # calculate movement..................
+        total = 0
+        normalizer = 0
+        for n in neighbors:
+            t = np.linalg.norm(n - p)
+            h = np.linalg.norm([x * np.dot((n - p), normal) for x in normal])
+            wc = math.exp((-1*t*t)/(2 * sigma_c *sigma_c))
+            ws = math.exp((-1*h*h)/(2 * sigma_s *sigma_s))
+            total += wc * ws * h
+            normalizer += wc * ws
+        # add new position
+        if (normalizer != 0):
+            factor = total/normalizer
+        modification = [n * factor for n in normal]
+        new_points[index] = p + modification
+        index += 1
+        if (index % bar_step == 0 or index == points.shape[0]):
+            instrumentation.progress("bilateral", index, points.shape[0])
+    instrumentation.count("vertices_processed", points.shape[0])
+    instrumentation.count("neighbors_visited", neighbors_visited)
+    # update positions
+    return new_points
 
-    print("***********************************")
-    print("Running Bilateral Mesh Smoothing...")
-    print("***********************************")
 
-    # testing defaults for parameters
-    filename = "bunny.xyz"
-    sub_sampling = 5
-    iterations = 2
-    n_degree = 4
+'''
+Function:   unique_padded
+Use:        sort the rows of a padded (-1) index array, remove the repeated
+            indices within each row, and drop the columns left with only -1
+'''
+def unique_padded(rows):
+    rows = np.sort(rows, axis=1)
+    repeated = np.zeros(rows.shape, dtype=bool)
+    repeated[:, 1:] = rows[:, 1:] == rows[:, :-1]
+    rows[repeated] = -1
+    rows.sort(axis=1)
+    width = max(int((rows != -1).sum(axis=1).max(initial=0)), 1)
+    return rows[:, rows.shape[1] - width:]
 
-    if (not testing):
-        filename = input("Input filename: ")
 
-        # how many points to skip in subsampling
-        sub_sampling = int(input("Sub sampling (0 for none): "))
+'''
+Function:   simplex_rings
+Use:        the neighboring simplices of the located simplices, with degree
+            more rings of their neighbors, as calc_normal gathers them
+Parameters...
+tri: Delaunay triangulation of the points
+triangles: indices of the simplices the points were located in
+degree: how many times to add an extra set of neighbors
 
-        # how many times to smooth the mesh
-        iterations = int(input("Algorithm iterations: "))
+Returns the sorted unique simplex indices of every point padded with -1.
+'''
+def simplex_rings(tri, triangles, degree):
+    rings = tri.neighbors[triangles]
+    for d in range(degree):
+        extra = tri.neighbors[rings]
+        extra[rings == -1] = -1
+        rings = unique_padded(np.concatenate((rings, extra.reshape(rings.shape[0], -1)), axis=1))
+    return rings
 
-        # how many levels of neighbors to include in normal calculations
-        n_degree = int(input("Neighbor range (for normals): "))
 
-    f = open(filename,'r')
+'''
+Function:   simplex_neighborhoods
+Use:        gather the neighborhood of every point in one pass, as padded arrays
+            holding the same triangles and points calc_normal would use
+Parameters...
+points: array of the current point positions
+tri: Delaunay triangulation of the points
+n_degree: how many levels of neighbors to include in normal calculations
+active: indices of the points to gather the neighborhoods of, all if not given
 
-    p = []
+Returns (normals, candidates, sigma_c) of every (active) point: the normal,
+the sorted unique vertex indices of its neighboring simplices padded with -1,
+and sigma_c as the smallest gap to a vertex of the first ring of simplices
+(like neighborhood_radius).
+'''
+def simplex_neighborhoods(points, tri, n_degree=0, active=None):
+    centers = points if active is None else points[active]
 
-    # Create array with points read from file
-    for l in f:
-        row = l.split()
-        p.append([row[0], row[1], row[2]])
-        # in case there are two 'columns' of points in the input 
-        # which is the case with our .xyz files
-        if (len(row) == 6):
-            p.append([row[3], row[4], row[5]])
+    # the point location is done one vertex at a time on purpose: a bulk
+    # find_simplex call continues each walk from the previous result, and
+    # since every vertex lies on several simplices it would pick different
+    # ones than the per-point loop
+    triangles = np.array([tri.find_simplex(v) for v in centers], dtype=np.intp)
 
-    points = np.array(p)
+    normals = np.empty(centers.shape, dtype=points.dtype)
+    sigma_c = np.empty(centers.shape[0], dtype=points.dtype)
+    blocks = []
+    # a block of points at a time, since the rings grow with n_degree
+    for start in range(0, centers.shape[0], CHUNK_POINTS):
+        rows = slice(start, start + CHUNK_POINTS)
 
-    # Subsampling can be done since Delaunay triangulation is very slow otherwise
-    if (sub_sampling > 0):
-        points = points[::sub_sampling]
+        # sigma_c: smallest gap to the vertices of the first ring
+        first = tri.neighbors[triangles[rows]]
+        vertices = tri.simplices[first].reshape(first.shape[0], -1)
+        dist = np.linalg.norm(points[vertices] - centers[rows][:, None, :], axis=2)
+        ring = np.repeat(first != -1, tri.simplices.shape[1], axis=1)
+        sigma_c[rows] = np.where(ring & (dist > 0), dist, 1e10).min(axis=1)
 
-    print("Points Loaded")
+        neighbors = simplex_rings(tri, triangles[rows], n_degree)
+        valid = neighbors != -1
 
+        # normals: average of the neighboring simplex normals
+        s = tri.simplices[neighbors]
+        v1 = points[s[:, :, 0]] - points[s[:, :, 1]]
+        v2 = points[s[:, :, 0]] - points[s[:, :, 2]]
+        crossp = np.cross(v1, v2)
+        crossp[~valid] = 0
+        normals[rows] = crossp.sum(axis=1)
 
+        # vertices of all neighboring simplices, -1 where there is no simplex
+        candidates = s.astype(np.int32)
+        candidates[~valid] = -1
+        blocks.append(unique_padded(candidates.reshape(s.shape[0], -1)))
 
-    # Generate triangulation of the points, QJ ensures all points are used
-    tri = Delaunay(points[:-1], qhull_options="Qbb Qc Qz Q12 QJ Qt")
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normals /= np.linalg.norm(normals, axis=1)[:, None]
+
+    width = max([b.shape[1] for b in blocks] + [1])
+    candidates = np.concatenate([np.pad(b, ((0, 0), (width - b.shape[1], 0)), constant_values=-1)
+                                 for b in blocks] + [np.zeros((0, width), dtype=np.int32)])
+
+    return normals, candidates, sigma_c
+
+
+'''
+Function:   pad_ragged
+Use:        turn a sequence of index lists into a 2D int32 array padded with -1
+Parameters...
+lists: sequence of lists of point indices
+width: number of columns, at least the longest list, the longest list if not given
+'''
+def pad_ragged(lists, width=None):
+    lengths = np.fromiter((len(l) for l in lists), dtype=np.intp, count=len(lists))
+    if (width is None):
+        width = max(lengths.max(initial=0), 1)
+    padded = np.full((len(lists), width), -1, dtype=np.int32)
+    if (lengths.sum() > 0):
+        rows = np.repeat(np.arange(len(lists)), lengths)
+        columns = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        padded[rows, columns] = np.concatenate([l for l in lists if len(l)])
+    return padded
+
+
+'''
+Function:   knn_size
+Use:        number of nearest neighbors used for a kdtree normal, chosen as the
+            vertex count of the (n_degree + 1)-ring of a regular triangle mesh
+Parameters...
+n_degree: how many levels of neighbors to include in normal calculations
+'''
+def knn_size(n_degree):
+    return 3 * (n_degree + 1) * (n_degree + 2) + 1
+
+
+'''
+Function:   kdtree_neighborhoods
+Use:        gather the neighborhood of every point with bulk queries on a
+            spatial index instead of the triangulation
+Parameters...
+points: array of the current point positions
+n_degree: how many levels of neighbors to include in normal calculations
+tree: cKDTree of the points, built here if not given
+active: indices of the points to gather the neighborhoods of, all if not given
+with_normals: compute the normals (not needed when they come from a NormalCache)
+
+Returns (normals, candidates, sigma_c) of every (active) point: normals from
+the covariance of the k nearest neighbors (None without with_normals), all
+points within 2 * sigma_c padded with -1, and sigma_c as the distance to the
+nearest other point.
+'''
+def kdtree_neighborhoods(points, n_degree, tree=None, active=None, with_normals=True):
+    if (tree is None):
+        tree = cKDTree(points)
+    centers = points if active is None else points[active]
+    k = min(knn_size(n_degree), points.shape[0])
+
+    normals = np.empty(centers.shape, dtype=points.dtype) if with_normals else None
+    sigma_c = np.empty(centers.shape[0], dtype=points.dtype)
+    neighbors = []
+    # a block of points at a time, which bounds the memory of the k-NN arrays
+    for start in range(0, centers.shape[0], CHUNK_POINTS):
+        block = centers[start:start + CHUNK_POINTS]
+        rows = slice(start, start + block.shape[0])
+
+        # k-NN query for both the normals and sigma_c
+        dist, nearest = tree.query(block, k=k)
+        dist = dist.reshape(block.shape[0], k)
+        nearest = nearest.reshape(block.shape[0], k)
+
+        # sigma_c: smallest gap between the point and its neighbors
+        gaps = np.where(dist > 0, dist, np.inf).min(axis=1)
+        gaps[np.isinf(gaps)] = 1e10
+        sigma_c[rows] = gaps
+
+        # normals: direction of least variance among the nearest neighbors
+        if (with_normals):
+            local = points[nearest] - points[nearest].mean(axis=1)[:, None, :]
+            covariance = np.einsum('ijk,ijl->ikl', local, local)
+            eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+            normals[rows] = eigenvectors[:, :, 0]
+
+        # all points inside the 2 * sigma_c neighborhood
+        neighbors.append(tree.query_ball_point(block, 2 * sigma_c[rows]))
+
+    width = max([max([len(l) for l in lists], default=0) for lists in neighbors] + [1])
+    candidates = np.concatenate([pad_ragged(lists, width) for lists in neighbors] +
+                                [np.zeros((0, width), dtype=np.int32)])
+
+    return normals, candidates, sigma_c
+
+
+'''
+Function:   topology_neighborhoods
+Use:        gather the neighborhood of every point from the precomputed mesh
+            adjacency, without any point location
+Parameters...
+points: array of the current point positions
+topology: MeshTopology of the triangulation
+n_degree: how many levels of neighbors to include in normal calculations
+active: indices of the points to gather the neighborhoods of, all if not given
+
+Returns (normals, candidates) of every (active) point: normals averaged over the simplices around the
+vertex and its n_degree-ring, and the 1-ring vertices padded with -1. The
+1-ring of a Delaunay triangulation always holds the nearest other point, so
+sigma_c taken from it is exact.
+'''
+def topology_neighborhoods(points, topology, n_degree, active=None):
+    # normal of every simplex, computed once
+    s = topology.simplices
+    crossp = np.cross(points[s[:, 0]] - points[s[:, 1]],
+                      points[s[:, 0]] - points[s[:, 2]])
+
+    # sum over the simplices around each vertex, then over its rings
+    vertex_simplex = csr_matrix(*topology.vertex_simplex, s.shape[0], dtype=points.dtype)
+    around = vertex_simplex @ crossp
+    normals = around if active is None else around[active]
+    if (n_degree > 0):
+        ring = csr_matrix(*topology.ring(n_degree), topology.num_points, dtype=points.dtype)
+        if (active is not None):
+            ring = ring[active]
+        normals = normals + ring @ around
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normals /= np.linalg.norm(normals, axis=1)[:, None]
+
+    candidates = csr_to_padded(*topology.vertex_vertex)
+    if (active is not None):
+        candidates = candidates[active]
+
+    return normals, candidates
+
+
+'''
+Function:   offsets_block
+Use:        compute the bilateral shift of a block of points along their normals
+Parameters...
+points: array of the current point positions
+centers: positions of the points of the block
+normals: unit normal of every point of the block
+candidates: padded (-1) indices of the points that may be in each neighborhood
+sigma_c: neighborhood radius of every point of the block, taken as the
+         smallest gap to a candidate if not given
+'''
+def offsets_block(points, centers, normals, candidates, sigma_c=None):
+    valid_point = candidates != -1
+
+    # distances to every candidate neighbor point
+    diff = points[candidates] - centers[:, None, :]
+    dist = np.linalg.norm(diff, axis=2)
+
+    # sigma_c: smallest gap between the point and its neighbors
+    if (sigma_c is None):
+        gaps = np.where(valid_point & (dist > 0), dist, 1e10)
+        sigma_c = gaps.min(axis=1)
+
+    # neighbors within 2 * sigma_c
+    inside = valid_point & (dist < 2 * sigma_c[:, None])
+    count = inside.sum(axis=1)
+
+    # offsets along the normal and sigma_s from their standard deviation
+    h = np.abs(np.einsum('ijk,ik->ij', diff, normals))
+    h[~inside] = 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        average_offset = h.sum(axis=1) / count
+        deviation = np.where(inside, h - average_offset[:, None], 0)
+        sigma_s = np.sqrt((deviation * deviation).sum(axis=1) / count)
+    sigma_s[~(sigma_s >= 1.0e-12)] = 1.0e-12
+
+    # bilateral weights and resulting shift along the normal
+    wc = np.exp(-(dist * dist) / (2 * sigma_c[:, None] * sigma_c[:, None]))
+    ws = np.exp(-(h * h) / (2 * sigma_s[:, None] * sigma_s[:, None]))
+    weights = np.where(inside, wc * ws, 0)
+    total = (weights * h).sum(axis=1)
+    normalizer = weights.sum(axis=1)
+    factor = np.zeros(centers.shape[0], dtype=points.dtype)
+    np.divide(total, normalizer, out=factor, where=normalizer != 0)
+    return factor
+
+
+
+'''
+Function:   bilateral_offsets
+Use:        compute the bilateral shift of every point along its normal, a block
+            of points at a time, which bounds the memory of the (point,
+            candidate) arrays
+Parameters...
+points: array of the current point positions
+normals: unit normal of every (active) point
+candidates: padded (-1) indices of the points that may be in each neighborhood
+sigma_c: neighborhood radius of every point, taken as the smallest gap to a
+         candidate if not given
+active: indices of the points to shift, all if not given
+'''
+def bilateral_offsets(points, normals, candidates, sigma_c=None, active=None):
+    centers = points if active is None else points[active]
+    factor = np.empty(centers.shape[0], dtype=points.dtype)
+    for start in range(0, centers.shape[0], CHUNK_POINTS):
+        rows = slice(start, start + CHUNK_POINTS)
+        factor[rows] = offsets_block(points, centers[rows], normals[rows], candidates[rows],
+                                     None if sigma_c is None else sigma_c[rows])
+    return factor
+
+
+'''
+Function:   bilateral_step
+Use:        move the (active) points once, computing the normals, sigma_c,
+            sigma_s, weights and offsets of all of them together as array
+            operations
+Parameters...
+points: array of the current point positions
+tri: Delaunay triangulation of the points, or its MeshTopology in "topology"
+     mode (unused in "kdtree" mode)
+n_degree: how many levels of neighbors to include in normal calculations
+neighborhood: "simplex" to search the neighboring triangles like the loop,
+              "topology" to use the precomputed adjacency of the triangulation,
+              "kdtree" for complete searches on a spatial index
+active: indices of the points to move, all if not given
+out: array the new positions are written to (not points), allocated if not given
+normal_cache: NormalCache (see normal_estimation.py) the normals are taken
+              from instead of the neighborhoods, None to use the neighborhoods
+
+Returns (new_points, candidates): all the points, with the active ones moved,
+and the candidate neighbors of the active points padded with -1.
+'''
+def bilateral_step(points, tri, n_degree, neighborhood="simplex", active=None, out=None,
+                   normal_cache=None):
+    with instrumentation.stage("normals"):
+        if (neighborhood == "simplex"):
+            normals, candidates, sigma_c = simplex_neighborhoods(points, tri, n_degree, active)
+        elif (neighborhood == "topology"):
+            topology = as_topology(tri, points.shape[0])
+            normals, candidates = topology_neighborhoods(points, topology, n_degree, active)
+            sigma_c = None
+        elif (neighborhood == "kdtree"):
+            normals, candidates, sigma_c = kdtree_neighborhoods(
+                points, n_degree, active=active, with_normals=normal_cache is None)
+        else:
+            raise ValueError("Unknown neighborhood: " + str(neighborhood))
+
+        # the cached normals are kept, so the moves are computed on a copy
+        if (normal_cache is not None):
+            normals = normal_cache.update(points)
+            normals = normals.copy() if active is None else normals[active]
+
+    with instrumentation.stage("bilateral_update"):
+        factor = bilateral_offsets(points, normals, candidates, sigma_c, active)
+
+    if (instrumentation.enabled):
+        instrumentation.count("vertices_processed", factor.shape[0])
+        instrumentation.count("neighbors_visited", np.count_nonzero(candidates != -1))
+
+    if (out is None):
+        out = np.empty_like(points)
+    if (active is None):
+        np.multiply(normals, factor[:, None], out=normals)
+        np.add(points, normals, out=out)
+        # points without a usable normal stay where they are
+        unmoved = ~np.isfinite(out).all(axis=1)
+        out[unmoved] = points[unmoved]
+        return out, candidates
+
+    centers = points[active]
+    moved = centers + factor[:, None] * normals
+    unmoved = ~np.isfinite(moved).all(axis=1)
+    moved[unmoved] = centers[unmoved]
+    out[:] = points
+    out[active] = moved
+    return out, candidates
+
+
+'''
+Function:   bilateral_iteration_batch
+Use:        move every point once with bilateral_step
+Parameters...
+points: array of the current point positions
+tri: Delaunay triangulation of the points, or its MeshTopology in "topology"
+     mode (unused in "kdtree" mode)
+n_degree: how many levels of neighbors to include in normal calculations
+neighborhood: "simplex", "topology" or "kdtree", see bilateral_step
+'''
+def bilateral_iteration_batch(points, tri, n_degree, neighborhood="simplex"):
+    return bilateral_step(points, tri, n_degree, neighborhood)[0]
 
-    print("Triangulation Complete")
 
+'''
+Function:   dependency_graph
+Use:        sparse matrix with a one in row i and column j where the move of
+            point i depends on the position of point j, so the points moved by
+            the last iteration (as a vector v) affect those with (graph @ v) > 0
+Parameters...
+points: array of the current point positions
+tri: Delaunay triangulation of the points, or its MeshTopology in "topology" mode
+n_degree: how many levels of neighbors to include in normal calculations
+neighborhood: "simplex", "topology" or "kdtree", see bilateral_step
+candidates: padded (-1) candidate neighbors of every point, from bilateral_step
+normals: "mesh" or "pca", see bilateral_denoise
+'''
+def dependency_graph(points, tri, n_degree, neighborhood, candidates, normals="mesh"):
+    n = points.shape[0]
+    if (neighborhood == "topology" and normals == "mesh"):
+        # the normal sums the simplices around the n_degree-ring
+        return csr_matrix(*as_topology(tri, n).ring(n_degree + 1), n)
+
+    if (neighborhood == "kdtree" or normals == "pca"):
+        # the normal uses the k nearest neighbors, the shift the candidates
+        k = min(knn_size(n_degree), n)
+        nearest = cKDTree(points).query(points, k=k)[1].reshape(n, k)
+        candidates = np.concatenate((nearest, candidates), axis=1)
+
+    # the simplex normals use the vertices of the candidate simplices
+    valid = candidates != -1
+    rows = np.repeat(np.arange(n), valid.sum(axis=1))
+    indptr, indices = csr_from_pairs(rows, candidates[valid].astype(np.intp), n)
+    return csr_matrix(indptr, indices, n)
+
+
+'''
+Function:   run_key
+Use:        hash identifying a run by its starting points and parameters, so a
+            checkpoint is only resumed by the run that wrote it
+'''
+def run_key(points, n_degree, engine, neighborhood, tolerance, normals="mesh"):
+    digest = hashlib.sha1(("%d %s %s %r %s " % (n_degree, engine, neighborhood,
+                                                tolerance, normals)).encode())
+    digest.update(np.ascontiguousarray(points, dtype=float).data)
+    return digest.hexdigest()
+
+
+'''
+Function:   save_checkpoint
+Use:        write the state of a run after an iteration, replacing the previous
+            checkpoint only once the new one is complete
+Parameters...
+filename: the checkpoint .npz file
+key: run_key of the run
+points: the current point positions
+iteration: number of iterations done
+active: mask of the points to move in the next iteration
+history: (maximum, RMS) displacement of every iteration done
+'''
+def save_checkpoint(filename, key, points, iteration, active, history):
+    temp = filename + ".tmp"
+    with open(temp, 'wb') as f:
+        np.savez(f, key=key, points=points, iteration=iteration, active=active,
+                 history=np.array(history, dtype=float).reshape(-1, 2))
+    os.replace(temp, filename)
+
+
+'''
+Function:   load_checkpoint
+Use:        read the state written by save_checkpoint
+Parameters...
+filename: the checkpoint .npz file
+key: run_key of the run, which must match the one of the checkpoint
+
+Returns (points, iteration, active, history).
+'''
+def load_checkpoint(filename, key):
+    with np.load(filename) as data:
+        if (str(data["key"]) != key):
+            raise ValueError("Checkpoint is from a different run: " + filename)
+        history = [tuple(h) for h in data["history"].tolist()]
+        return data["points"], int(data["iteration"]), data["active"], history
 
-    '''
-    Below is the implementation of the algorithm itself
-    '''
-    points = points.astype(np.float)
+
+'''
+Function:   converged
+Use:        whether the last iteration moved the points less than the thresholds
+Parameters...
+history: (maximum, RMS) displacement of every iteration done
+converge_max: maximum displacement below which the run stops
+converge_rms: RMS displacement below which the run stops
+'''
+def converged(history, converge_max=None, converge_rms=None):
+    if (not history):
+        return False
+    largest, rms = history[-1]
+    return ((converge_max is not None and largest < converge_max) or
+            (converge_rms is not None and rms < converge_rms))
+
+
+'''
+Function:   bilateral_denoise
+Use:        run the denoising iterations on a triangulated point array
+Parameters...
+points: array of point positions (the triangulation may leave out the last)
+tri: Delaunay triangulation of the points
+iterations: how many times to smooth the mesh (at most, with convergence)
+n_degree: how many levels of neighbors to include in normal calculations
+engine: "batch" for the vectorized engine, "loop" for the per-point loop,
+        "parallel" for the batch engine on spatial tiles in a process pool
+        (see parallel_bilateral.py, always uses kdtree neighborhoods)
+neighborhood: "simplex", "topology" or "kdtree", see bilateral_step
+tolerance: with the batch engine, only the points that moved more than this
+           in the last iteration, or have such a candidate neighbor, are moved
+           again (None to move every point in every iteration)
+converge_max: stop once no point moved more than this in an iteration
+converge_rms: stop once the RMS displacement of an iteration is below this
+checkpoint: .npz file the state is saved to after every iteration; a run
+            started with an existing checkpoint resumes from it
+normals: "mesh" (default) for the normals of the neighborhoods, "pca" for
+         oriented k-NN normals (knn_size(n_degree) neighbors) kept across the
+         iterations and estimated again only where points moved, see
+         normal_estimation.py (batch engine only)
+
+NOTE: the neighborhoods, which decide what a moved point affects, are taken
+from the first iteration that moves every point (the first one, or the first
+one after resuming). With "kdtree" neighborhoods they change slightly as the
+points move, so points that settled may then not see every new neighbor.
+'''
+def bilateral_denoise(points, tri, iterations, n_degree, engine="batch",
+                      neighborhood="simplex", tolerance=None, converge_max=None,
+                      converge_rms=None, checkpoint=None, normals="mesh"):
+    if (normals not in ("mesh", "pca")):
+        raise ValueError("Unknown normals: " + str(normals))
+
+    if (engine == "parallel"):
+        if (neighborhood != "kdtree"):
+            raise ValueError("The parallel engine only supports kdtree neighborhoods")
+        if (normals != "mesh"):
+            raise ValueError("The parallel engine only supports mesh normals")
+        if (tolerance is not None or converge_max is not None or
+                converge_rms is not None or checkpoint is not None):
+            raise ValueError("The parallel engine always runs every iteration")
+        from parallel_bilateral import parallel_bilateral_denoise
+        return parallel_bilateral_denoise(points, iterations, n_degree)
+
+    # the adjacency does not change as points move, so it is built only once
+    if (neighborhood == "topology"):
+        tri = as_topology(tri, points.shape[0])
+
+    if (engine == "batch"):
+        normal_cache = None
+        if (normals == "pca"):
+            normal_cache = NormalCache(knn_size(n_degree))
+        def iteration(points, active, out):
+            return bilateral_step(points, tri, n_degree, neighborhood, active, out,
+                                  normal_cache)
+    elif (engine == "loop"):
+        if (neighborhood != "simplex" or normals != "mesh"):
+            raise ValueError("The loop engine only supports simplex neighborhoods")
+        if (tolerance is not None):
+            raise ValueError("The loop engine always moves every point")
+        def iteration(points, active, out):
+            return bilateral_iteration(points, tri, n_degree, out), None
+    else:
+        raise ValueError("Unknown engine: " + str(engine))
+
+    # the points keep their precision (float32 or float64), and every
+    # iteration writes to the other of two buffers
+    dtype = points.dtype if (np.issubdtype(points.dtype, np.floating)) else np.float64
+    points = np.array(points, dtype=dtype)
+    spare = np.empty_like(points)
+    n = points.shape[0]
+    done = 0
+    active = np.ones(n, dtype=bool)
+    history = []
+    graph = None
+
+    if (checkpoint is not None):
+        key = run_key(points, n_degree, engine, neighborhood, tolerance, normals)
+        if (os.path.exists(checkpoint)):
+            points, done, active, history = load_checkpoint(checkpoint, key)
+            points = points.astype(dtype, copy=False)
+            print("Resuming after iteration: " + str(done))
 
     # Vertex modification passes
-    for i in range(iterations):
-        print("Iteration: " + str(i))
-        new_points = []
-        index = 0
-        # algorithm parameters, set for each vertex below
-        sigma_c = 0 
-        sigma_s = 0
-        # progress bar
-        toolbar_width = 50
-        sys.stdout.write("[%s]"  % (" " * toolbar_width))
-        sys.stdout.flush()
-        sys.stdout.write("\b" * (toolbar_width+1))
-        bar_step = round(points.shape[0] / toolbar_width)
-        
-        for p in points:
-            # calculate normal
-            normal, neighbor_points = calc_normal(p, n_degree, tri, points)
-            # calculate sigma_c...................
-            sigma_c = neighborhood_radius(p, tri, points)
-            # get neighbor points
-            neighbors = []
-            for y in neighbor_points:
-                v = points[y]
-                dist = np.linalg.norm(p-v)
-                if (dist < 2*sigma_c):
-                    neighbors.append(v)
-            # calculate sigma_s....................
-            average_offset = 0
-            offsets = []
-            # calculate average offset
-            for n in neighbors:
-                t = np.linalg.norm([x * np.dot((n - p), normal) for x in normal])
-                t = math.sqrt(t*t)
-                average_offset += t
-                offsets.append(t)
-            if (len(neighbors) != 0):
-                average_offset /= len(neighbors)
-            # calculate standard deviation
-            o_sum = 0
-            for o in offsets:
-                o_sum += (o - average_offset) * (o - average_offset)
-            if (len(offsets)):
-                o_sum /= len(offsets)
-            sigma_s = math.sqrt(o_sum)
-            # enforce a bottom bound on sigma_c
-            minimum = 1.0e-12
-            if (sigma_s < minimum):
-                sigma_s = minimum
-            # calculate movement..................
-            total = 0
-            normalizer = 0
-            for n in neighbors:
-                t = np.linalg.norm(n - p)
-                h = np.linalg.norm([x * np.dot((n - p), normal) for x in normal])
-                wc = math.exp((-1*t*t)/(2 * sigma_c *sigma_c))
-                ws = math.exp((-1*h*h)/(2 * sigma_s *sigma_s))
-                total += wc * ws * h
-                normalizer += wc * ws
-            # add new position
-            if (normalizer != 0):
-                factor = total/normalizer
-            modification = [n * factor for n in normal]
-            new_point = p + modification
-            new_points.append(new_point)
-            index += 1
-            if (index % bar_step == 0):
-                sys.stdout.write("#")
-                sys.stdout.flush()
-        # update positions
-        points = np.array(new_points)
-        points = points.astype(np.float)
-        sys.stdout.write("\n")
+    for i in range(done, iterations):
+        if (converged(history, converge_max, converge_rms) or not active.any()):
+            print("Converged after %d iterations" % i)
+            break
+
+        # without the neighborhoods, every point has to be moved once
+        if (tolerance is not None and graph is None):
+            active[:] = True
+
+        # moving a few points costs more per point (the rows of the arrays
+        # have to be selected), so the others are only left out when enough
+        # of them settled
+        if (np.count_nonzero(active) > ACTIVE_FRACTION * n):
+            print("Iteration: " + str(i))
+            new_points, candidates = iteration(points, None, spare)
+        else:
+            print("Iteration: %d (%d of %d points)" % (i, np.count_nonzero(active), n))
+            new_points, candidates = iteration(points, np.flatnonzero(active), spare)
+
+        moved = np.linalg.norm(new_points - points, axis=1)
+        history.append((float(moved.max(initial=0)), float(np.sqrt(np.mean(moved * moved)))))
+        points, spare = new_points, points
+
+        if (tolerance is not None):
+            if (graph is None):
+                graph = dependency_graph(points, tri, n_degree, neighborhood, candidates,
+                                         normals)
+            changed = moved > tolerance
+            active = changed | (graph @ changed.astype(float) > 0)
+
+        if (checkpoint is not None):
+            save_checkpoint(checkpoint, key, points, i + 1, active, history)
+
+    return points
+
+
+'''
+Function:   denoising_mesh
+Use:        the triangulation the neighborhoods of the points are taken from
+Parameters...
+points: array of the point positions
+mesher, neighborhood, cache: see denoise_file
+
+Returns (tri, neighborhood): the triangulation (None for kdtree
+neighborhoods), and the neighborhood mode it is used with.
+'''
+def denoising_mesh(points, mesher="delaunay", neighborhood="simplex", cache=True):
+    # Generate triangulation of the points, QJ ensures all points are used
+    # (kdtree neighborhoods search a spatial index instead)
+    tri = None
+    if (mesher == "local"):
+        neighborhood = "topology"
+        with instrumentation.stage("triangulation"):
+            tri = MeshTopology(local_surface_mesh(points), points.shape[0])
+
+        print("Triangulation Complete")
+    elif (mesher != "delaunay"):
+        raise ValueError("Unknown mesher: " + str(mesher))
+    elif (neighborhood != "kdtree"):
+        with instrumentation.stage("triangulation"):
+            tri = cached_delaunay(points[:-1], points.shape[0],
+                                  cache_dir=CACHE_DIR if cache else None)
+
+        print("Triangulation Complete")
+    return tri, neighborhood
+
+
+'''
+Function:   denoise_file
+Use:        run the algorithm on a .xyz file without any prompts
+Parameters...
+filename: the input .xyz file
+save_filename: the output .xyz file
+sub_sampling: subsampling rate, 0 for none
+iterations: how many times to smooth the mesh
+n_degree: how many levels of neighbors to include in normal calculations
+engine: "batch" (default), "loop" or "parallel", see bilateral_denoise, or
+        "tiled" to denoise the file tile by tile with bounded memory (see
+        out_of_core.py, always in "kdtree" mode and without subsampling)
+neighborhood: "simplex" (default), "topology" or "kdtree", see
+              bilateral_iteration_batch
+mesher: "delaunay" (default) for the scipy Delaunay triangulation, "local" for
+        the surface mesh of surface_mesher.py (always with "topology"
+        neighborhoods, since there are no simplices to locate points in)
+subsampling: "stride" (default) to keep every sub_sampling-th point, "voxel"
+             or "poisson" to reduce the cloud by the same factor spatially, see
+             subsampling.subsample_points, or "multires" to denoise a voxel
+             level reduced by that factor and interpolate the displacements
+             back onto every point, see multiresolution.py
+cache: reuse the Delaunay triangulations of earlier runs on the same points,
+       see triangulation_cache.py
+tolerance, converge_max, converge_rms, checkpoint: active points, early stop
+       and checkpoints of the iterations, see bilateral_denoise
+precision: "double" (default) or "single" to keep the points in float32 from
+           loading to writing, which halves the memory of the iterations
+normals: "mesh" (default) or "pca", see bilateral_denoise
+refine_levels: with "multires" subsampling, how many finer levels get one
+               kdtree iteration after the coarse run
+'''
+def denoise_file(filename, save_filename, sub_sampling=5, iterations=2, n_degree=4,
+                 engine="batch", neighborhood="simplex", mesher="delaunay",
+                 subsampling="stride", cache=True, tolerance=None, converge_max=None,
+                 converge_rms=None, checkpoint=None, precision="double", normals="mesh",
+                 refine_levels=0):
+    dtype = precision_dtype(precision)
+
+    if (engine == "tiled"):
+        from out_of_core import tiled_denoise
+        with instrumentation.stage("tiled_denoise"):
+            tiled_denoise(filename, save_filename, iterations, n_degree)
+
+        print("Done!")
+        return
+
+    # Read the points, in case there are two 'columns' of points in the input
+    # (which is the case with our .xyz files) both are used
+    with instrumentation.stage("load"):
+        points = load_xyz_points(filename, dtype)
+
+    if (subsampling == "multires"):
+        from multiresolution import multires_denoise
+
+        # the full algorithm on the coarsest level
+        def denoise(level):
+            tri, mode = denoising_mesh(level, mesher, neighborhood, cache)
+            return bilateral_denoise(level, tri, iterations, n_degree, engine, mode,
+                                     tolerance, converge_max, converge_rms, checkpoint,
+                                     normals), None
+
+        # one kdtree iteration on the finer levels
+        def refine(level):
+            return bilateral_denoise(level, None, 1, n_degree, "batch", "kdtree"), None
+
+        points = multires_denoise(points, denoise, sub_sampling, refine_levels, refine)
+    else:
+        # Subsampling can be done since Delaunay triangulation is very slow otherwise
+        with instrumentation.stage("subsample"):
+            points = subsample_points(points, subsampling, sub_sampling).astype(dtype, copy=False)
+
+        print("Points Loaded")
+
+        tri, neighborhood = denoising_mesh(points, mesher, neighborhood, cache)
+
+        '''
+        Below is the implementation of the algorithm itself
+        '''
+        points = bilateral_denoise(points, tri, iterations, n_degree, engine,
+                                   neighborhood, tolerance, converge_max, converge_rms,
+                                   checkpoint, normals)
 
     sys.stdout.write("\n")
         
     # write the data in .xyz format to a file
+    with instrumentation.stage("write"):
+        write_xyz(save_filename, points)
+
+    print("Done!")
+
+
+'''
+Function:   run_bilateral_denoising
+Use:        to execute this algorithm from another script
+Parameters...
+testing: use the bunny defaults instead of prompting for parameters
+engine, neighborhood, mesher, subsampling: see denoise_file
+'''
+def run_bilateral_denoising(testing, engine="batch", neighborhood="simplex",
+                            mesher="delaunay", subsampling="stride"):
+
+    print("***********************************")
+    print("Running Bilateral Mesh Smoothing...")
+    print("***********************************")
+
+    # testing defaults for parameters
+    filename = "bunny.xyz"
+    sub_sampling = 5
+    iterations = 2
+    n_degree = 4
     save_filename = "bunny_bms_denoised.xyz"
+
     if (not testing):
-        save_filename = input("Output .xyz filename: ")
-    save_file = open(save_filename, "w")
-    save_file.write("")
-    save_file = open(save_filename, "a")
-    for p in points: 
-        save_file.write(str(p[0]) + " " + str(p[1]) + " " + str(p[2]) + "\n")
+        filename = input("Input filename: ")
 
-    print("Done!")
-                
-        
+        # how many points to skip in subsampling
+        sub_sampling = int(input("Sub sampling (0 for none): "))
+
+        # how many times to smooth the mesh
+        iterations = int(input("Algorithm iterations: "))
+
+        # how many levels of neighbors to include in normal calculations
+        n_degree = int(input("Neighbor range (for normals): "))
+
+        save_filename = input("Output .xyz filename: ")
 
+    denoise_file(filename, save_filename, sub_sampling, iterations, n_degree,
+                 engine, neighborhood, mesher, subsampling)
@@ -1,11 +1,102 @@
 from scipy.spatial import Delaunay
 import numpy as np
 import math
+import os
+import shutil
+import tempfile
 from cloud_to_gts import gts_write
 from cloud_to_gts import input_triangulation
 from run_non_iterative import run_non_iterative
 from BilateralMeshDenoising import run_bilateral_denoising
 from run_icp import run_icp
+from BilateralMeshDenoising import bilateral_denoise
+from BilateralMeshDenoising import knn_size
+from cloud_io import load_xyz_points
+from cloud_io import write_xyz
+from cloud_to_gts import load_triangulation
+from normal_estimation import NormalCache
+from normal_estimation import pca_normals
+from out_of_core import tiled_denoise
+
+'''
+Function:   check_engines
+Use:        the batch engine matches the per-point loop
+'''
+def check_engines():
+    tri, points = load_triangulation("bunny.xyz", 16, cache=False)
+    loop = bilateral_denoise(points, tri, 1, 2, engine="loop")
+    batch = bilateral_denoise(points, tri, 1, 2, engine="batch")
+    # the last point is not in the triangulation (see triangulate) and has no
+    # neighbors, where the loop keeps the offset of the point before it
+    assert np.allclose(loop[:-1], batch[:-1], rtol=0, atol=1e-14)
+
+'''
+Function:   check_parallel
+Use:        the multi-process engine matches the serial kdtree run
+'''
+def check_parallel():
+    points = np.asarray(load_xyz_points("bunny_noisy.xyz", cache=False))
+    serial = bilateral_denoise(points, None, 2, 2, neighborhood="kdtree")
+    parallel = bilateral_denoise(points, None, 2, 2, engine="parallel", neighborhood="kdtree")
+    assert np.allclose(parallel, serial, rtol=0, atol=1e-12)
+
+'''
+Function:   check_normal_cache
+Use:        the normals a NormalCache keeps up to date after some points moved
+            match a full estimation at the new positions (up to their sign)
+'''
+def check_normal_cache():
+    points = np.asarray(load_xyz_points("bunny_noisy.xyz", cache=False))
+    cache = NormalCache(knn_size(2))
+    cache.update(points)
+
+    rng = np.random.default_rng(0)
+    moved = points.copy()
+    index = rng.choice(points.shape[0], 50, replace=False)
+    moved[index] += rng.normal(scale=0.01 * np.ptp(points, axis=0).max(), size=(50, 3))
+    normals = cache.update(moved)
+    expected = pca_normals(moved, knn_size(2))[0]
+    assert np.allclose(np.abs(np.einsum('ij,ij->i', normals, expected)), 1, rtol=0, atol=1e-9)
+
+'''
+Function:   check_single_precision
+Use:        single precision keeps the points in float32 and stays within about
+            a millionth of the cloud size of double precision for most points
+'''
+def check_single_precision():
+    tri, points = load_triangulation("bunny.xyz", 16, cache=False)
+    single_tri, single_points = load_triangulation("bunny.xyz", 16, cache=False,
+                                                   precision="single")
+    double = bilateral_denoise(points, tri, 2, 2)
+    single = bilateral_denoise(single_points, single_tri, 2, 2)
+    assert single.dtype == np.float32
+    error = np.linalg.norm(single - double, axis=1) / np.ptp(points, axis=0).max()
+    assert np.median(error) < 1e-6
+    assert np.quantile(error, 0.9) < 1e-5
+
+'''
+Function:   check_tiled
+Use:        the tiled out-of-core run matches the whole-cloud kdtree run, with
+            a few scattered points alone in their tiles (their k-NN lie in
+            other tiles)
+'''
+def check_tiled():
+    points = np.asarray(load_xyz_points("bunny_noisy.xyz", cache=False))[::12]
+    rng = np.random.default_rng(0)
+    points = np.concatenate((points, rng.uniform(points.min(axis=0), points.max(axis=0),
+                                                 (6, 3))))
+    expected = bilateral_denoise(points, None, 1, 1, neighborhood="kdtree")
+
+    work_dir = tempfile.mkdtemp(prefix="auto_test_")
+    try:
+        write_xyz(os.path.join(work_dir, "cloud.xyz"), points)
+        tiled_denoise(os.path.join(work_dir, "cloud.xyz"),
+                      os.path.join(work_dir, "tiled.xyz"), iterations=1, n_degree=1,
+                      tile_points=100)
+        tiled = load_xyz_points(os.path.join(work_dir, "tiled.xyz"), cache=False)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    assert np.allclose(tiled, expected, rtol=0, atol=1e-9)
 
 def test_1():
 
@@ -30,6 +121,31 @@ def test_1():
     print("ICP is FUNCTIONAL")
     print()
 
+    check_engines()
+    print()
+    print("BATCH ENGINE matches the loop")
+    print()
+
+    check_parallel()
+    print()
+    print("PARALLEL ENGINE matches the serial run")
+    print()
+
+    check_tiled()
+    print()
+    print("TILED DENOISING matches the whole cloud")
+    print()
+
+    check_normal_cache()
+    print()
+    print("NORMAL CACHE matches a full estimation")
+    print()
+
+    check_single_precision()
+    print()
+    print("SINGLE PRECISION matches double precision")
+    print()
+
     print("ALL TESTS PASSED")
     print()
 
@@ -0,0 +1,332 @@
+'''
+    Batch Denoising
+
+    Runs many denoising jobs without any prompts, from a JSON manifest:
+
+        python3 batch_denoise.py manifest.json --processes 4 --timeout 3600
+
+    The manifest is a list of jobs, or an object with a "jobs" list and the
+    "defaults" shared by all of them:
+
+        {
+            "defaults": {"method": "bilateral",
+                         "params": {"bilateral": {"iterations": 2, "n_degree": 4}}},
+            "jobs": [
+                {"input": "bunny_noisy.xyz", "reference": "bunny.xyz"},
+                {"input": "dragon_noisy.xyz", "method": "non_iterative",
+                    "params": {"arg1": "2", "arg2": "1", "dist_mode": "1"},
+                    "timeout": 600}
+            ]
+        }
+
+    Each job has:
+        input:      the .xyz file (the mesh file for "gts_to_xyz")
+        method:     "bilateral" (denoise_file in BilateralMeshDenoising.py),
+                    "non_iterative" (smooth_file in run_non_iterative.py) or
+                    "gts_to_xyz" (mesh_to_cloud in cloud_to_gts.py, for
+                    binary meshes and GTS text)
+        params:     keyword arguments of that function
+        output:     the output .xyz file, named after the input and the method
+                    in the output directory if not given
+        reference:  optional .xyz file the output is scored against with
+                    evaluation.py once all jobs are done (the KD-tree of a
+                    reference is built once for all the jobs using it)
+        threshold:  optional inlier distance of the scores
+        timeout:    optional seconds after which the job is stopped
+
+    The "params" of the defaults are given per method, and the job "params"
+    are added to those of its method.
+    Relative input and reference paths are relative to the manifest, relative
+    outputs to the output directory. Every job runs in its own process, at most
+    --processes at a time, and its printed output goes to a .log file next to
+    its output. A job that fails or times out does not stop the others. The
+    status and run time of every job are printed at the end and written to a
+    JSON summary, along with the stage timings and counters the job reported
+    (see instrumentation.py) and its scores.
+'''
+from multiprocessing import Pipe
+from multiprocessing import Process
+from multiprocessing.connection import wait
+import argparse
+import json
+import os
+import signal
+import sys
+import time
+import traceback
+import instrumentation
+
+METHODS = ("bilateral", "non_iterative", "gts_to_xyz")
+
+'''
+Function:   load_manifest
+Use:        read the jobs of a manifest, with the defaults and paths filled in
+Parameters...
+filename: the manifest .json file
+output_dir: directory of the outputs and logs
+timeout: default timeout in seconds, None for no limit
+'''
+def load_manifest(filename, output_dir, timeout=None):
+    with open(filename, 'r') as f:
+        manifest = json.load(f)
+
+    defaults = {}
+    if (isinstance(manifest, dict)):
+        defaults = manifest.get("defaults", {})
+        manifest = manifest.get("jobs", [])
+
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    jobs = []
+    for number, entry in enumerate(manifest):
+        job = dict(defaults)
+        job.update(entry)
+        job.setdefault("method", "bilateral")
+        job.setdefault("timeout", timeout)
+        params = defaults.get("params", {}).get(job["method"], {})
+        job["params"] = dict(params, **entry.get("params", {}))
+
+        if (job["method"] not in METHODS):
+            raise ValueError("Unknown method: " + str(job["method"]))
+        if ("input" not in job):
+            raise ValueError("Job " + str(number) + " has no input")
+
+        job["input"] = os.path.join(base_dir, job["input"])
+        if (job.get("reference")):
+            job["reference"] = os.path.join(base_dir, job["reference"])
+
+        # number the outputs so the same input can be run with several parameters
+        if (not job.get("output")):
+            name = os.path.splitext(os.path.basename(job["input"]))[0]
+            job["output"] = "%s_%s_%d.xyz" % (name, job["method"], number)
+        job["output"] = os.path.join(output_dir, job["output"])
+        job["log"] = os.path.splitext(job["output"])[0] + ".log"
+        jobs.append(job)
+    return jobs
+
+
+'''
+Function:   execute_job
+Use:        run the method of a job, in the current process
+'''
+def execute_job(job):
+    if (job["method"] == "bilateral"):
+        from BilateralMeshDenoising import denoise_file
+        denoise_file(job["input"], job["output"], **job["params"])
+    elif (job["method"] == "non_iterative"):
+        from cloud_to_gts import MESH_EXTENSIONS
+        from run_non_iterative import smooth_file
+        params = dict(job["params"])
+        # keep the intermediate mesh files of parallel jobs apart
+        base = os.path.splitext(job["output"])[0]
+        extension = MESH_EXTENSIONS.get(params.get("mesh_format", "gts"), ".gts")
+        params.setdefault("gts_in", base + "_mesh" + extension)
+        params.setdefault("gts_out", base + "_smooth" + extension)
+        smooth_file(job["input"], job["output"], **params)
+    else:
+        from cloud_to_gts import mesh_to_cloud
+        mesh_to_cloud(job["input"], job["output"])
+
+
+'''
+Function:   job_process
+Use:        entry point of the process of a job, sends back the result
+Parameters...
+job: the job from load_manifest
+connection: pipe to send the result through
+'''
+def job_process(job, connection):
+    # a group of its own, so that a timeout also stops the smoother program
+    # and the pool workers the job starts
+    os.setsid()
+    start = time.time()
+    result = {"status": "ok", "error": None}
+    # line buffered, so the lines of the subprocesses stay in order
+    with open(job["log"], 'w', buffering=1) as log:
+        # the pipelines print their progress, keep it out of the batch output,
+        # along with that of the programs they start (which write to fd 1 and 2)
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        sys.stdout = log
+        sys.stderr = log
+
+        # log the stages as they run, and record their timings and counters
+        def log_stage(event, name, value):
+            if (event == "stage_end"):
+                log.write("[%8.2f s] %s took %.3f s\n" % (time.time() - start, name, value))
+        instrumentation.enable()
+        instrumentation.subscribe(log_stage)
+        try:
+            execute_job(job)
+        except Exception:
+            result = {"status": "failed", "error": traceback.format_exc().splitlines()[-1]}
+            traceback.print_exc()
+        sys.stdout.flush()
+    result["seconds"] = time.time() - start
+    result["instrumentation"] = instrumentation.report()
+    connection.send(result)
+    connection.close()
+
+
+'''
+Function:   run_jobs
+Use:        run jobs in separate processes, a bounded number at a time, and
+            stop those that run past their timeout
+Parameters...
+jobs: list of jobs from load_manifest
+processes: how many jobs run at the same time
+
+Returns the result of every job, in the order of the jobs.
+'''
+def run_jobs(jobs, processes):
+    results = [None] * len(jobs)
+    waiting = list(range(len(jobs)))
+    # sentinel of the process -> (job number, process, pipe, start, deadline)
+    running = {}
+
+    while (waiting or running):
+        while (waiting and len(running) < processes):
+            number = waiting.pop(0)
+            job = jobs[number]
+            receiver, sender = Pipe(duplex=False)
+            process = Process(target=job_process, args=(job, sender))
+            process.start()
+            sender.close()
+            start = time.time()
+            deadline = None
+            if (job["timeout"] is not None):
+                deadline = start + float(job["timeout"])
+            running[process.sentinel] = (number, process, receiver, start, deadline)
+            print("Started:  " + os.path.basename(job["input"]) + " (" + job["method"] + ")")
+
+        deadlines = [r[4] for r in running.values() if r[4] is not None]
+        wait_time = None
+        if (deadlines):
+            wait_time = max(min(deadlines) - time.time(), 0)
+        done = wait(list(running.keys()), wait_time)
+
+        now = time.time()
+        for sentinel in list(running.keys()):
+            number, process, receiver, start, deadline = running[sentinel]
+            if (sentinel in done):
+                process.join()
+                if (receiver.poll()):
+                    result = receiver.recv()
+                else:
+                    result = {"status": "failed", "seconds": now - start,
+                              "error": "exit code " + str(process.exitcode)}
+            elif (deadline is not None and now >= deadline):
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    # stopped before its group was set up
+                    process.terminate()
+                process.join()
+                result = {"status": "timeout", "seconds": now - start,
+                          "error": "stopped after %g s" % (deadline - start)}
+            else:
+                continue
+            receiver.close()
+            del running[sentinel]
+
+            result.update(input=jobs[number]["input"], method=jobs[number]["method"],
+                          output=jobs[number]["output"], log=jobs[number]["log"])
+            results[number] = result
+            print("Finished: " + os.path.basename(jobs[number]["input"]) + " (" +
+                  result["status"] + ", %.1f s)" % result["seconds"])
+
+    return results
+
+
+'''
+Function:   score_outputs
+Use:        score the outputs of the finished jobs against their references
+Parameters...
+jobs: list of jobs from load_manifest
+results: the results of the jobs from run_jobs, the scores are added to them
+'''
+def score_outputs(jobs, results):
+    from cloud_io import load_xyz_points
+    from evaluation import THRESHOLD
+    from evaluation import ReferenceCloud
+    references = {}
+    for job, result in zip(jobs, results):
+        if (not job.get("reference") or result["status"] != "ok"):
+            continue
+        try:
+            if (job["reference"] not in references):
+                references[job["reference"]] = ReferenceCloud(load_xyz_points(job["reference"]))
+            result["scores"] = references[job["reference"]].evaluate(
+                load_xyz_points(job["output"]), job.get("threshold", THRESHOLD))
+        except Exception:
+            result["status"] = "failed"
+            result["error"] = "scoring: " + traceback.format_exc().splitlines()[-1]
+
+
+'''
+Function:   write_summary
+Use:        print a table of the results and write them to a JSON file
+Parameters...
+results: list of job results from run_jobs
+filename: the summary .json file
+seconds: wall clock time of the whole batch
+'''
+def write_summary(results, filename, seconds):
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+
+    summary = {"jobs": results, "seconds": seconds, "counts": counts}
+    with open(filename, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    print()
+    print("************* Batch Summary *************")
+    for result in results:
+        print("%-8s %9.1f s  %s (%s)" % (result["status"], result["seconds"],
+                                         os.path.basename(result["input"]), result["method"]))
+        if (result["error"]):
+            print("         " + result["error"])
+        if (result.get("scores")):
+            print("         fitness %.4f, chamfer %.4g, hausdorff %.4g" % (
+                result["scores"]["fitness"], result["scores"]["chamfer"],
+                result["scores"]["hausdorff"]))
+    print("*****************************************")
+    print(", ".join("%d %s" % (counts[s], s) for s in sorted(counts)) +
+          " in %.1f s" % seconds)
+    print("Summary written to " + filename)
+
+
+'''
+Function:   main()
+Use:        run a batch from the command line
+Parameters...
+argv: the command line arguments, those of the process if not given
+'''
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the denoising jobs of a manifest")
+    parser.add_argument("manifest", help="JSON file listing the jobs")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="how many jobs run at the same time (default: all cores)")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="default seconds after which a job is stopped")
+    parser.add_argument("--output-dir", default="batch_output",
+                        help="directory of the outputs and logs")
+    parser.add_argument("--summary", default=None,
+                        help="summary JSON file (default: summary.json in the output directory)")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    jobs = load_manifest(args.manifest, args.output_dir, args.timeout)
+    summary = args.summary or os.path.join(args.output_dir, "summary.json")
+
+    start = time.time()
+    results = run_jobs(jobs, max(args.processes, 1))
+    score_outputs(jobs, results)
+    write_summary(results, summary, time.time() - start)
+
+    # a non-zero exit status lets scripts notice failed jobs
+    return int(any(r["status"] != "ok" for r in results))
+
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -0,0 +1,527 @@
+'''
+    Stage Benchmarks
+
+    Times every stage of the pipelines separately, on several datasets and
+    subsampling rates, so it is visible how each stage scales with the number
+    of points and whether a change made it faster or slower:
+
+        python3 benchmark.py --output results.json
+        python3 benchmark.py --baseline results.json --threshold 0.2
+
+    The stages, run in this order on each (dataset, subsampling rate):
+
+        load            parse the .xyz text (no sidecar)
+        load_cached     load the points from the binary sidecar
+        subsample       subsample the points
+        triangulation   Delaunay triangulation
+        normals         bilateral normals and neighbors (simplex_neighborhoods)
+        pca_normals     oriented k-NN normals (normal_estimation.py)
+        bilateral       bilateral update of the points (bilateral_offsets)
+        bilateral_loop  one iteration of the per-point loop (calc_normal),
+                        only when asked for since it is slow
+        multires_transfer
+                        interpolate the bilateral displacements onto the full
+                        cloud (multiresolution.py)
+        gts_write       write the GTS file of the triangulation
+        mesh_write      write the binary mesh file of the triangulation
+        mesh_read       read the points back from the binary mesh file
+        smoother        the NumPy non-iterative smoother
+        smoother_binary the compiled smoother program on the GTS file
+        smoother_mesh   the compiled smoother program on the binary mesh file,
+                        skipped for smoothers built before that format
+        icp             ICP alignment and scores against the full cloud with
+                        evaluation.py (icp_align), the KD-tree included
+        icp_open3d      the open3d ICP evaluation of ICPEval.py, only when
+                        asked for since open3d is an optional install
+        evaluation      scores against the full cloud with evaluation.py,
+                        the KD-tree of the full cloud included
+
+    A stage that cannot run here (no compiled smoother, no open3d) is recorded
+    as skipped. Every stage is run --repeat times and the fastest time is kept.
+    The peak memory is what Python and NumPy allocate during the stage, from
+    tracemalloc (qhull and the smoother program allocate outside of it), on
+    the first run only, since tracing slows the allocations down a little.
+
+    The results are written as JSON. Given a baseline (the JSON of an earlier
+    run), every stage that got slower than the baseline by more than the
+    threshold is reported, and the exit status is 1 if there is any.
+'''
+from contextlib import redirect_stdout
+from scipy.spatial import Delaunay
+import numpy as np
+import argparse
+import json
+import os
+import platform
+import resource
+import scipy
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from BilateralMeshDenoising import bilateral_iteration
+from BilateralMeshDenoising import bilateral_offsets
+from BilateralMeshDenoising import knn_size
+from BilateralMeshDenoising import simplex_neighborhoods
+from cloud_io import load_xyz_points
+from cloud_io import parse_xyz
+from cloud_io import write_xyz
+from cloud_to_gts import gts_write
+from cloud_to_gts import mesh_faces
+from cloud_to_gts import read_mesh
+from cloud_to_gts import write_mesh
+from evaluation import ReferenceCloud
+from multiresolution import transfer_displacements
+from non_iterative_smoothing import non_iterative_smooth
+from normal_estimation import orient_normals
+from normal_estimation import pca_normals
+from run_non_iterative import smoother_accepts_binary
+from run_non_iterative import smoother_program
+from subsampling import subsample_points
+
+DATASETS = ("bunny.xyz", "bunny_noisy.xyz", "dragon_noisy.xyz")
+SUBSAMPLING = (16, 8, 4)
+STAGES = ("load", "load_cached", "subsample", "triangulation", "normals", "pca_normals",
+          "bilateral", "bilateral_loop", "multires_transfer", "gts_write", "mesh_write", "mesh_read", "smoother",
+          "smoother_binary", "smoother_mesh", "icp", "icp_open3d",
+          "evaluation")
+DEFAULT_STAGES = tuple(s for s in STAGES if s not in ("bilateral_loop", "icp_open3d"))
+
+# stages whose results a stage uses
+REQUIRES = {"normals": ("triangulation",),
+            "bilateral": ("triangulation", "normals"),
+            "bilateral_loop": ("triangulation",),
+            "multires_transfer": ("triangulation", "normals", "bilateral"),
+            "gts_write": ("triangulation",),
+            "mesh_write": ("triangulation",),
+            "mesh_read": ("triangulation", "mesh_write"),
+            "smoother": ("triangulation",),
+            "smoother_binary": ("triangulation", "gts_write"),
+            "smoother_mesh": ("triangulation", "mesh_write")}
+
+# timings below this many seconds are too noisy to compare to a baseline
+MIN_SECONDS = 0.01
+
+
+class SkipStage(Exception):
+    '''
+    Class:  SkipStage
+    Use:    raised by a stage that cannot run in this environment
+    '''
+
+
+'''
+Function:   stage_load
+Use:        parse the .xyz text of the dataset
+'''
+def stage_load(state):
+    state["cloud"] = parse_xyz(state["filename"])
+
+
+'''
+Function:   stage_load_cached
+Use:        load the points of the dataset from its sidecar (written by the
+            first load, outside of the timing)
+'''
+def stage_load_cached(state):
+    state["cloud"] = np.asarray(load_xyz_points(state["filename"]))
+
+
+'''
+Function:   stage_subsample
+Use:        subsample the whole cloud to the points used by the later stages
+'''
+def stage_subsample(state):
+    state["points"] = np.asarray(subsample_points(state["cloud"], state["subsampling"],
+                                                  state["rate"]), dtype=float)
+
+
+'''
+Function:   stage_triangulation
+Use:        Delaunay triangulation of the points, as in the pipelines
+'''
+def stage_triangulation(state):
+    state["tri"] = Delaunay(state["points"][:-1], qhull_options="Qbb Qc Qz Q12 QJ Qt")
+
+
+'''
+Function:   stage_normals
+Use:        normals and neighbors of all points for the bilateral update
+'''
+def stage_normals(state):
+    state["normals"], state["candidates"], state["sigma_c"] = simplex_neighborhoods(
+        state["points"], state["tri"], state["n_degree"])
+
+
+'''
+Function:   stage_pca_normals
+Use:        oriented k-NN normals of all points, as for normals="pca"
+'''
+def stage_pca_normals(state):
+    normals, nearest = pca_normals(state["points"], knn_size(state["n_degree"]))
+    orient_normals(state["points"], normals, nearest)
+
+
+'''
+Function:   stage_bilateral
+Use:        bilateral update of all points from their normals and neighbors
+'''
+def stage_bilateral(state):
+    points = state["points"]
+    factor = bilateral_offsets(points, state["normals"], state["candidates"], state["sigma_c"])
+    state["denoised"] = points + factor[:, None] * state["normals"]
+
+
+'''
+Function:   stage_bilateral_loop
+Use:        one iteration of the per-point bilateral loop
+'''
+def stage_bilateral_loop(state):
+    bilateral_iteration(state["points"], state["tri"], state["n_degree"])
+
+
+'''
+Function:   stage_multires_transfer
+Use:        carry the displacements of the bilateral stage back onto every
+            point of the cloud
+'''
+def stage_multires_transfer(state):
+    points = state["points"]
+    transfer_displacements(points, state["denoised"] - points, state["cloud"])
+
+
+'''
+Function:   stage_gts_write
+Use:        write the GTS file of the triangulation
+'''
+def stage_gts_write(state):
+    gts_write(state["tri"], state["points"], True, state["gts_file"])
+
+
+'''
+Function:   stage_mesh_write
+Use:        write the binary mesh file of the triangulation
+'''
+def stage_mesh_write(state):
+    write_mesh(state["tri"], state["points"], state["mesh_file"])
+
+
+'''
+Function:   stage_mesh_read
+Use:        read the points of the binary mesh file into memory
+'''
+def stage_mesh_read(state):
+    np.array(read_mesh(state["mesh_file"])[0])
+
+
+'''
+Function:   stage_smoother
+Use:        run the NumPy non-iterative smoother on the triangulation
+'''
+def stage_smoother(state):
+    faces = mesh_faces(state["tri"], state["points"].shape[0])
+    non_iterative_smooth(state["points"], faces, 1.0, 1.0, 1)
+
+
+'''
+Function:   run_smoother
+Use:        run the compiled smoother program on a mesh file
+Parameters...
+mesh_file: the GTS or binary mesh file
+options: extra arguments of the program (["-b"] for a binary mesh)
+'''
+def run_smoother(mesh_file, options=()):
+    program = smoother_program()
+    if (not os.access(program, os.X_OK)):
+        raise SkipStage("no compiled smoother at " + program)
+    with open(mesh_file, 'rb') as f:
+        done = subprocess.run([program, "1", "1", "1"] + list(options), stdin=f,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if (done.returncode != 0):
+        message = done.stderr.decode(errors="replace").strip().splitlines()
+        raise SkipStage("smoother failed: " + (message[-1] if message else str(done.returncode)))
+
+
+'''
+Function:   stage_smoother_binary
+Use:        run the compiled smoother program on the GTS file
+'''
+def stage_smoother_binary(state):
+    run_smoother(state["gts_file"])
+
+
+'''
+Function:   stage_smoother_mesh
+Use:        run the compiled smoother program on the binary mesh file
+'''
+def stage_smoother_mesh(state):
+    if (os.access(smoother_program(), os.X_OK) and
+            not smoother_accepts_binary(smoother_program())):
+        raise SkipStage("the smoother does not accept binary meshes")
+    run_smoother(state["mesh_file"], ["-b"])
+
+
+'''
+Function:   stage_icp
+Use:        native ICP alignment and scores of the denoised points against the
+            full cloud, as run_icp.py
+'''
+def stage_icp(state):
+    reference = ReferenceCloud(state["cloud"])
+    reference.evaluate(state.get("denoised", state["points"]), icp=True)
+
+
+'''
+Function:   stage_icp_open3d
+Use:        open3d ICP evaluation of the denoised points against the full cloud
+'''
+def stage_icp_open3d(state):
+    try:
+        from ICPEval import icp_eval, init_para, load_xyz
+    except ImportError as e:
+        raise SkipStage(str(e))
+    denoised = os.path.join(state["work_dir"], "denoised.xyz")
+    write_xyz(denoised, state.get("denoised", state["points"]))
+    source, target = load_xyz(denoised, state["filename"])
+    threshold, trans_init = init_para()
+    icp_eval(source, target, threshold, trans_init)
+
+
+'''
+Function:   stage_evaluation
+Use:        native scores of the denoised points against the full cloud
+'''
+def stage_evaluation(state):
+    reference = ReferenceCloud(state["cloud"])
+    reference.evaluate(state.get("denoised", state["points"]))
+
+
+STAGE_FUNCTIONS = {"load": stage_load, "load_cached": stage_load_cached,
+                   "subsample": stage_subsample, "triangulation": stage_triangulation,
+                   "normals": stage_normals, "pca_normals": stage_pca_normals,
+                   "bilateral": stage_bilateral,
+                   "bilateral_loop": stage_bilateral_loop,
+                   "multires_transfer": stage_multires_transfer, "gts_write": stage_gts_write,
+                   "mesh_write": stage_mesh_write, "mesh_read": stage_mesh_read,
+                   "smoother": stage_smoother, "smoother_binary": stage_smoother_binary,
+                   "smoother_mesh": stage_smoother_mesh,
+                   "icp": stage_icp, "icp_open3d": stage_icp_open3d,
+                   "evaluation": stage_evaluation}
+
+
+'''
+Function:   measure
+Use:        run a stage and measure its time and peak memory
+Parameters...
+function: the stage function
+state: the state passed to the stage
+repeat: how many times to run the stage, the fastest time is kept
+track_memory: measure the peak memory (on the first run only)
+
+Returns (seconds, peak bytes or None).
+'''
+def measure(function, state, repeat=1, track_memory=True):
+    best = None
+    peak = None
+    for i in range(max(repeat, 1)):
+        tracing = track_memory and i == 0
+        if (tracing):
+            tracemalloc.start()
+        try:
+            # the progress printed by the pipelines would break up the table
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                start = time.perf_counter()
+                function(state)
+                seconds = time.perf_counter() - start
+            if (tracing):
+                current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if (tracing):
+                tracemalloc.stop()
+        if (best is None or seconds < best):
+            best = seconds
+    return best, peak
+
+
+'''
+Function:   run_benchmarks
+Use:        run the stages on every dataset and subsampling rate
+Parameters...
+datasets: list of .xyz files
+levels: list of subsampling rates
+stages: names of the stages to run, they are run in the order of STAGES
+repeat: how many times each stage is run
+track_memory: measure the peak memory of the stages
+subsampling: "stride", "voxel" or "poisson", see subsampling.subsample_points
+n_degree: neighbor range of the normals and the per-point bilateral loop
+
+Returns a list of results, one per (dataset, rate, stage).
+'''
+def run_benchmarks(datasets, levels, stages, repeat=1, track_memory=True,
+                   subsampling="stride", n_degree=4):
+    results = []
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as work_dir:
+        for filename in datasets:
+            # make sure the sidecar exists, so load_cached measures a cached load
+            load_xyz_points(filename)
+            for rate in levels:
+                state = {"filename": filename, "rate": rate, "subsampling": subsampling,
+                         "n_degree": n_degree, "work_dir": work_dir,
+                         "gts_file": os.path.join(work_dir, "mesh.gts"),
+                         "mesh_file": os.path.join(work_dir, "mesh.bmesh")}
+                stage_load_cached(state)
+                stage_subsample(state)
+                done = set()
+                for name in STAGES:
+                    if (name not in stages):
+                        continue
+                    # the inputs of a stage that were not timed are made untimed
+                    for required in REQUIRES.get(name, ()):
+                        if (required not in done):
+                            STAGE_FUNCTIONS[required](state)
+                            done.add(required)
+
+                    result = {"dataset": os.path.basename(filename), "subsample": rate,
+                              "points": int(state["points"].shape[0]), "stage": name}
+                    try:
+                        seconds, peak = measure(STAGE_FUNCTIONS[name], state,
+                                                repeat, track_memory)
+                        result.update(seconds=seconds, peak_bytes=peak)
+                    except SkipStage as e:
+                        result.update(seconds=None, peak_bytes=None, skipped=str(e))
+                    done.add(name)
+                    results.append(result)
+                    print_result(result)
+    return results
+
+
+'''
+Function:   print_result
+Use:        print one result as a row of the table
+'''
+def print_result(result):
+    if (result["seconds"] is None):
+        timing = "skipped (" + result["skipped"] + ")"
+    else:
+        timing = "%10.4f s" % result["seconds"]
+        if (result["peak_bytes"] is not None):
+            timing += "  %9.1f MB" % (result["peak_bytes"] / 1e6)
+    print("%-18s %4d %8d  %-16s %s" % (result["dataset"], result["subsample"],
+                                       result["points"], result["stage"], timing))
+
+
+'''
+Function:   scaling_exponents
+Use:        fit seconds ~ points^k for every (dataset, stage) over the rates
+Parameters...
+results: list of results from run_benchmarks
+
+Returns {(dataset, stage): k} for the stages timed at two or more sizes.
+'''
+def scaling_exponents(results):
+    series = {}
+    for r in results:
+        if (r["seconds"] and r["stage"] not in ("load", "load_cached")):
+            series.setdefault((r["dataset"], r["stage"]), []).append((r["points"], r["seconds"]))
+    exponents = {}
+    for key, values in series.items():
+        sizes = np.log([v[0] for v in values])
+        if (len(values) > 1 and np.ptp(sizes) > 0):
+            exponents[key] = float(np.polyfit(sizes, np.log([v[1] for v in values]), 1)[0])
+    return exponents
+
+
+'''
+Function:   compare_to_baseline
+Use:        find the stages that got slower than in the baseline
+Parameters...
+results: list of results from run_benchmarks
+baseline: list of results of an earlier run
+threshold: accepted relative slowdown, e.g. 0.2 for 20%
+
+Returns a list of (result, baseline seconds) of the regressions.
+'''
+def compare_to_baseline(results, baseline, threshold):
+    previous = {(b["dataset"], b["subsample"], b["stage"]): b["seconds"] for b in baseline}
+    regressions = []
+    for r in results:
+        old = previous.get((r["dataset"], r["subsample"], r["stage"]))
+        if (r["seconds"] is None or old is None):
+            continue
+        if (max(r["seconds"], old) >= MIN_SECONDS and r["seconds"] > old * (1 + threshold)):
+            regressions.append((r, old))
+    return regressions
+
+
+'''
+Function:   environment
+Use:        description of the machine and versions, stored with the results
+'''
+def environment():
+    return {"python": platform.python_version(), "numpy": np.__version__,
+            "scipy": scipy.__version__, "platform": platform.platform(),
+            "processor": platform.processor(), "cpus": os.cpu_count(),
+            "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+
+'''
+Function:   main()
+Use:        run the benchmarks from the command line
+Parameters...
+argv: the command line arguments, those of the process if not given
+'''
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time every stage of the pipelines")
+    parser.add_argument("--datasets", nargs="+", default=list(DATASETS))
+    parser.add_argument("--subsample", nargs="+", type=int, default=list(SUBSAMPLING),
+                        help="subsampling rates to run (default: %(default)s)")
+    parser.add_argument("--subsampling", default="stride",
+                        choices=("stride", "voxel", "poisson"))
+    parser.add_argument("--stages", nargs="+", default=list(DEFAULT_STAGES), choices=STAGES)
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="runs of every stage, the fastest is kept")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="do not measure the peak memory of the stages")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default=None,
+                        help="results JSON of an earlier run to compare to")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown reported as a regression (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.datasets, args.subsample, args.stages, args.repeat,
+                             not args.no_memory, args.subsampling)
+
+    exponents = scaling_exponents(results)
+    print()
+    print("****** Scaling (seconds ~ points^k) ******")
+    for (dataset, stage), k in sorted(exponents.items()):
+        print("%-18s %-16s k = %.2f" % (dataset, stage, k))
+
+    report = {"environment": environment(), "results": results,
+              "scaling": [{"dataset": d, "stage": s, "exponent": k}
+                          for (d, s), k in sorted(exponents.items())],
+              "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to " + args.output)
+
+    if (args.baseline is None):
+        return 0
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)["results"]
+    regressions = compare_to_baseline(results, baseline, args.threshold)
+    print()
+    print("****** Regressions over %d%% ******" % round(100 * args.threshold))
+    for r, old in regressions:
+        print("%-18s %4d  %-16s %.4f s -> %.4f s" % (r["dataset"], r["subsample"],
+                                                     r["stage"], old, r["seconds"]))
+    if (not regressions):
+        print("None")
+    return int(len(regressions) > 0)
+
+
+if __name__=="__main__":
+    sys.exit(main())
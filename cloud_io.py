@@ -0,0 +1,318 @@
+import numpy as np
+import glob
+import os
+import shutil
+import tempfile
+
+'''
+This python utility contains the functions used to read and write point clouds.
+
+Our .xyz files hold one point per row ("x y z"), or two points per row
+("x1 y1 z1 x2 y2 z2"), in which case the points are read in row order,
+first point before second point.
+
+Parsing text is slow, so the first time a file is loaded a binary .npy copy is
+written next to it (the "sidecar"). The sidecar name holds the size and the
+modification time of the .xyz file, so it is only reused while the .xyz file
+is unchanged, and later loads simply memory-map it. The sidecar is written from
+blocks of the text file, so loading never holds the whole cloud in memory.
+Each process writes its own temporary file and renames it into place, so
+concurrent loads of the same file (e.g. parallel batch jobs) never see a
+partial sidecar, and a sidecar that cannot be read is simply parsed again.
+
+Writing is done in blocks of rows, each formatted with a single string
+operation, so large clouds are written at close to disk speed without ever
+holding the whole text in memory. Values are written with every digit of their
+type (value_format), so a written cloud reads back unchanged.
+'''
+
+# rows formatted and written at a time
+CHUNK_ROWS = 65536
+
+# bytes of text parsed at a time when writing a sidecar
+CHUNK_BYTES = 1 << 24
+
+# coordinate types of the precision modes, "single" halves the memory of the
+# points and of everything computed from them
+PRECISIONS = {"double": np.float64, "single": np.float32}
+
+'''
+Function:   precision_dtype
+Use:        coordinate type of a precision mode, "double" or "single"
+'''
+def precision_dtype(precision):
+    if (precision not in PRECISIONS):
+        raise ValueError("Unknown precision: " + str(precision))
+    return PRECISIONS[precision]
+
+
+'''
+Function:   sidecar_filename
+Use:        name of the binary cache of a .xyz file in its current state
+Parameters...
+filename: the .xyz file
+dtype: data type of the cached points
+'''
+def sidecar_filename(filename, dtype):
+    info = os.stat(filename)
+    return "%s.%s.%d_%d.npy" % (filename, np.dtype(dtype).name,
+                                info.st_size, info.st_mtime_ns)
+
+
+'''
+Function:   row_lengths_match
+Use:        whether every row of a text holds one of the given numbers of
+            values, counted on the bytes of the text without splitting it
+Parameters...
+text: rows of whitespace separated values
+lengths: the allowed numbers of values per row
+'''
+def row_lengths_match(text, lengths):
+    data = np.frombuffer(text.encode(), dtype=np.uint8)
+    if (data.shape[0] == 0):
+        return True
+    space = np.isin(data, np.frombuffer(b" \t\r\n\v\f", dtype=np.uint8))
+    # a value starts at a non space byte following a space (or the start)
+    starts = ~space
+    starts[1:] &= space[:-1]
+    row = np.cumsum(data == ord("\n"))
+    counts = np.bincount(row[starts], minlength=row[-1] + 1)
+    return bool(np.isin(counts, lengths).all())
+
+
+'''
+Function:   parse_xyz_text
+Use:        parse .xyz text (whole rows) into an (n, 3) array
+Parameters...
+text: the rows of a .xyz file
+dtype: data type of the returned points
+'''
+def parse_xyz_text(text, dtype=np.float64):
+    # parse everything in one go when every row holds whole points (3 or 6
+    # values, or none), the values are then already in the order the points
+    # are listed
+    if (row_lengths_match(text, (0, 3, 6))):
+        values = np.fromstring(text, dtype=dtype, sep=" ")
+        if (values.shape[0] % 3 == 0):
+            return values.reshape(-1, 3)
+
+    # otherwise only the first one or two points of each row are used
+    p = []
+    for l in text.splitlines():
+        row = l.split()
+        if (len(row) < 3):
+            continue
+        p.append(row[0:3])
+        if (len(row) == 6):
+            p.append(row[3:6])
+    return np.array(p, dtype=dtype).reshape(-1, 3)
+
+
+'''
+Function:   parse_xyz
+Use:        parse the text of a .xyz file into an (n, 3) array
+Parameters...
+filename: the .xyz file
+dtype: data type of the returned points
+'''
+def parse_xyz(filename, dtype=np.float64):
+    with open(filename, 'r') as f:
+        return parse_xyz_text(f.read(), dtype)
+
+
+'''
+Function:   iter_xyz_blocks
+Use:        parse a .xyz file a block of rows at a time
+Parameters...
+filename: the .xyz file
+dtype: data type of the returned points
+chunk_bytes: approximate size of the text parsed at a time
+'''
+def iter_xyz_blocks(filename, dtype=np.float64, chunk_bytes=CHUNK_BYTES):
+    with open(filename, 'r') as f:
+        rest = ""
+        while (True):
+            text = f.read(chunk_bytes)
+            if (not text):
+                break
+            # only whole rows are parsed, the partial last row waits for the
+            # next block
+            text = rest + text
+            cut = text.rfind("\n") + 1
+            rest = text[cut:]
+            if (cut > 0):
+                yield parse_xyz_text(text[:cut], dtype)
+        if (rest.strip()):
+            yield parse_xyz_text(rest, dtype)
+
+
+'''
+Function:   write_npy_blocks
+Use:        write an (n, 3) .npy file from blocks of points, without holding
+            them all in memory
+Parameters...
+filename: the .npy file
+blocks: iterable of (m, 3) arrays
+dtype: data type of the stored points
+'''
+def write_npy_blocks(filename, blocks, dtype=np.float64):
+    # the header holds the number of points, so the data is collected in a raw
+    # file first and copied behind the header once the count is known
+    handle, raw = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                   prefix=os.path.basename(filename) + ".", suffix=".raw")
+    os.close(handle)
+    count = 0
+    try:
+        with open(raw, 'wb') as f:
+            for block in blocks:
+                np.ascontiguousarray(block, dtype=dtype).tofile(f)
+                count += block.shape[0]
+        with open(filename, 'wb') as f, open(raw, 'rb') as data:
+            np.lib.format.write_array_header_1_0(f, {
+                'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                'fortran_order': False,
+                'shape': (count, 3)})
+            shutil.copyfileobj(data, f)
+    finally:
+        if (os.path.exists(raw)):
+            os.remove(raw)
+    return count
+
+
+'''
+Function:   load_sidecar
+Use:        memory-map a sidecar, None if it is missing or cannot be read
+'''
+def load_sidecar(sidecar):
+    try:
+        return np.load(sidecar, mmap_mode='r')
+    except (OSError, ValueError, EOFError):
+        return None
+
+
+'''
+Function:   store_sidecar
+Use:        write the sidecar of a .xyz file through a temporary file of its
+            own, and remove the sidecars of older versions of the file
+Parameters...
+filename: the .xyz file
+dtype: data type of the sidecar
+write: function writing the .npy file at the path it is given
+'''
+def store_sidecar(filename, dtype, write):
+    sidecar = sidecar_filename(filename, dtype)
+    handle, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(sidecar)),
+                                    prefix=os.path.basename(sidecar) + ".", suffix=".tmp")
+    os.close(handle)
+    try:
+        write(temp)
+        os.chmod(temp, 0o644)
+        os.replace(temp, sidecar)
+    finally:
+        if (os.path.exists(temp)):
+            os.remove(temp)
+
+    # temporary files of other processes do not match, nor does the sidecar of
+    # the current version, which another process may have just put in place
+    for old in glob.glob(glob.escape(filename) + "." + np.dtype(dtype).name + ".*.npy"):
+        if (old != sidecar):
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+    return sidecar
+
+
+'''
+Function:   load_xyz_points
+Use:        load the points of a .xyz file, from its binary sidecar if possible
+Parameters...
+filename: the .xyz file
+dtype: data type of the returned points (float64 or float32)
+cache: read and write the .npy sidecar; the returned array is then a read-only
+       memory map
+'''
+def load_xyz_points(filename, dtype=np.float64, cache=True):
+    if (not cache):
+        return parse_xyz(filename, dtype)
+
+    points = load_sidecar(sidecar_filename(filename, dtype))
+    if (points is not None):
+        return points
+
+    try:
+        sidecar = store_sidecar(filename, dtype, lambda temp: write_npy_blocks(
+            temp, iter_xyz_blocks(filename, dtype), dtype))
+    except OSError:
+        # the cache is optional, e.g. in a read-only data directory
+        return parse_xyz(filename, dtype)
+
+    points = load_sidecar(sidecar)
+    return parse_xyz(filename, dtype) if points is None else points
+
+
+'''
+Function:   value_format
+Use:        text format writing every digit of a data type, so that parsing
+            the text gives back the same values
+'''
+def value_format(dtype):
+    if (np.issubdtype(dtype, np.integer)):
+        return "%d"
+    if (np.dtype(dtype) == np.float32):
+        return "%.9g"
+    return "%.17g"
+
+
+'''
+Function:   write_rows
+Use:        write a 2D array to an open text file, one row per line, in blocks
+Parameters...
+f: file opened for writing text
+rows: 2D array to write
+fmt: format of a single value, by default every digit of the data type
+chunk_rows: how many rows to format at a time
+'''
+def write_rows(f, rows, fmt=None, chunk_rows=CHUNK_ROWS):
+    if (rows.shape[0] == 0):
+        return
+    if (fmt is None):
+        fmt = value_format(rows.dtype)
+    row_format = " ".join([fmt] * rows.shape[1]) + "\n"
+    for start in range(0, rows.shape[0], chunk_rows):
+        block = rows[start:start + chunk_rows]
+        f.write((row_format * block.shape[0]) % tuple(block.ravel().tolist()))
+
+
+'''
+Function:   write_xyz
+Use:        write points to a .xyz file, one "x y z" point per line
+Parameters...
+filename: the .xyz file
+points: (n, 3) array of the points
+fmt: format of a single coordinate, by default every digit of the data type
+'''
+def write_xyz(filename, points, fmt=None):
+    with open(filename, 'w') as f:
+        write_rows(f, np.asarray(points), fmt)
+
+
+'''
+Function:   write_cloud
+Use:        write points to a .xyz file together with its binary sidecar, so
+            that the file is never parsed when it is loaded
+Parameters...
+filename: the .xyz file
+points: (n, 3) array of the points
+dtype: data type of the sidecar
+
+The coordinates are written with every digit, so the sidecar holds exactly the
+points parsing the text would give.
+'''
+def write_cloud(filename, points, dtype=np.float64):
+    write_xyz(filename, points, "%.17g")
+
+    def write(temp):
+        with open(temp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(points, dtype=dtype))
+    store_sidecar(filename, dtype, write)
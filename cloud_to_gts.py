@@ -1,6 +1,18 @@
 import numpy as np
-from scipy.spatial import Delaunay
 import math
+import itertools
+import instrumentation
+from cloud_io import CHUNK_ROWS
+from cloud_io import load_xyz_points
+from cloud_io import precision_dtype
+from cloud_io import write_rows
+from cloud_io import write_xyz
+from mesh_topology import MeshTopology
+from mesh_topology import as_topology
+from subsampling import subsample_points
+from surface_mesher import local_surface_mesh
+from triangulation_cache import CACHE_DIR
+from triangulation_cache import cached_delaunay
 
 '''
 This python utility contains functions that allow a .xyz file to be converted into a .gts file.
@@ -14,13 +26,94 @@ For Reference (this was surprisingly hard to find in the documentation):
     Next np lines:  coordinates of each point
     Next ne lines:  indices of each edge's pair of points
     Next nf lines:  indices of each face's edges
+
+The same mesh is passed to the compiled smoother in a binary format (see
+MeshHeader in smoother.c), so it is never formatted and parsed as text. All
+little-endian:
+    Header:         32 bytes, MESH_HEADER (magic "NMSH", version, bytes per
+                    coordinate (4 or 8), np, ne, nf and two reserved words)
+    Vertex block:   np * 3 float or double coordinates
+    Edge block:     ne * 2 int32 point indices
+    Face block:     nf * 3 int32 edge indices
+Indices start at 0. write_mesh writes the file as one buffer, and read_mesh
+memory-maps the blocks. GTS text remains an export format (gts_write).
 '''
 
+# header of the binary mesh format
+MESH_HEADER = np.dtype([("magic", "S4"), ("version", "<u4"), ("coordinate_size", "<u4"),
+                        ("num_points", "<u4"), ("num_edges", "<u4"), ("num_faces", "<u4"),
+                        ("reserved", "<u4", (2,))])
+MESH_MAGIC = b"NMSH"
+MESH_VERSION = 1
+
+# file extension of each mesh format
+MESH_EXTENSIONS = {"binary": ".bmesh", "gts": ".gts"}
+
+'''
+Function:   load_triangulation()
+Use:        return the triangulation of a .xyz file, without any prompts
+Parameters...
+filename: the .xyz file
+subsample_rate: subsampling rate, 0 for none
+mesher: "delaunay" for the scipy Delaunay triangulation, "local" for the
+        MeshTopology of a surface mesh from surface_mesher.py
+subsampling: "stride" to keep every subsample_rate-th point, "voxel" or
+             "poisson" to reduce the cloud by the same factor spatially, see
+             subsampling.subsample_points
+cache: reuse the Delaunay triangulations of earlier runs on the same points,
+       see triangulation_cache.py
+precision: "double" (default) or "single" for float32 points
+'''
+def load_triangulation(filename, subsample_rate=5, mesher="delaunay", subsampling="stride",
+                       cache=True, precision="double"):
+    dtype = precision_dtype(precision)
+
+    # Read points from the file into numpy array (both 'columns' if there are two)
+    with instrumentation.stage("load"):
+        points = load_xyz_points(filename, dtype)
+
+    # Perform subsampling (really noticeable impact with large datasets)
+    with instrumentation.stage("subsample"):
+        points = subsample_points(points, subsampling, subsample_rate).astype(dtype, copy=False)
+
+    print("Points Loaded")
+
+    tri = triangulate(points, mesher, cache)
+
+    return tri, points;
+
+
+'''
+Function:   triangulate()
+Use:        return the triangulation of an array of points
+Parameters...
+points: (n, 3) array of the points
+mesher, cache: see load_triangulation
+'''
+def triangulate(points, mesher="delaunay", cache=True):
+    with instrumentation.stage("triangulation"):
+        if (mesher == "local"):
+            # triangle mesh of the surface only, returned as its topology
+            tri = MeshTopology(local_surface_mesh(points), points.shape[0])
+        elif (mesher == "delaunay"):
+            tri = cached_delaunay(points[:-1], points.shape[0],
+                                  cache_dir=CACHE_DIR if cache else None)
+        else:
+            raise ValueError("Unknown mesher: " + str(mesher))
+
+    print("Triangulation Complete")
+
+    return tri
+
+
 '''
 Function:   input_triangulation()
 Use:        return Delaunay triangulation of input .xyz file
+Parameters...
+testing: use the bunny defaults instead of prompting for parameters
+mesher, subsampling: see load_triangulation
 '''
-def input_triangulation(testing):
+def input_triangulation(testing, mesher="delaunay", subsampling="stride"):
 
     filename = "bunny.xyz"
     subsample_rate = 5
@@ -29,31 +122,64 @@ def input_triangulation(testing):
         filename = input("Input file name: ")
         subsample_rate = int(input("Subsampling rate (0 for none): "))
 
-    f = open(filename, 'r')
+    return load_triangulation(filename, subsample_rate, mesher, subsampling)
+
 
-    p = []
+'''
+Function:   read_gts_header()
+Use:        read the counts line of an open gts file
+Parameters...
+f: gts file opened for reading text
 
-    # Read points from the file into numpy array
+Returns (num_points, num_edges, num_faces), leaving f at the first point.
+'''
+def read_gts_header(f):
     for l in f:
         row = l.split()
-        p.append([row[0], row[1], row[2]])
-        # in case there are two 'columns' in the file
-        if (len(row) == 6):
-            p.append([row[3], row[4], row[5]])
+        # skip blank and comment lines
+        if (len(row) == 0 or row[0].startswith("#")):
+            continue
+        return int(row[0]), int(row[1]), int(row[2])
+    raise ValueError("Empty GTS file")
 
-    points = np.array(p)
 
-    # Perform subsampling (really noticeable impact with large datasets)
-    if (subsample_rate > 0):
-        points = points[::subsample_rate]
-
-    print("Points Loaded")
-
-    tri = Delaunay(points[:-1], qhull_options="Qbb Qc Qz Q12 QJ Qt")
+'''
+Function:   iter_gts_points()
+Use:        read the points of a gts file in blocks, stopping after the point
+            block so the edges and faces are never read
+Parameters...
+filename: the gts file
+dtype: data type of the returned points
+chunk_rows: how many points to parse at a time
+'''
+def iter_gts_points(filename, dtype=np.float64, chunk_rows=CHUNK_ROWS):
+    with open(filename, 'r') as f:
+        num_points = read_gts_header(f)[0]
+        remaining = num_points
+        while (remaining > 0):
+            lines = list(itertools.islice(f, min(chunk_rows, remaining)))
+            if (len(lines) == 0):
+                raise ValueError("GTS file ends inside the point block")
+            remaining -= len(lines)
+            block = np.fromstring("".join(lines), dtype=dtype, sep=" ")
+            # points with extra data on their line are parsed one at a time
+            if (block.shape[0] != 3 * len(lines)):
+                block = np.array([l.split()[0:3] for l in lines], dtype=dtype)
+            yield block.reshape(-1, 3)
 
-    print("Triangulation Complete")
 
-    return tri, points;
+'''
+Function:   read_gts_points()
+Use:        read the points of a gts file into an (n, 3) array
+Parameters...
+filename: the gts file
+dtype: data type of the returned points
+'''
+def read_gts_points(filename, dtype=np.float64):
+    blocks = list(iter_gts_points(filename, dtype))
+    if (len(blocks) == 0):
+        return np.zeros((0, 3), dtype=dtype)
+    return np.concatenate(blocks)
 
 
 '''
@@ -62,72 +188,176 @@ Use:        convert a gts file into an xyz file
 '''
 def gts_to_cloud(filename, out_filename):
 
-    f = open(filename, 'r')
+    with open(filename, 'r') as f:
+        with open(out_filename, 'w') as out_f:
+            num_points = read_gts_header(f)[0]
+            # the point lines are already in .xyz format, copy them in blocks
+            remaining = num_points
+            while (remaining > 0):
+                lines = list(itertools.islice(f, min(CHUNK_ROWS, remaining)))
+                if (len(lines) == 0):
+                    break
+                out_f.writelines(lines)
+                remaining -= len(lines)
 
-    num_points = 0
-    string_write = ""
-    rowcount = 0
 
-    for l in f:
-        row = l.split()
-        if (rowcount == 0):
-            num_points = int(row[0])
-        elif (rowcount < num_points+1):
-            string_write += l
-        rowcount += 1
+'''
+Function:   mesh_tables()
+Use:        edges and faces of a triangulation as stored in the mesh files,
+            the faces given by their three edges (indices start at 0)
+Parameters...
+tri: Delaunay triangulation of the points, or its MeshTopology
+num_points: number of points
+'''
+def mesh_tables(tri, num_points):
+    # faces share their edges through the mesh topology
+    topology = as_topology(tri, num_points)
+    return topology.face_edges()
+
 
-    out_f = open(out_filename, 'w')
-    out_f.write(string_write)
+'''
+Function:   mesh_faces()
+Use:        vertex indices of the faces of a triangulation, the first three
+            vertices of each simplex as in gts_write and the mesh files
+Parameters...
+tri: Delaunay triangulation of the points, or its MeshTopology
+num_points: number of points
+'''
+def mesh_faces(tri, num_points):
+    return as_topology(tri, num_points).simplices[:, :3]
+
+
+'''
+Function:   write_mesh()
+Use:        write the binary mesh file passed to the compiled smoother, as a
+            single buffer
+Parameters...
+tri: Delaunay triangulation of the points, or its MeshTopology
+points: array of the points
+filename: the binary mesh file to write
+dtype: coordinate type (float32 or float64), that of the points if not given
+'''
+def write_mesh(tri, points, filename, dtype=None):
+    if (dtype is None):
+        dtype = np.float32 if (points.dtype == np.float32) else np.float64
+    dtype = np.dtype(dtype).newbyteorder("<")
+    edges, faces = mesh_tables(tri, points.shape[0])
+
+    header = np.zeros(1, dtype=MESH_HEADER)
+    header["magic"] = MESH_MAGIC
+    header["version"] = MESH_VERSION
+    header["coordinate_size"] = dtype.itemsize
+    header["num_points"] = points.shape[0]
+    header["num_edges"] = edges.shape[0]
+    header["num_faces"] = faces.shape[0]
+
+    # lay the blocks out in one buffer and write it at once
+    sizes = [MESH_HEADER.itemsize, points.size * dtype.itemsize, edges.size * 4, faces.size * 4]
+    offsets = np.cumsum([0] + sizes)
+    buffer = np.empty(offsets[-1], dtype=np.uint8)
+    buffer[:offsets[1]] = header.view(np.uint8)
+    buffer[offsets[1]:offsets[2]].view(dtype)[:] = points.ravel()
+    buffer[offsets[2]:offsets[3]].view("<i4")[:] = edges.ravel()
+    buffer[offsets[3]:offsets[4]].view("<i4")[:] = faces.ravel()
+
+    with instrumentation.stage("mesh_write"):
+        buffer.tofile(filename)
+
+    return filename
+
+
+'''
+Function:   is_binary_mesh()
+Use:        whether a file is a binary mesh (and not GTS text)
+'''
+def is_binary_mesh(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MESH_MAGIC)) == MESH_MAGIC
+
+
+'''
+Function:   read_mesh()
+Use:        memory-map the blocks of a binary mesh file
+Parameters...
+filename: the binary mesh file
+
+Returns (points, edges, faces), read-only (the trailer the smoother appends
+after the blocks is ignored).
+'''
+def read_mesh(filename):
+    header = np.fromfile(filename, dtype=MESH_HEADER, count=1)
+    if (header.shape[0] != 1 or header["magic"][0] != MESH_MAGIC):
+        raise ValueError("Not a binary mesh file: " + filename)
+    if (header["version"][0] != MESH_VERSION):
+        raise ValueError("Unknown binary mesh version: " + str(header["version"][0]))
+    if (header["coordinate_size"][0] not in (4, 8)):
+        raise ValueError("Unknown coordinate size: " + str(header["coordinate_size"][0]))
+
+    blocks = [("<f%d" % header["coordinate_size"][0], (int(header["num_points"][0]), 3)),
+              ("<i4", (int(header["num_edges"][0]), 2)),
+              ("<i4", (int(header["num_faces"][0]), 3))]
+    arrays = []
+    offset = MESH_HEADER.itemsize
+    for dtype, shape in blocks:
+        if (shape[0] == 0):
+            arrays.append(np.zeros(shape, dtype=dtype))
+        else:
+            arrays.append(np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape))
+        offset += shape[0] * shape[1] * np.dtype(dtype).itemsize
+    return tuple(arrays)
+
+
+'''
+Function:   mesh_to_cloud()
+Use:        convert a mesh file, binary or GTS text, into an xyz file with the
+            points of its surface
+'''
+def mesh_to_cloud(filename, out_filename):
+    if (not is_binary_mesh(filename)):
+        gts_to_cloud(filename, out_filename)
+        return
+
+    # like the GTS text written by the smoother, only the points of the faces
+    points, edges, faces = read_mesh(filename)
+    write_xyz(out_filename, points[np.unique(edges[faces])])
 
-        
 
 '''
 Function:   gts_write()
 Use:        convert point cloud into gts file for non iterative
-            algorithm execution
+            algorithm execution (the smoother reads the binary mesh of
+            write_mesh faster, this is kept to export the mesh)
+Parameters...
+tri: Delaunay triangulation of the points, or its MeshTopology
+points: array of the points
+testing: use the default filename instead of prompting for it
+filename: the GTS file to write, no prompt is shown when it is given
 '''
-def gts_write(tri, points, testing):
+def gts_write(tri, points, testing, filename=None):
 
-    filename = "bunny_mesh.gts"
-    if (not testing):
-        filename = input("Initial GTS generation filename: ")
+    if (filename is None):
+        filename = "bunny_mesh.gts"
+        if (not testing):
+            filename = input("Initial GTS generation filename: ")
 
     print("Formatting mesh data...")
 
     num_points = points.shape[0]
-    
-    edges = []
-    for s in tri.simplices:
-        p1 = s[0] + 1
-        p2 = s[1] + 1
-        p3 = s[2] + 1
-        edges.append([p1, p2])
-        edges.append([p2, p3])
-        edges.append([p3, p1])
+    edge_table, face_table = mesh_tables(tri, num_points)
 
+    # GTS indices start at 1
+    edges = edge_table + 1
     num_edges = len(edges)
 
-    faces = []
-    count = 1
-    for s in tri.simplices:
-        faces.append([count, count+1, count+2])
-        count += 3
-
+    faces = face_table + 1
     num_faces = len(faces)
 
-    f = open(filename, 'w')
-
     print("Writing to GTS file...")
 
-    string_write = ""
-    string_write += str(num_points) + " " + str(num_edges) + " " + str(num_faces) + "\n"
-    for p in points:
-        string_write += str(p[0]) + " " + str(p[1]) + " " + str(p[2]) + "\n"
-    for e in edges:
-        string_write += str(e[0]) + " " + str(e[1]) + "\n"
-    for x in faces:
-        string_write += str(x[0]) + " " + str(x[1]) + " " + str(x[2]) + "\n"
-    f.write(string_write)
+    with instrumentation.stage("gts_write"), open(filename, 'w') as f:
+        f.write(str(num_points) + " " + str(num_edges) + " " + str(num_faces) + "\n")
+        write_rows(f, points)
+        write_rows(f, edges, "%d")
+        write_rows(f, faces, "%d")
 
     return filename
-
@@ -0,0 +1,662 @@
+'''
+    Denoising Service
+
+    Every run of denoise.py or run_icp.py starts Python, imports scipy, parses
+    the .xyz file and triangulates it before any denoising is done. The
+    service is a long running process that keeps all of that in memory
+    between requests:
+
+        python3 denoise_service.py serve --port 8765 --memory 2048 --workers 4
+        python3 denoise_service.py serve --socket /tmp/denoise.sock
+
+    It listens on localhost (or a Unix socket) for HTTP requests with JSON
+    bodies, which the same script can send:
+
+        python3 denoise_service.py denoise bunny_noisy.xyz out.xyz --method bilateral \
+            --params '{"iterations": 3, "n_degree": 2}'
+        python3 denoise_service.py evaluate bunny.xyz out.xyz
+        python3 denoise_service.py stats
+
+    The requests are
+        POST /denoise:  {"input", "output", "method", "params"}, as the jobs of
+                        batch_denoise.py ("bilateral" with the keyword
+                        arguments of denoise_file, "non_iterative" with those
+                        of smooth_file); without an "output" the denoised
+                        points are returned in the response
+        POST /evaluate: {"reference", "inputs", "threshold", "icp"}, scored as
+                        by evaluation.py
+        GET /stats:     the cache contents and the counters of the service
+
+    The loaded points, the subsampled points, the triangulations (with their
+    topology), the smoothing meshes of the non-iterative method (surface
+    vertices, centroid tree and mollified normals) and the reference clouds
+    of the evaluation (KD-tree and normals) are kept in an LRU cache with a
+    memory budget (ScanCache), keyed on the file (path, size and modification
+    time) and the parameters that made them. A request only computes what
+    the cache misses, and concurrent requests for the same entry wait for one
+    of them to compute it. The requests run on a pool of worker threads (the
+    NumPy, scipy and qhull calls release the interpreter lock for most of
+    their work), so the cache is shared by all of them.
+
+    The pipelines and scipy are imported with the first request that needs
+    them, so the service starts at once. Requests the cache does not apply to
+    (the "tiled" engine, "multires" subsampling, the compiled smoother
+    program) are run by denoise_file or smooth_file as they are.
+    Relative paths are relative to the working directory of the service.
+'''
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import numpy as np
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+# default memory budget of the cache
+SERVICE_BYTES = 1 << 30
+
+# default address of the service
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+
+'''
+Function:   object_size
+Use:        bytes of the arrays held by an object (the arrays of its
+            attributes, lists, tuples and dictionaries, each counted once)
+'''
+def object_size(value, seen=None):
+    if (seen is None):
+        seen = set()
+    if (id(value) in seen):
+        return 0
+    seen.add(id(value))
+
+    if (isinstance(value, np.ndarray)):
+        return value.nbytes
+    if (isinstance(value, (list, tuple))):
+        return sum(object_size(v, seen) for v in value)
+    if (isinstance(value, dict)):
+        return sum(object_size(v, seen) for v in value.values())
+    if (hasattr(value, "__dict__")):
+        return object_size(vars(value), seen)
+    if (hasattr(value, "data") and hasattr(value, "indices")):
+        # a cKDTree: its points, their order and the nodes
+        return object_size((value.data, value.indices), seen) + value.size * 64
+    return 0
+
+
+class ScanCache:
+    '''
+    Class:  ScanCache
+    Use:    least recently used cache of the intermediates of the requests,
+            trimmed to a memory budget, safe to share between threads
+    Parameters...
+    max_bytes: size the cache is trimmed to after every new entry
+    '''
+    def __init__(self, max_bytes=SERVICE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._building = set()
+        self._condition = threading.Condition()
+
+    '''
+    Function:   get
+    Use:        the value of a key, built and added to the cache on a miss
+    Parameters...
+    key: hashable key of the value
+    build: function computing the value
+
+    While one thread builds a value, the other threads asking for the same key
+    wait for it. A value larger than the whole budget is returned uncached.
+    '''
+    def get(self, key, build):
+        with self._condition:
+            while (key in self._building):
+                self._condition.wait()
+            if (key in self.entries):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            self._building.add(key)
+
+        try:
+            value = build()
+            size = object_size(value)
+        finally:
+            with self._condition:
+                self._building.discard(key)
+                self._condition.notify_all()
+
+        with self._condition:
+            if (size <= self.max_bytes and key not in self.entries):
+                self.entries[key] = (value, size)
+                self.total += size
+                self.trim()
+        return value
+
+    '''
+    Function:   trim
+    Use:        remove the least recently used entries until the cache fits its
+                budget (called with the lock held)
+    '''
+    def trim(self):
+        while (self.total > self.max_bytes and self.entries):
+            key, (value, size) = self.entries.popitem(last=False)
+            self.total -= size
+            self.evictions += 1
+
+    '''
+    Function:   clear
+    Use:        remove every entry
+    '''
+    def clear(self):
+        with self._condition:
+            self.entries.clear()
+            self.total = 0
+
+    '''
+    Function:   stats
+    Use:        the entries (least recently used first) and counters, as a
+                dictionary
+    '''
+    def stats(self):
+        with self._condition:
+            return {"bytes": self.total, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": [{"key": [str(k) for k in key], "bytes": size}
+                                for key, (value, size) in self.entries.items()]}
+
+
+'''
+Function:   file_key
+Use:        key of the current contents of a file, so a changed file is loaded
+            again
+'''
+def file_key(filename):
+    path = os.path.abspath(filename)
+    status = os.stat(path)
+    return (path, status.st_size, status.st_mtime_ns)
+
+
+class DenoiseService:
+    '''
+    Class:  DenoiseService
+    Use:    runs denoise and evaluate requests on a pool of worker threads,
+            sharing a ScanCache
+    Parameters...
+    max_bytes: memory budget of the cache
+    workers: how many requests run at the same time
+    '''
+    def __init__(self, max_bytes=SERVICE_BYTES, workers=None):
+        self.cache = ScanCache(max_bytes)
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        self.started = time.time()
+        self.requests = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    '''
+    Function:   submit
+    Use:        run a request on the worker pool and wait for its result
+    Parameters...
+    name: "denoise" or "evaluate"
+    request: dictionary of the request
+    '''
+    def submit(self, name, request):
+        if (name not in ("denoise", "evaluate")):
+            raise ValueError("Unknown request: " + str(name))
+        with self._lock:
+            self.requests += 1
+        try:
+            return self.pool.submit(getattr(self, name), request).result()
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            raise
+
+    '''
+    Function:   points
+    Use:        the points of a .xyz file, loaded once
+    '''
+    def points(self, filename, precision="double"):
+        from cloud_io import load_xyz_points
+        from cloud_io import precision_dtype
+        dtype = precision_dtype(precision)
+        return self.cache.get(("points", file_key(filename), precision),
+                              lambda: load_xyz_points(filename, dtype))
+
+    '''
+    Function:   subsampled
+    Use:        the subsampled points of a .xyz file, subsampled once
+    '''
+    def subsampled(self, filename, rate, subsampling="stride", precision="double"):
+        from subsampling import subsample_points
+        from cloud_io import precision_dtype
+        def build():
+            points = self.points(filename, precision)
+            # a copy, so a stride does not keep the whole cloud alive
+            return np.ascontiguousarray(subsample_points(points, subsampling, rate),
+                                        dtype=precision_dtype(precision))
+        return self.cache.get(("subsampled", file_key(filename), rate, subsampling, precision),
+                              build)
+
+    '''
+    Function:   triangulation
+    Use:        the triangulation of the subsampled points of a .xyz file, with
+                its topology attached, triangulated once
+    Parameters...
+    filename, rate, subsampling, precision: see subsampled
+    mesher: "delaunay" or "local", see cloud_to_gts.triangulate
+    cache: also use the triangulation cache on disk (triangulation_cache.py)
+    '''
+    def triangulation(self, filename, rate, subsampling="stride", precision="double",
+                      mesher="delaunay", cache=True):
+        from cloud_to_gts import triangulate
+        from mesh_topology import as_topology
+        def build():
+            points = self.subsampled(filename, rate, subsampling, precision)
+            tri = triangulate(points, mesher, cache)
+            if (mesher == "delaunay"):
+                # what the neighborhoods use, computed once for all requests
+                tri.topology = as_topology(tri, points.shape[0])
+                tri.transform
+            return tri
+        return self.cache.get(("triangulation", file_key(filename), rate, subsampling,
+                               precision, mesher), build)
+
+    '''
+    Function:   denoise
+    Use:        run a denoise request
+    Parameters...
+    request: {"input", "output" (optional), "method" ("bilateral" by default),
+              "params"}, see the module description
+
+    Returns {"points": number of output points, "seconds", and "output" or
+    "cloud" (the output points as a list, when there is no output file)}.
+    '''
+    def denoise(self, request):
+        start = time.time()
+        method = request.get("method", "bilateral")
+        params = dict(request.get("params", {}))
+        output = request.get("output")
+        if (method == "bilateral"):
+            points = self.bilateral(request["input"], output, params)
+        elif (method == "non_iterative"):
+            points = self.non_iterative(request["input"], output, params)
+        else:
+            raise ValueError("Unknown method: " + str(method))
+
+        result = {"points": None, "seconds": 0.0}
+        if (points is not None and output):
+            from cloud_io import write_xyz
+            write_xyz(output, points)
+        if (points is not None):
+            result["points"] = int(points.shape[0])
+        if (output):
+            result["output"] = output
+        elif (points is not None):
+            result["cloud"] = np.asarray(points, dtype=float).tolist()
+        result["seconds"] = time.time() - start
+        return result
+
+    '''
+    Function:   bilateral
+    Use:        the denoised points of a bilateral request, None once
+                denoise_file has written them
+    Parameters...
+    filename: the input .xyz file
+    output: the output .xyz file, if any
+    params: keyword arguments of BilateralMeshDenoising.denoise_file
+    '''
+    def bilateral(self, filename, output, params):
+        from BilateralMeshDenoising import bilateral_denoise
+        from BilateralMeshDenoising import denoise_file
+        rate = params.pop("sub_sampling", 5)
+        iterations = params.pop("iterations", 2)
+        n_degree = params.pop("n_degree", 4)
+        engine = params.pop("engine", "batch")
+        neighborhood = params.pop("neighborhood", "simplex")
+        mesher = params.pop("mesher", "delaunay")
+        subsampling = params.pop("subsampling", "stride")
+        cache = params.pop("cache", True)
+        precision = params.pop("precision", "double")
+        refine_levels = params.pop("refine_levels", 0)
+
+        if (engine == "tiled" or subsampling == "multires"):
+            if (not output):
+                raise ValueError("Tiled and multires requests need an output file")
+            denoise_file(filename, output, rate, iterations, n_degree, engine, neighborhood,
+                         mesher, subsampling, cache, precision=precision,
+                         refine_levels=refine_levels, **params)
+            return None
+
+        points = self.subsampled(filename, rate, subsampling, precision)
+        tri = None
+        if (mesher == "local"):
+            neighborhood = "topology"
+        if (mesher == "local" or neighborhood != "kdtree"):
+            tri = self.triangulation(filename, rate, subsampling, precision, mesher, cache)
+        # the iterations move the points they are given
+        return bilateral_denoise(points.copy(), tri, iterations, n_degree, engine,
+                                 neighborhood, **params)
+
+    '''
+    Function:   non_iterative
+    Use:        the smoothed surface vertices of a non-iterative request, None
+                once smooth_file has written them
+    Parameters...
+    filename: the input .xyz file
+    output: the output .xyz file, if any
+    params: keyword arguments of run_non_iterative.smooth_file
+    '''
+    def non_iterative(self, filename, output, params):
+        from run_non_iterative import smooth_file
+        engine = params.get("engine", "numpy")
+        subsampling = params.get("subsampling", "stride")
+        if (engine not in ("numpy", "library") or subsampling == "multires"):
+            if (not output):
+                raise ValueError("Binary engine and multires requests need an output file")
+            smooth_file(filename, output, **params)
+            return None
+
+        from cloud_to_gts import mesh_faces
+        from non_iterative_smoothing import SmoothingMesh
+        from smoother_library import library_smooth
+        rate = params.get("subsample_rate", 5)
+        mesher = params.get("mesher", "delaunay")
+        precision = params.get("precision", "double")
+        key = (file_key(filename), rate, subsampling, precision, mesher)
+        tri = self.triangulation(filename, rate, subsampling, precision, mesher,
+                                 params.get("cache", True))
+        points = self.subsampled(filename, rate, subsampling, precision)
+        mesh = self.cache.get(("smoothing_mesh",) + key, lambda: SmoothingMesh(
+            points, mesh_faces(tri, points.shape[0])))
+
+        sigma_f = float(params.get("arg1", "1"))
+        sigma_g = float(params.get("arg2", "1"))
+        dist_mode = int(params.get("dist_mode", "1"))
+        if (engine == "numpy"):
+            # an entry of their own, so that every sigma_f counts in the budget
+            normals = self.cache.get(("mollified_normals",) + key + (sigma_f, dist_mode),
+                                     lambda: mesh.mollify(sigma_f, dist_mode))
+            new_points = mesh.smooth(sigma_f, sigma_g, dist_mode, normals)
+        else:
+            new_points = library_smooth(points, mesh.faces, sigma_f, sigma_g, dist_mode)
+        # like the smoother output, only the vertices of the surface are kept
+        return new_points[mesh.vertices]
+
+    '''
+    Function:   reference
+    Use:        the ReferenceCloud of a .xyz file, with its normals, built once
+    '''
+    def reference(self, filename):
+        from evaluation import ReferenceCloud
+        def build():
+            reference = ReferenceCloud(self.points(filename))
+            reference.normals()
+            return reference
+        return self.cache.get(("reference", file_key(filename)), build)
+
+    '''
+    Function:   evaluate
+    Use:        run an evaluate request
+    Parameters...
+    request: {"reference", "inputs" (list of .xyz files), "threshold"
+              (optional), "icp" (optional)}
+
+    Returns {"results": the scores of every input, with its name as "file",
+    "seconds"}.
+    '''
+    def evaluate(self, request):
+        from cloud_io import load_xyz_points
+        from evaluation import THRESHOLD
+        start = time.time()
+        reference = self.reference(request["reference"])
+        results = []
+        for filename in request["inputs"]:
+            scores = reference.evaluate(load_xyz_points(filename),
+                                        request.get("threshold", THRESHOLD),
+                                        icp=request.get("icp", False))
+            scores["file"] = filename
+            results.append(scores)
+        return {"results": results, "seconds": time.time() - start}
+
+    '''
+    Function:   stats
+    Use:        the cache contents and the request counters
+    '''
+    def stats(self):
+        with self._lock:
+            counts = {"requests": self.requests, "failures": self.failures}
+        counts.update(uptime=time.time() - self.started, cache=self.cache.stats())
+        return counts
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    '''
+    Class:  ServiceHandler
+    Use:    HTTP handler of the service, the DenoiseService is the "service" of
+            the server
+    '''
+    '''
+    Function:   do_GET
+    Use:        GET /stats
+    '''
+    def do_GET(self):
+        if (self.path.rstrip("/") != "/stats"):
+            self.respond(404, {"error": "Unknown request: " + self.path})
+            return
+        self.respond(200, self.server.service.stats())
+
+    '''
+    Function:   do_POST
+    Use:        POST /denoise or /evaluate with a JSON body
+    '''
+    def do_POST(self):
+        name = self.path.strip("/")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            result = self.server.service.submit(name, request)
+        except (ValueError, KeyError, TypeError, OSError) as error:
+            self.respond(400, {"error": traceback.format_exception_only(type(error), error)[-1].strip()})
+            return
+        except Exception as error:
+            traceback.print_exc()
+            self.respond(500, {"error": traceback.format_exception_only(type(error), error)[-1].strip()})
+            return
+        self.respond(200, result)
+
+    '''
+    Function:   respond
+    Use:        send a JSON response
+    '''
+    def respond(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    '''
+    Function:   address_string
+    Use:        the client in the log, Unix socket clients have no address
+    '''
+    def address_string(self):
+        if (isinstance(self.client_address, tuple) and self.client_address):
+            return str(self.client_address[0])
+        return "unix"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Class:  UnixHTTPServer
+    Use:    the HTTP server on a Unix socket, a thread per connection
+    '''
+    daemon_threads = True
+
+
+class UnixHTTPConnection(HTTPConnection):
+    '''
+    Class:  UnixHTTPConnection
+    Use:    HTTP client connection over a Unix socket
+    Parameters...
+    path: the socket file
+    '''
+    def __init__(self, path, timeout=None):
+        HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = path
+
+    '''
+    Function:   connect
+    Use:        connect to the socket file
+    '''
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+'''
+Function:   serve
+Use:        run the service until it is interrupted
+Parameters...
+port: localhost port to listen on
+socket_path: Unix socket to listen on instead of the port
+max_bytes: memory budget of the cache
+workers: how many requests run at the same time, all cores if not given
+'''
+def serve(port=SERVICE_PORT, socket_path=None, max_bytes=SERVICE_BYTES, workers=None):
+    if (socket_path is not None):
+        if (os.path.exists(socket_path)):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, ServiceHandler)
+        address = socket_path
+    else:
+        server = ThreadingHTTPServer((SERVICE_HOST, port), ServiceHandler)
+        address = "http://%s:%d" % (SERVICE_HOST, port)
+    server.service = DenoiseService(max_bytes, workers)
+
+    print("Serving on " + address)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.pool.shutdown()
+        if (socket_path is not None and os.path.exists(socket_path)):
+            os.remove(socket_path)
+
+
+'''
+Function:   service_request
+Use:        send a request to a running service
+Parameters...
+name: "denoise", "evaluate" or "stats"
+request: dictionary of the request (not for "stats")
+port: localhost port of the service
+socket_path: Unix socket of the service instead of the port
+timeout: seconds to wait for the response, no limit if not given
+
+Returns the JSON response as a dictionary.
+'''
+def service_request(name, request=None, port=SERVICE_PORT, socket_path=None, timeout=None):
+    if (socket_path is not None):
+        connection = UnixHTTPConnection(socket_path, timeout)
+    else:
+        connection = HTTPConnection(SERVICE_HOST, port, timeout=timeout)
+    try:
+        if (request is None):
+            connection.request("GET", "/" + name)
+        else:
+            connection.request("POST", "/" + name, json.dumps(request),
+                               {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        body = json.loads(response.read() or b"{}")
+    finally:
+        connection.close()
+    if (response.status != 200):
+        raise ValueError("Service error: " + str(body.get("error")))
+    return body
+
+
+'''
+Function:   main()
+Use:        run the service or send it a request from the command line
+Parameters...
+argv: the command line arguments, those of the process if not given
+'''
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep clouds and triangulations in memory "
+                                                 "between denoising requests")
+    parser.add_argument("--port", type=int, default=SERVICE_PORT,
+                        help="localhost port (default: %d)" % SERVICE_PORT)
+    parser.add_argument("--socket", default=None, help="Unix socket instead of the port")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="run the service")
+    serve_parser.add_argument("--memory", type=float, default=SERVICE_BYTES / 2.0 ** 20,
+                              help="memory budget of the cache in MB (default: %d)"
+                                   % (SERVICE_BYTES >> 20))
+    serve_parser.add_argument("--workers", type=int, default=None,
+                              help="requests run at the same time (default: all cores)")
+
+    denoise_parser = commands.add_parser("denoise", help="denoise a file")
+    denoise_parser.add_argument("input", help="the input .xyz file")
+    denoise_parser.add_argument("output", help="the output .xyz file")
+    denoise_parser.add_argument("--method", default="bilateral",
+                                choices=("bilateral", "non_iterative"))
+    denoise_parser.add_argument("--params", default="{}",
+                                help="keyword arguments of the method as JSON")
+
+    evaluate_parser = commands.add_parser("evaluate", help="score files against a reference")
+    evaluate_parser.add_argument("reference", help="ground truth .xyz file")
+    evaluate_parser.add_argument("files", nargs="+", help=".xyz files to score")
+    evaluate_parser.add_argument("--threshold", type=float, default=None,
+                                 help="largest distance of an inlier")
+    evaluate_parser.add_argument("--icp", action="store_true",
+                                 help="align every file to the reference with ICP first")
+
+    commands.add_parser("stats", help="print the cache contents")
+    args = parser.parse_args(argv)
+
+    if (args.command == "serve"):
+        serve(args.port, args.socket, int(args.memory * 2 ** 20), args.workers)
+        return 0
+
+    # the service resolves relative paths from its own working directory
+    if (args.command == "denoise"):
+        request = {"input": os.path.abspath(args.input), "output": os.path.abspath(args.output),
+                   "method": args.method, "params": json.loads(args.params)}
+        result = service_request("denoise", request, args.port, args.socket)
+    elif (args.command == "evaluate"):
+        request = {"reference": os.path.abspath(args.reference),
+                   "inputs": [os.path.abspath(f) for f in args.files], "icp": args.icp}
+        if (args.threshold is not None):
+            request["threshold"] = args.threshold
+        result = service_request("evaluate", request, args.port, args.socket)
+    else:
+        result = service_request("stats", None, args.port, args.socket)
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+'''
+    Point Cloud Evaluation
+
+    Scores denoised clouds against a ground truth cloud with a KD-tree
+    (scipy cKDTree), without open3d:
+
+        python3 evaluation.py bunny.xyz bunny_bms_denoised.xyz bunny_nims_smoothed.xyz
+
+    The metrics of every scored cloud (the "source") are:
+
+        fitness:                share of the source points with a reference
+                                point within the threshold (inliers)
+        inlier_rmse:            RMSE of the distances of the inliers
+        point_to_plane_rmse:    RMSE of the inlier distances along the normal
+                                of their nearest reference point
+        chamfer:                mean distance from the source to the reference
+                                plus mean distance from the reference to the
+                                source
+        hausdorff:              largest distance either way
+
+    Fitness and inlier RMSE are those of open3d's evaluate_registration (used
+    by ICPEval.py): 1 and 0 for identical clouds. With --icp the source is first
+    aligned to the reference by point-to-point ICP, and the transformation is
+    reported as well.
+
+    The reference KD-tree is built once, and the reference normals (fitted to
+    the nearest neighbors of every point) once they are first needed, so any
+    number of clouds can be scored against one reference at the cost of a
+    query each.
+'''
+from scipy.spatial import cKDTree
+import numpy as np
+import argparse
+import json
+import sys
+from cloud_io import load_xyz_points
+
+# default inlier distance, as in ICPEval.init_para
+THRESHOLD = 0.02
+
+# nearest neighbors each reference normal is fitted to
+NORMAL_NEIGHBORS = 30
+
+# points whose normals are fitted at a time
+CHUNK_POINTS = 1 << 16
+
+
+class ReferenceCloud:
+    '''
+    Class:  ReferenceCloud
+    Use:    a ground truth cloud with its KD-tree, and its normals once needed,
+            to score any number of clouds against it
+    Parameters...
+    points: (n, 3) array of the reference points
+    normal_neighbors: how many nearest neighbors each normal is fitted to
+    '''
+    def __init__(self, points, normal_neighbors=NORMAL_NEIGHBORS):
+        self.points = np.ascontiguousarray(points, dtype=float)
+        self.tree = cKDTree(self.points)
+        self.normal_neighbors = normal_neighbors
+        self._normals = None
+
+    '''
+    Function:   normals
+    Use:        unit normal of every reference point, the direction of least
+                variance of its nearest neighbors
+    '''
+    def normals(self):
+        if (self._normals is None):
+            n = self.points.shape[0]
+            k = min(self.normal_neighbors, n)
+            normals = np.empty((n, 3))
+            for start in range(0, n, CHUNK_POINTS):
+                block = self.points[start:start + CHUNK_POINTS]
+                nearest = self.tree.query(block, k=k, workers=-1)[1].reshape(-1, k)
+                neighbors = self.points[nearest]
+                local = neighbors - neighbors.mean(axis=1)[:, None, :]
+                covariance = np.einsum('ijk,ijl->ikl', local, local)
+                normals[start:start + block.shape[0]] = np.linalg.eigh(covariance)[1][:, :, 0]
+            self._normals = normals
+        return self._normals
+
+    '''
+    Function:   nearest
+    Use:        distance to and index of the nearest reference point of every point
+    '''
+    def nearest(self, points):
+        return self.tree.query(points, k=1, workers=-1)
+
+    '''
+    Function:   evaluate
+    Use:        score a cloud against the reference
+    Parameters...
+    points: (m, 3) array of the source points
+    threshold: largest distance of an inlier correspondence
+    transformation: 4x4 matrix applied to the source first, none if not given
+    icp: align the source to the reference with icp_align first
+
+    Returns a dictionary of the metrics (see the module description).
+    '''
+    def evaluate(self, points, threshold=THRESHOLD, transformation=None, icp=False):
+        points = np.asarray(points, dtype=float)
+        if (icp):
+            transformation = icp_align(self, points, threshold, transformation)
+        if (transformation is not None):
+            points = transform_points(points, transformation)
+
+        distance, index = self.nearest(points)
+        back = cKDTree(points).query(self.points, k=1, workers=-1)[0]
+
+        inliers = distance < threshold
+        count = int(np.count_nonzero(inliers))
+        fitness = count / float(max(points.shape[0], 1))
+        inlier_rmse = 0.0
+        plane_rmse = 0.0
+        if (count > 0):
+            inlier_rmse = float(np.sqrt(np.mean(distance[inliers] ** 2)))
+            gap = points[inliers] - self.points[index[inliers]]
+            residual = np.einsum('ij,ij->i', gap, self.normals()[index[inliers]])
+            plane_rmse = float(np.sqrt(np.mean(residual * residual)))
+
+        scores = {"points": int(points.shape[0]),
+                  "reference_points": int(self.points.shape[0]),
+                  "threshold": threshold,
+                  "fitness": fitness,
+                  "inlier_rmse": inlier_rmse,
+                  "point_to_plane_rmse": plane_rmse,
+                  "chamfer": float(distance.mean() + back.mean()),
+                  "hausdorff": float(max(distance.max(), back.max()))}
+        if (transformation is not None):
+            scores["transformation"] = np.asarray(transformation).tolist()
+        return scores
+
+
+'''
+Function:   transform_points
+Use:        apply a 4x4 rigid transformation to an array of points
+'''
+def transform_points(points, transformation):
+    transformation = np.asarray(transformation, dtype=float)
+    return points @ transformation[:3, :3].T + transformation[:3, 3]
+
+
+'''
+Function:   icp_align
+Use:        point-to-point ICP of a cloud to the reference, stopping like
+            open3d's ICPConvergenceCriteria
+Parameters...
+reference: the ReferenceCloud
+points: (m, 3) array of the source points
+threshold: largest distance of a correspondence
+transformation: 4x4 initial transformation, the identity if not given
+max_iteration: how many alignment steps to do at most
+relative_fitness, relative_rmse: stop once a step changes the fitness and the
+                                 inlier RMSE by less than this (relatively)
+
+Returns the 4x4 transformation of the source onto the reference.
+'''
+def icp_align(reference, points, threshold=THRESHOLD, transformation=None,
+              max_iteration=30, relative_fitness=1e-6, relative_rmse=1e-6):
+    if (transformation is None):
+        transformation = np.eye(4)
+    transformation = np.array(transformation, dtype=float)
+    fitness, rmse = 0.0, 0.0
+
+    for i in range(max_iteration):
+        moved = transform_points(points, transformation)
+        distance, index = reference.nearest(moved)
+        inliers = distance < threshold
+        if (np.count_nonzero(inliers) < 3):
+            break
+
+        # stop once the correspondences no longer improve
+        new_fitness = np.count_nonzero(inliers) / float(points.shape[0])
+        new_rmse = np.sqrt(np.mean(distance[inliers] ** 2))
+        if (i > 0 and abs(new_fitness - fitness) < relative_fitness * max(fitness, 1e-12) and
+                abs(new_rmse - rmse) < relative_rmse * max(rmse, 1e-12)):
+            break
+        fitness, rmse = new_fitness, new_rmse
+
+        # best rigid motion of the inliers onto their correspondences (Kabsch)
+        source = moved[inliers]
+        target = reference.points[index[inliers]]
+        source_center = source.mean(axis=0)
+        target_center = target.mean(axis=0)
+        u, s, vt = np.linalg.svd((source - source_center).T @ (target - target_center))
+        flip = np.diag([1.0, 1.0, np.sign(np.linalg.det(vt.T @ u.T))])
+        rotation = vt.T @ flip @ u.T
+        step = np.eye(4)
+        step[:3, :3] = rotation
+        step[:3, 3] = target_center - rotation @ source_center
+        transformation = step @ transformation
+
+    return transformation
+
+
+'''
+Function:   evaluate_files
+Use:        score any number of .xyz files against one reference .xyz file,
+            building the reference KD-tree only once
+Parameters...
+reference_file: the ground truth .xyz file
+filenames: the .xyz files to score
+threshold: largest distance of an inlier correspondence
+icp: align every file to the reference first
+
+Returns the metrics of every file, with its name as "file".
+'''
+def evaluate_files(reference_file, filenames, threshold=THRESHOLD, icp=False):
+    reference = ReferenceCloud(load_xyz_points(reference_file))
+    results = []
+    for filename in filenames:
+        scores = reference.evaluate(load_xyz_points(filename), threshold, icp=icp)
+        scores["file"] = filename
+        results.append(scores)
+    return results
+
+
+'''
+Function:   print_scores
+Use:        print the metrics of one scored cloud
+'''
+def print_scores(scores):
+    print("%s: fitness %.6f, inlier_rmse %.6g, point_to_plane_rmse %.6g, "
+          "chamfer %.6g, hausdorff %.6g" % (scores.get("file", "cloud"), scores["fitness"],
+                                            scores["inlier_rmse"], scores["point_to_plane_rmse"],
+                                            scores["chamfer"], scores["hausdorff"]))
+    if ("transformation" in scores):
+        print("Transformation is:")
+        print(np.array(scores["transformation"]))
+
+
+'''
+Function:   main()
+Use:        score files against a reference from the command line
+Parameters...
+argv: the command line arguments, those of the process if not given
+'''
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score point clouds against a reference cloud")
+    parser.add_argument("reference", help="ground truth .xyz file")
+    parser.add_argument("files", nargs="+", help=".xyz files to score")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="largest distance of an inlier (default: %g)" % THRESHOLD)
+    parser.add_argument("--icp", action="store_true",
+                        help="align every file to the reference with ICP first")
+    parser.add_argument("--output", default=None, help="JSON file the scores are written to")
+    args = parser.parse_args(argv)
+
+    results = evaluate_files(args.reference, args.files, args.threshold, args.icp)
+    for scores in results:
+        print_scores(scores)
+
+    if (args.output):
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Scores written to " + args.output)
+    return 0
+
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -1,6 +1,6 @@
-from cloud_to_gts import gts_to_cloud
+from cloud_to_gts import mesh_to_cloud
 
-gts_file = input("Target GTS filename: ")
+gts_file = input("Target mesh filename (binary or GTS): ")
 xyz_file = input("New XYZ filename: ")
 
-gts_to_cloud(gts_file, xyz_file)
+mesh_to_cloud(gts_file, xyz_file)
@@ -0,0 +1,224 @@
+'''
+    Instrumentation
+
+    A small layer the pipelines report to, so it can be seen where the time
+    goes without changing the algorithms:
+
+        stage timers:   with stage("triangulation"): ...
+                        records the calls, the total seconds and the peak
+                        memory of every named stage
+        counters:       count("neighbors_visited", n)
+                        adds to a named counter
+        progress:       progress("bilateral", done, total)
+                        reports how far a long loop is
+
+    Everything is off by default. While disabled, stage() returns a shared
+    context that does nothing and count() returns at once, so the calls can
+    stay in the code (they are made per stage or per batch of points, never per
+    point). enable() turns the recording on, and report() returns what was
+    recorded as a dictionary (JSON serializable).
+
+    Hooks subscribe to the events as they happen, e.g. for a job runner:
+
+        def hook(event, name, value):
+            ...
+        subscribe(hook)
+
+    The events are "stage_start" (value None), "stage_end" (value: seconds),
+    "count" (value: amount) and "progress" (value: (done, total)). Progress is
+    reported even while disabled: it goes to the hooks if there are any, and is
+    drawn as the usual console progress bar otherwise.
+
+    The peak memory is the peak resident set size of the process, and also the
+    tracemalloc peak while tracemalloc is tracing.
+'''
+import resource
+import sys
+import time
+import tracemalloc
+
+enabled = False
+stages = {}
+counters = {}
+_hooks = []
+
+# state of the console progress bar, (name, total, characters drawn)
+_bar = None
+BAR_WIDTH = 50
+
+
+class _NullStage:
+    '''
+    Class:  _NullStage
+    Use:    the stage context while disabled, does nothing
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    '''
+    Class:  _Stage
+    Use:    times a stage and records it when the context exits
+    Parameters...
+    name: name of the stage
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        emit("stage_start", self.name, None)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        record = stages.setdefault(self.name, {"calls": 0, "seconds": 0.0,
+                                               "peak_rss_kb": 0, "peak_traced_bytes": None})
+        record["calls"] += 1
+        record["seconds"] += seconds
+        record["peak_rss_kb"] = max(record["peak_rss_kb"], peak_rss_kb())
+        if (tracemalloc.is_tracing()):
+            traced = tracemalloc.get_traced_memory()[1]
+            record["peak_traced_bytes"] = max(record["peak_traced_bytes"] or 0, traced)
+        emit("stage_end", self.name, seconds)
+        return False
+
+
+'''
+Function:   enable
+Use:        start recording stages and counters
+'''
+def enable():
+    global enabled
+    enabled = True
+
+
+'''
+Function:   disable
+Use:        stop recording, what was recorded is kept until reset
+'''
+def disable():
+    global enabled
+    enabled = False
+
+
+'''
+Function:   reset
+Use:        forget the recorded stages and counters
+'''
+def reset():
+    stages.clear()
+    counters.clear()
+
+
+'''
+Function:   subscribe
+Use:        call hook(event, name, value) for every event
+'''
+def subscribe(hook):
+    _hooks.append(hook)
+
+
+'''
+Function:   unsubscribe
+Use:        stop calling a hook
+'''
+def unsubscribe(hook):
+    if (hook in _hooks):
+        _hooks.remove(hook)
+
+
+'''
+Function:   emit
+Use:        pass an event to the hooks
+'''
+def emit(event, name, value):
+    for hook in _hooks:
+        hook(event, name, value)
+
+
+'''
+Function:   stage
+Use:        context timing a named stage
+'''
+def stage(name):
+    if (not enabled):
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+'''
+Function:   count
+Use:        add an amount to a named counter
+'''
+def count(name, amount=1):
+    if (not enabled):
+        return
+    counters[name] = counters.get(name, 0) + int(amount)
+    if (_hooks):
+        emit("count", name, amount)
+
+
+'''
+Function:   progress
+Use:        report how far a loop is, to the hooks or as a console progress bar
+Parameters...
+name: what is in progress
+done: items done so far
+total: number of items
+'''
+def progress(name, done, total):
+    if (_hooks):
+        emit("progress", name, (done, total))
+    else:
+        console_progress(name, done, total)
+
+
+'''
+Function:   console_progress
+Use:        draw a progress bar of # characters on stdout
+'''
+def console_progress(name, done, total):
+    global _bar
+    if (_bar is None or _bar[0] != name or _bar[1] != total or done == 0):
+        if (_bar is not None and _bar[2] < BAR_WIDTH):
+            sys.stdout.write("\n")
+        sys.stdout.write("[%s]" % (" " * BAR_WIDTH))
+        sys.stdout.write("\b" * (BAR_WIDTH + 1))
+        _bar = (name, total, 0)
+    width = BAR_WIDTH * done // max(total, 1)
+    if (width > _bar[2]):
+        sys.stdout.write("#" * (width - _bar[2]))
+        _bar = (name, total, width)
+        if (width >= BAR_WIDTH):
+            sys.stdout.write("\n")
+    sys.stdout.flush()
+
+
+'''
+Function:   peak_rss_kb
+Use:        peak resident set size of the process so far, in kilobytes
+'''
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    if (sys.platform == "darwin"):
+        return peak // 1024
+    return peak
+
+
+'''
+Function:   report
+Use:        everything recorded so far, as a dictionary
+'''
+def report():
+    return {"stages": {name: dict(record) for name, record in stages.items()},
+            "counters": dict(counters),
+            "peak_rss_kb": peak_rss_kb()}
@@ -0,0 +1,169 @@
+import numpy as np
+from scipy import sparse
+
+'''
+This python utility holds the connectivity of a triangulated point cloud in a
+compact form that both algorithms can share.
+
+Everything is stored as int32 CSR (compressed sparse row) arrays: for a vertex v,
+the entries of v are indices[indptr[v]:indptr[v+1]]. The topology only depends
+on the triangulation, so it is built once and stays valid while the points
+themselves are moved by the smoothing iterations.
+
+    vertex_simplex:     simplices that contain each vertex
+    vertex_vertex:      vertices sharing a simplex with each vertex (1-ring)
+    ring(n):            vertices within n edges of each vertex
+    face_edges():       unique edges of the faces and the edges of each face
+'''
+
+'''
+Function:   csr_from_pairs
+Use:        build sorted, duplicate free int32 CSR arrays from (row, column) pairs
+Parameters...
+rows, columns: arrays of the pair indices
+num_rows: number of rows of the result
+'''
+def csr_from_pairs(rows, columns, num_rows):
+    order = np.lexsort((columns, rows))
+    rows = rows[order]
+    columns = columns[order]
+    keep = np.ones(rows.shape[0], dtype=bool)
+    keep[1:] = (rows[1:] != rows[:-1]) | (columns[1:] != columns[:-1])
+    rows = rows[keep]
+    columns = columns[keep]
+    indptr = np.zeros(num_rows + 1, dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=num_rows), out=indptr[1:])
+    return indptr, columns.astype(np.int32)
+
+
+'''
+Function:   csr_to_padded
+Use:        turn CSR arrays into a 2D array with one row per vertex, padded with -1
+Parameters...
+indptr, indices: the CSR arrays
+'''
+def csr_to_padded(indptr, indices):
+    lengths = np.diff(indptr)
+    width = max(int(lengths.max(initial=0)), 1)
+    padded = np.full((lengths.shape[0], width), -1, dtype=np.int32)
+    rows = np.repeat(np.arange(lengths.shape[0]), lengths)
+    columns = np.arange(indices.shape[0]) - np.repeat(indptr[:-1], lengths)
+    padded[rows, columns] = indices
+    return padded
+
+
+'''
+Function:   csr_matrix
+Use:        view CSR index arrays as a scipy sparse matrix of ones
+Parameters...
+indptr, indices: the CSR arrays
+num_columns: number of columns of the matrix
+dtype: data type of the ones, so products keep the type of the other operand
+'''
+def csr_matrix(indptr, indices, num_columns, dtype=np.float64):
+    data = np.ones(indices.shape[0], dtype=dtype)
+    return sparse.csr_matrix((data, indices, indptr),
+                             shape=(indptr.shape[0] - 1, num_columns))
+
+
+class MeshTopology:
+    '''
+    Class:  MeshTopology
+    Use:    vertex to simplex, vertex to vertex and n-ring adjacency of a mesh
+    Parameters...
+    simplices: (m, k) array of the vertex indices of each simplex
+    num_points: number of points, which may be more than the triangulated ones
+    vertex_simplex, vertex_vertex: the CSR arrays of the adjacency if already
+                                   known (e.g. from triangulation_cache.py)
+    '''
+    def __init__(self, simplices, num_points, vertex_simplex=None, vertex_vertex=None):
+        self.simplices = np.ascontiguousarray(simplices, dtype=np.int32)
+        self.num_points = num_points
+
+        # vertex -> simplex
+        num_simplices, k = self.simplices.shape
+        if (vertex_simplex is None):
+            vertex_simplex = csr_from_pairs(
+                self.simplices.ravel().astype(np.intp),
+                np.repeat(np.arange(num_simplices), k),
+                num_points)
+        self.vertex_simplex = vertex_simplex
+
+        # vertex -> vertex, every pair of vertices in a simplex is connected
+        if (vertex_vertex is None):
+            first, second = np.triu_indices(k, 1)
+            a = self.simplices[:, first].ravel().astype(np.intp)
+            b = self.simplices[:, second].ravel().astype(np.intp)
+            vertex_vertex = csr_from_pairs(np.concatenate((a, b)),
+                                           np.concatenate((b, a)),
+                                           num_points)
+        self.vertex_vertex = vertex_vertex
+
+        self._rings = {1: vertex_vertex}
+        self._face_edges = None
+
+    '''
+    Function:   ring
+    Use:        vertices within degree edges of each vertex, the vertex itself excluded
+    Parameters...
+    degree: how many levels of neighbors to include
+    '''
+    def ring(self, degree):
+        if (degree < 1):
+            indptr = np.zeros(self.num_points + 1, dtype=np.int32)
+            return indptr, np.zeros(0, dtype=np.int32)
+        if (degree not in self._rings):
+            # only the pattern of the products matters, float32 counts are enough
+            adjacency = csr_matrix(*self.vertex_vertex, self.num_points, dtype=np.float32)
+            previous = csr_matrix(*self.ring(degree - 1), self.num_points, dtype=np.float32)
+            reach = previous + previous @ adjacency + adjacency
+            reach.setdiag(0)
+            reach.eliminate_zeros()
+            reach.sort_indices()
+            self._rings[degree] = (reach.indptr.astype(np.int32),
+                                   reach.indices.astype(np.int32))
+        return self._rings[degree]
+
+    '''
+    Function:   face_edges
+    Use:        unique edges of the faces (the first three vertices of each
+                simplex, as in the GTS output) and the three edges of each face
+    '''
+    def face_edges(self):
+        if (self._face_edges is None):
+            faces = self.simplices[:, :3]
+            pairs = np.stack((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]), axis=1)
+            pairs = np.sort(pairs.reshape(-1, 2), axis=1)
+            edges, inverse = np.unique(pairs, axis=0, return_inverse=True)
+            self._face_edges = (edges.astype(np.int32),
+                                inverse.reshape(-1, 3).astype(np.int32))
+        return self._face_edges
+
+
+'''
+Function:   as_topology
+Use:        return the topology of a mesh given as a scipy Delaunay triangulation
+            or as an existing MeshTopology
+Parameters...
+mesh: Delaunay triangulation or MeshTopology
+num_points: number of points, defaults to the number of triangulated points
+
+NOTE: with the "Qz" option qhull adds a point at infinity, and scipy keeps the
+simplices that use it with a vertex index one past the last point (which is
+also why Delaunay.vertex_neighbor_vertices fails on our triangulations).
+Those simplices are not part of the surface and are left out.
+
+Triangulations from triangulation_cache.py carry their topology with them, it
+is returned as is when it has the requested number of points.
+'''
+def as_topology(mesh, num_points=None):
+    if (isinstance(mesh, MeshTopology)):
+        return mesh
+    triangulated = mesh.points.shape[0]
+    if (num_points is None):
+        num_points = triangulated
+    topology = getattr(mesh, "topology", None)
+    if (topology is not None and topology.num_points == num_points):
+        return topology
+    simplices = mesh.simplices[(mesh.simplices < triangulated).all(axis=1)]
+    return MeshTopology(simplices, num_points)
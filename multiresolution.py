@@ -0,0 +1,149 @@
+'''
+    Multi-Resolution Denoising
+
+    Subsampling makes the triangulation and the iterations affordable, but
+    the output then only has the subsampled points. Here the denoiser runs
+    on a coarse level of the cloud and its result is carried back to every
+    original point:
+
+        - the levels are voxel grids of the original points (the point
+            closest to the centroid of each voxel, see
+            subsampling.voxel_indices), the coarsest sized so that about
+            len(points) // rate points are left, each finer one with half
+            the voxel size
+        - the denoiser moves the points of the coarsest level, and the
+            displacement of every point of the next level is interpolated
+            from its nearest coarse points, weighted by their inverse
+            squared distance (one cKDTree query per level)
+        - at each finer level a cheap refinement pass can move the
+            interpolated points again (e.g. one kdtree iteration of the
+            bilateral denoising), and its displacements are carried on
+        - the displacements of the finest level are interpolated onto the
+            full cloud, so the output has every point of the input
+
+    The expensive part (triangulation and iterations) only sees the coarse
+    level, so the full resolution output costs about as much as a
+    subsampled run plus one nearest neighbor query of the full cloud.
+'''
+from scipy.spatial import cKDTree
+import numpy as np
+import instrumentation
+from subsampling import subsample_to_count
+from subsampling import voxel_indices
+
+# coarse points the displacement of a finer point is interpolated from
+TRANSFER_NEIGHBORS = 4
+
+# points whose displacements are interpolated at a time
+CHUNK_POINTS = 1 << 16
+
+'''
+Function:   voxel_pyramid
+Use:        the levels of the cloud, from the coarsest to the finest
+Parameters...
+points: (n, 3) array of the points
+rate: reduction factor of the coarsest level (len(points) // rate points)
+refine_levels: how many finer levels to add, each with half the voxel size
+               of the previous one (fewer once a level has every point)
+
+Returns a list of the (sorted) indices of the points of every level.
+'''
+def voxel_pyramid(points, rate, refine_levels=0):
+    n = points.shape[0]
+    if (rate <= 1 or n == 0):
+        return [np.arange(n)]
+
+    subsample = lambda p, s: p[voxel_indices(p, s)]
+    size = subsample_to_count(points, max(n // rate, 1), subsample)[1]
+    levels = [voxel_indices(points, size)]
+    for level in range(refine_levels):
+        size /= 2.0
+        index = voxel_indices(points, size)
+        if (index.shape[0] >= n):
+            break
+        levels.append(index)
+    return levels
+
+
+'''
+Function:   transfer_displacements
+Use:        interpolate the displacements of some points at other positions
+Parameters...
+source: (m, 3) array of the points whose displacements are known
+displacements: (m, 3) array of their displacements
+targets: (n, 3) array of the positions to interpolate at
+k: how many nearest source points each displacement is interpolated from
+
+Returns the (n, 3) displacements, weighted by the inverse squared distance to
+the source points (a target on a source point gets its displacement).
+'''
+def transfer_displacements(source, displacements, targets, k=TRANSFER_NEIGHBORS):
+    k = min(k, source.shape[0])
+    tree = cKDTree(source)
+    result = np.empty(targets.shape, dtype=displacements.dtype)
+    for start in range(0, targets.shape[0], CHUNK_POINTS):
+        block = targets[start:start + CHUNK_POINTS]
+        distance, nearest = tree.query(block, k=k, workers=-1)
+        distance = distance.reshape(block.shape[0], k)
+        nearest = nearest.reshape(block.shape[0], k)
+
+        with np.errstate(divide='ignore'):
+            weights = 1.0 / (distance * distance)
+        exact = distance[:, 0] == 0
+        weights[exact] = 0.0
+        weights[exact, 0] = 1.0
+        weights /= weights.sum(axis=1)[:, None]
+
+        result[start:start + block.shape[0]] = np.einsum('ij,ijk->ik', weights,
+                                                         displacements[nearest])
+    instrumentation.count("displacements_transferred", targets.shape[0])
+    return result
+
+
+'''
+Function:   multires_denoise
+Use:        denoise the coarsest level of a cloud and carry the displacements
+            back to every point
+Parameters...
+points: (n, 3) array of the points
+denoise: function of the (m, 3) points of the coarsest level returning
+         (moved points, indices of the points whose displacement counts, None
+         for all), e.g. the surface vertices of the non-iterative smoothing
+rate: reduction factor of the coarsest level, see voxel_pyramid
+refine_levels: how many finer levels the refinement runs on
+refine: function of the interpolated points of a finer level returning
+        (moved points, indices) like denoise, no finer levels if not given
+k: how many coarser points each displacement is interpolated from
+
+Returns the (n, 3) denoised points, in the precision of the points.
+'''
+def multires_denoise(points, denoise, rate, refine_levels=0, refine=None,
+                     k=TRANSFER_NEIGHBORS):
+    if (refine is None):
+        refine_levels = 0
+    with instrumentation.stage("multires_pyramid"):
+        levels = voxel_pyramid(points, rate, refine_levels)
+    print("Levels: " + ", ".join(str(index.shape[0]) for index in levels) +
+          " of " + str(points.shape[0]) + " points")
+
+    source = points[levels[0]]
+    with instrumentation.stage("multires_coarse"):
+        moved, used = denoise(source)
+    if (used is not None):
+        source, moved = source[used], moved[used]
+    displacements = moved - source
+
+    for index in levels[1:]:
+        level = points[index]
+        with instrumentation.stage("multires_transfer"):
+            guess = level + transfer_displacements(source, displacements, level, k)
+        with instrumentation.stage("multires_refine"):
+            moved, used = refine(guess)
+        source = level
+        if (used is not None):
+            source, moved = source[used], moved[used]
+        displacements = moved - source
+
+    with instrumentation.stage("multires_transfer"):
+        shift = transfer_displacements(source, displacements, points, k)
+    return (points + shift).astype(points.dtype, copy=False)
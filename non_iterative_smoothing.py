@@ -0,0 +1,295 @@
+'''
+    Non Iterative Feature Preserving Mesh Smoothing, in NumPy
+
+    This is a port of smoother.c that runs in process on the triangulation, so
+    no GTS file has to be written, no smoother binary has to be built for the
+    system and no subprocess is started.
+
+    The C implementation walks a bounding box tree of the triangle centroids for
+    every vertex. Here the same search is a bulk ball query on a cKDTree of the
+    centroids, and the projections and weights of all (vertex, triangle) pairs
+    are computed as array operations, a block of vertices at a time:
+
+        mollify_vertices:   smoothed positions used only for the normals
+                            (mollify_vertex in smoother.c)
+        filter_vertices:    the actual new positions (filter_vertex), with the
+                            projections onto the triangle planes (project_to_tri)
+        distribution:       the gaussian, exponential and gamma weighting
+
+    As in smoother.c, sigma_f and sigma_g are given in units of the mean edge
+    length of the mesh, and only vertices that are part of a face are moved.
+'''
+from scipy.spatial import cKDTree
+import numpy as np
+import math
+import instrumentation
+
+# vertices processed at a time, bounds the memory of the (vertex, triangle) pairs
+CHUNK_VERTICES = 1024
+
+'''
+Function:   gaussian2
+Use:        value of the gaussian distribution at x (a squared distance)
+'''
+def gaussian2(x, sigma):
+    return np.exp(-x / (2 * sigma * sigma))
+
+
+'''
+Function:   exp_dist
+Use:        value of the exponential distribution at x
+'''
+def exp_dist(x, sigma):
+    return sigma * np.exp(-sigma * x)
+
+
+'''
+Function:   gamma_dist
+Use:        value of the gamma distribution at x, with the factorial taken of
+            the integer part of k like smoother.c
+'''
+def gamma_dist(x, k, theta):
+    gamma_func = float(math.factorial(max(int(k) - 1, 0)))
+    denominator = gamma_func * math.pow(theta, k)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nominator = np.power(x, k - 1) * np.exp(-x / theta)
+    return nominator / denominator
+
+
+'''
+Function:   distribution
+Use:        weight of x for the selected distribution
+Parameters...
+x: array of squared distances
+sigma: parameter of the distribution
+dist_mode: 1 for gaussian, 2 for exponential, 3 for gamma
+'''
+def distribution(x, sigma, dist_mode):
+    if (dist_mode == 1):
+        return gaussian2(x, sigma)
+    if (dist_mode == 2):
+        return exp_dist(x, sigma)
+    if (dist_mode == 3):
+        return gamma_dist(x, sigma, sigma)
+    raise ValueError("Unknown distribution: " + str(dist_mode))
+
+
+'''
+Function:   triangle_normals
+Use:        unit normals of the triangles, zero for degenerate triangles
+Parameters...
+points: array of the vertex positions
+faces: (m, 3) array of the vertex indices of each triangle
+'''
+def triangle_normals(points, faces):
+    v1 = points[faces[:, 0]]
+    normals = np.cross(points[faces[:, 1]] - v1, points[faces[:, 2]] - v1)
+    norm = np.linalg.norm(normals, axis=1)
+    np.divide(normals, norm[:, None], out=normals, where=norm[:, None] > 0)
+    return normals
+
+
+'''
+Function:   ball_pairs
+Use:        all (point, centroid) pairs closer than the cutoff distance
+Parameters...
+tree: cKDTree of the triangle centroids
+points: array of the points to search around
+cutoff: search radius
+
+Returns (rows, columns, dmin): point index, triangle index and squared
+distance of every pair.
+'''
+def ball_pairs(tree, points, cutoff):
+    pairs = cKDTree(points).sparse_distance_matrix(tree, cutoff, output_type='ndarray')
+    return pairs['i'], pairs['j'], pairs['v'] * pairs['v']
+
+
+'''
+Function:   filter_vertices
+Use:        weighted average of the projections of each vertex onto the nearby
+            triangles (filter in smoother.c, for all vertices)
+Parameters...
+points: array of the original vertex positions
+vertices: indices of the vertices to filter
+faces: (m, 3) array of the vertex indices of each triangle
+tree: cKDTree of the triangle centroids
+cutoff: maximum distance from a vertex to a triangle centroid
+spatial_sigma: parameter for the distance to the centroid
+influence_sigma: parameter for the projection distance, 0 to not use it
+dist_mode: 1 for gaussian, 2 for exponential, 3 for gamma
+normals: unit normals to project with, those of the triangles if not given
+
+NOTE: the projection of p onto a plane is p - d * n with d the signed distance
+to the plane, so the weighted average of the projections is p minus the
+weighted average of d * n, and the squared projection distance is d * d.
+'''
+def filter_vertices(points, vertices, faces, tree, cutoff, spatial_sigma,
+                    influence_sigma, dist_mode, normals=None):
+    centroids = tree.data
+    v1 = points[faces[:, 0]]
+    area = np.linalg.norm(np.cross(points[faces[:, 1]] - v1, points[faces[:, 2]] - v1), axis=1) / 2.
+    if (normals is None):
+        normals = triangle_normals(points, faces)
+    # plane offsets, so the signed distance of p to a plane is p . n - offset
+    plane_offsets = np.einsum('ij,ij->i', centroids, normals)
+
+    new_points = points[vertices].copy()
+    for start in range(0, vertices.shape[0], CHUNK_VERTICES):
+        chunk = new_points[start:start + CHUNK_VERTICES]
+        rows, t, dmin = ball_pairs(tree, chunk, cutoff)
+        instrumentation.count("neighbors_visited", rows.shape[0])
+
+        # signed distance to the plane through the centroid
+        n = normals[t]
+        d = np.einsum('ij,ij->i', chunk[rows], n) - plane_offsets[t]
+
+        w = area[t] * distribution(dmin, spatial_sigma, dist_mode)
+        if (influence_sigma > 0.0):
+            w *= distribution(d * d, influence_sigma, dist_mode)
+
+        # scale by sum of weights if anything influenced this point
+        k = np.bincount(rows, weights=w, minlength=chunk.shape[0])
+        wd = w * d
+        shift = np.stack([np.bincount(rows, weights=wd * n[:, i],
+                                      minlength=chunk.shape[0]) for i in range(3)], axis=1)
+        moved = k > 0.0
+        chunk[moved] -= shift[moved] / k[moved, None]
+
+    instrumentation.count("vertices_processed", vertices.shape[0])
+    return new_points
+
+
+'''
+Function:   mollify_vertices
+Use:        calculate the 'mollified' positions, which are only used for the
+            triangle normals of the second pass (mollify_vertex in smoother.c)
+Parameters...
+points: array of the vertex positions
+vertices: indices of the vertices of the surface
+faces: (m, 3) array of the vertex indices of each triangle
+tree: cKDTree of the triangle centroids
+cutoff: maximum distance from a vertex to a triangle centroid
+sigma_m: parameter for the distance to the centroid
+dist_mode: 1 for gaussian, 2 for exponential, 3 for gamma
+'''
+def mollify_vertices(points, vertices, faces, tree, cutoff, sigma_m, dist_mode):
+    mollified = points.copy()
+    mollified[vertices] = filter_vertices(points, vertices, faces, tree,
+                                          cutoff, sigma_m, 0.0, dist_mode)
+    return mollified
+
+
+'''
+Function:   mean_edge_length
+Use:        mean length of the unique edges of the triangles
+Parameters...
+points: array of the vertex positions
+faces: (m, 3) array of the vertex indices of each triangle
+'''
+def mean_edge_length(points, faces):
+    pairs = np.concatenate((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]))
+    edges = np.unique(np.sort(pairs, axis=1), axis=0)
+    return np.linalg.norm(points[edges[:, 0]] - points[edges[:, 1]], axis=1).mean()
+
+
+class SmoothingMesh:
+    '''
+    Class:  SmoothingMesh
+    Use:    the parts of a triangle mesh the smoother uses whatever the
+            parameters (surface vertices, mean edge length, centroid tree), and
+            the mollified normals of every sigma_f used so far, so that runs
+            with several parameters share them
+    Parameters...
+    points: array of the vertex positions
+    faces: (m, 3) array of the vertex indices of each triangle
+    '''
+    def __init__(self, points, faces):
+        # float32 points stay float32, anything else is smoothed as float64
+        points = np.asarray(points)
+        if (points.dtype != np.float32):
+            points = points.astype(float)
+        self.points = points
+        self.faces = np.asarray(faces, dtype=np.intp)
+        self.vertices = np.unique(self.faces)
+
+        # scale by mean edge length
+        self.scale = mean_edge_length(self.points, self.faces)
+
+        # search structure over the triangle centroids
+        self.tree = cKDTree(self.points[self.faces].mean(axis=1))
+        self._normals = {}
+
+    '''
+    Function:   mollify
+    Use:        triangle normals of the 'mollified' mesh, computed without
+                keeping them (for callers that cache them on their own)
+    Parameters...
+    sigma_f: spatial parameter, in mean edge lengths
+    dist_mode: 1 for gaussian, 2 for exponential, 3 for gamma
+    '''
+    def mollify(self, sigma_f, dist_mode):
+        sigma_f = float(sigma_f) * self.scale
+        with instrumentation.stage("mollify"):
+            mollified = mollify_vertices(self.points, self.vertices, self.faces, self.tree,
+                                         2.0 * sigma_f, sigma_f / 2.0, int(float(dist_mode)))
+            return triangle_normals(mollified, self.faces)
+
+    '''
+    Function:   mollified_normals
+    Use:        triangle normals of the 'mollified' mesh, computed once for
+                every (sigma_f, dist_mode)
+    Parameters...
+    sigma_f: spatial parameter, in mean edge lengths
+    dist_mode: 1 for gaussian, 2 for exponential, 3 for gamma
+    '''
+    def mollified_normals(self, sigma_f, dist_mode):
+        key = (float(sigma_f), int(float(dist_mode)))
+        if (key not in self._normals):
+            self._normals[key] = self.mollify(*key)
+        return self._normals[key]
+
+    '''
+    Function:   smooth
+    Use:        smooth the mesh with the given parameters
+    Parameters...
+    sigma_f: spatial parameter, in mean edge lengths
+    sigma_g: influence parameter, in mean edge lengths
+    dist_mode: 1 for gaussian, 2 for exponential, 3 for gamma
+    normals: the mollified normals of (sigma_f, dist_mode) from mollify, those
+             kept by mollified_normals if not given
+
+    Returns the smoothed positions of all points.
+    '''
+    def smooth(self, sigma_f, sigma_g, dist_mode, normals=None):
+        # generate 'mollified' normals
+        if (normals is None):
+            normals = self.mollified_normals(sigma_f, dist_mode)
+
+        # calculate changes based on 'mollified' normals and shift all points
+        sigma_g = float(sigma_g) * self.scale
+        sigma_f = float(sigma_f) * self.scale
+        with instrumentation.stage("filter"):
+            new_points = self.points.copy()
+            new_points[self.vertices] = filter_vertices(self.points, self.vertices, self.faces,
+                                                        self.tree, 2.0 * sigma_f, sigma_f,
+                                                        sigma_g, int(float(dist_mode)), normals)
+        return new_points
+
+
+'''
+Function:   non_iterative_smooth
+Use:        smooth a triangle mesh, as the smoother binary does for a GTS file
+Parameters...
+points: array of the vertex positions
+faces: (m, 3) array of the vertex indices of each triangle
+sigma_f: spatial parameter, in mean edge lengths
+sigma_g: influence parameter, in mean edge lengths
+dist_mode: 1 for gaussian, 2 for exponential, 3 for gamma
+
+Returns (new_points, vertices): the smoothed positions of all points, and the
+indices of the vertices that are part of the surface (the others are unchanged).
+'''
+def non_iterative_smooth(points, faces, sigma_f, sigma_g, dist_mode):
+    mesh = SmoothingMesh(points, faces)
+    return mesh.smooth(sigma_f, sigma_g, dist_mode), mesh.vertices
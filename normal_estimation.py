@@ -0,0 +1,200 @@
+'''
+    Normal Estimation
+
+    Estimates the normal of every point of a cloud from its k nearest
+    neighbors (PCA), for all the points at once:
+
+        - one cKDTree query gives the k nearest neighbors of a block of points,
+            their covariance matrices are built with one einsum, and the
+            stacked matrices are solved with one np.linalg.eigh call; the
+            normal is the eigenvector of the smallest eigenvalue
+        - the sign of a PCA normal is arbitrary, so the normals are oriented
+            consistently by propagating the orientation along a minimum
+            spanning tree of the k-NN graph, whose edges are cheapest between
+            points with parallel normals (Hoppe et al., 'Surface Reconstruction
+            from Unorganized Points'). The tree is walked with pointer jumping
+            (log of its depth array operations) instead of point by point. The
+            highest point of every connected part has its normal pointing up.
+
+    NormalCache keeps the normals of a cloud that is moved in small steps (the
+    iterations of the bilateral denoising): after the first full estimation,
+    only the points that moved, those that had a moved point among their
+    nearest neighbors, and those a moved point came closer to than their k-th
+    nearest neighbor, are estimated again, and their new normals keep the
+    orientation of the old ones.
+'''
+from scipy.sparse import csgraph
+from scipy import sparse
+from scipy.spatial import cKDTree
+import numpy as np
+import instrumentation
+
+# nearest neighbors each normal is fitted to
+NORMAL_NEIGHBORS = 16
+
+# points whose normals are fitted at a time
+CHUNK_POINTS = 8192
+
+'''
+Function:   pca_normals
+Use:        unit normal of every point, the direction of least variance of its
+            k nearest neighbors
+Parameters...
+points: (n, 3) array of the points
+k: how many nearest neighbors (including the point) each normal is fitted to
+tree: cKDTree of the points, built here if not given
+index: indices of the points to estimate the normals of, all if not given
+
+Returns (normals, nearest): the unoriented normals of the (indexed) points, in
+the precision of the points, and the indices of their k nearest neighbors.
+'''
+def pca_normals(points, k=NORMAL_NEIGHBORS, tree=None, index=None):
+    if (tree is None):
+        tree = cKDTree(points)
+    centers = points if index is None else points[index]
+    k = min(k, points.shape[0])
+
+    normals = np.empty(centers.shape, dtype=points.dtype)
+    nearest = np.empty((centers.shape[0], k), dtype=np.int32)
+    for start in range(0, centers.shape[0], CHUNK_POINTS):
+        block = centers[start:start + CHUNK_POINTS]
+        rows = slice(start, start + block.shape[0])
+
+        nearest[rows] = tree.query(block, k=k, workers=-1)[1].reshape(block.shape[0], k)
+        neighbors = points[nearest[rows]]
+        local = neighbors - neighbors.mean(axis=1)[:, None, :]
+        covariance = np.einsum('ijk,ijl->ikl', local, local)
+        normals[rows] = np.linalg.eigh(covariance)[1][:, :, 0]
+
+    instrumentation.count("normals_estimated", centers.shape[0])
+    return normals, nearest
+
+
+'''
+Function:   orient_normals
+Use:        flip the normals so that neighboring normals point the same way
+Parameters...
+points: (n, 3) array of the points
+normals: (n, 3) array of their unit normals, flipped in place
+nearest: (n, k) indices of the nearest neighbors of every point, e.g. from
+         pca_normals
+
+Returns the normals.
+'''
+def orient_normals(points, normals, nearest):
+    n, k = nearest.shape
+    if (n == 0):
+        return normals
+
+    # k-NN graph, cheapest between parallel normals (zero costs would be no edge)
+    rows = np.repeat(np.arange(n), k)
+    columns = nearest.ravel().astype(np.intp)
+    keep = rows != columns
+    rows, columns = rows[keep], columns[keep]
+    cost = 1.0 - np.abs(np.einsum('ij,ij->i', normals[rows], normals[columns])) + 1e-9
+    graph = sparse.coo_matrix((cost, (rows, columns)), shape=(n + 1, n + 1)).tocsr()
+
+    # the highest point of every connected part is linked to an extra node n,
+    # whose normal points up, so one tree holds every point
+    parts, label = csgraph.connected_components(graph[:n, :n], directed=False)
+    order = np.lexsort((points[:, 2], label))
+    top = order[np.append(np.flatnonzero(np.diff(label[order])), n - 1)]
+    graph = graph + sparse.coo_matrix((np.full(parts, 1e-9), (np.full(parts, n), top)),
+                                      shape=(n + 1, n + 1)).tocsr()
+
+    tree = csgraph.minimum_spanning_tree(graph)
+    parent = csgraph.breadth_first_order(tree, n, directed=False,
+                                         return_predecessors=True)[1]
+    parent[n] = n
+
+    # flip of every point relative to its parent in the tree, then the flips
+    # are multiplied along the paths to the extra node by pointer jumping
+    up = np.zeros((1, 3), dtype=normals.dtype)
+    up[0, 2] = 1.0
+    extended = np.concatenate((normals, up))
+    sign = np.where(np.einsum('ij,ij->i', extended, extended[parent]) < 0, -1, 1)
+    while (np.any(parent != parent[parent])):
+        sign = sign * sign[parent]
+        parent = parent[parent]
+
+    normals *= sign[:n, None]
+    return normals
+
+
+class NormalCache:
+    '''
+    Class:  NormalCache
+    Use:    oriented PCA normals of a cloud that moves between calls, estimated
+            again only where the points moved
+    Parameters...
+    k: how many nearest neighbors each normal is fitted to
+    tolerance: distance a point has to move for its normal to be estimated
+               again (0 to estimate the normals again wherever a point moved)
+    '''
+    def __init__(self, k=NORMAL_NEIGHBORS, tolerance=0.0):
+        self.k = k
+        self.tolerance = tolerance
+        self.points = None
+        self.normals = None
+        self.nearest = None
+        self.radius = None
+
+    '''
+    Function:   update
+    Use:        the normals of the current positions of the points
+    Parameters...
+    points: (n, 3) array of the current point positions, the same points on
+            every call
+    '''
+    def update(self, points):
+        if (self.points is None or self.points.shape != points.shape):
+            self.normals, self.nearest = pca_normals(points, self.k)
+            orient_normals(points, self.normals, self.nearest)
+            self.points = points.copy()
+            self.radius = self.neighbor_radius(np.arange(points.shape[0]))
+            return self.normals
+
+        moved = np.linalg.norm(points - self.points, axis=1) > self.tolerance
+        if (not moved.any()):
+            return self.normals
+        self.points[moved] = points[moved]
+        tree = cKDTree(self.points)
+
+        # the moved points and every point that had one as a nearest neighbor
+        stale = moved | moved[self.nearest].any(axis=1)
+
+        # and every point a moved point is now closer to than its k-th neighbor
+        # (when most points moved, all are estimated again without searching)
+        index = np.flatnonzero(moved)
+        lengths = np.zeros(0, dtype=np.intp)
+        if (index.shape[0] > points.shape[0] // 2):
+            stale[:] = True
+        else:
+            close = tree.query_ball_point(self.points[index], self.radius.max(), workers=-1)
+            lengths = np.fromiter((len(c) for c in close), dtype=np.intp, count=len(close))
+        if (lengths.sum() > 0):
+            rows = np.repeat(index, lengths)
+            columns = np.concatenate([c for c in close if len(c)])
+            gap = np.linalg.norm(self.points[columns] - self.points[rows], axis=1)
+            stale[columns[gap <= self.radius[columns]]] = True
+
+        stale = np.flatnonzero(stale)
+        normals, nearest = pca_normals(self.points, self.k, tree, stale)
+
+        # keep the orientation the normals had
+        flip = np.einsum('ij,ij->i', normals, self.normals[stale]) < 0
+        normals[flip] *= -1
+        self.normals[stale] = normals
+        self.nearest[stale] = nearest
+        self.radius[stale] = self.neighbor_radius(stale)
+        instrumentation.count("normals_refreshed", stale.shape[0])
+        return self.normals
+
+    '''
+    Function:   neighbor_radius
+    Use:        distance of the points to their k-th nearest neighbor
+    Parameters...
+    index: indices of the points
+    '''
+    def neighbor_radius(self, index):
+        return np.linalg.norm(self.points[self.nearest[index, -1]] - self.points[index], axis=1)
@@ -0,0 +1,365 @@
+'''
+    Out-of-core Tiled Denoising
+
+    For clouds larger than memory, the denoiser is run on one spatial tile at a
+    time, with the tiles kept on disk:
+
+        - The .xyz file is converted block by block to its binary sidecar (see
+            cloud_io.py) and memory-mapped, and the bounding box is found with
+            one pass over it.
+        - The box is cut into tiles (tile_grid of parallel_bilateral.py), and a
+            second pass appends the points of every tile, with their index in
+            the file, to the tile's files in a work directory.
+        - The halo is estimated one tile at a time, from the neighborhood radii
+            of the tile's own points. They are found against the whole cloud,
+            from the interior files of the tiles around it, since the k-NN of
+            the points of a sparse tile lie in other tiles. Every iteration can
+            move the influence of a point one radius further, so the halo of a
+            tile is the radius of almost all of its points (HALO_QUANTILE of
+            parallel_bilateral.py) times the number of iterations. A third pass
+            appends the points within the halo of every tile to it.
+        - The few points with wider radii (outliers) do not widen the halo:
+            the points within their own radius (plus the halo for the further
+            iterations) are found with one k-d tree query per block of the
+            cloud and appended to their tile, and to the tiles whose points
+            (or wide points) reach them within the iterations.
+        - Each tile is then loaded with its halo and denoised, and its interior
+            points are written at their original index into a memory-mapped
+            result, which is finally written out as .xyz in blocks.
+
+    Peak memory is bounded by the size of one tile, its halo and the neighbors
+    of its wide points (plus a block of rows), not by the size of the cloud.
+    By default the bilateral method is run in "kdtree" mode, which needs no
+    triangulation of the whole cloud.
+'''
+from scipy.spatial import cKDTree
+import numpy as np
+import os
+import shutil
+import tempfile
+from BilateralMeshDenoising import bilateral_iteration_batch
+from cloud_io import CHUNK_ROWS
+from cloud_io import load_xyz_points
+from cloud_io import write_xyz
+from BilateralMeshDenoising import knn_size
+from parallel_bilateral import HALO_QUANTILE
+from parallel_bilateral import knn_radii
+from parallel_bilateral import tile_cuts
+from parallel_bilateral import tile_grid
+
+# average number of interior points per tile
+TILE_POINTS = 1 << 20
+
+# wide points whose neighbors are looked up at a time
+WIDE_QUERY = 64
+
+'''
+Function:   bounding_box
+Use:        lower and upper corner of the points, a block of rows at a time
+'''
+def bounding_box(points, chunk_rows=CHUNK_ROWS):
+    low = np.full(3, np.inf)
+    high = np.full(3, -np.inf)
+    for start in range(0, points.shape[0], chunk_rows):
+        block = np.asarray(points[start:start + chunk_rows])
+        low = np.minimum(low, block.min(axis=0))
+        high = np.maximum(high, block.max(axis=0))
+    return low, high
+
+
+'''
+Function:   append_tiles
+Use:        append points and their indices to the files of their tiles
+Parameters...
+work_dir: directory of the tile files
+kind: "interior" or "halo"
+tile_ids: tile of every point
+points: array of the points
+indices: index of every point in the whole cloud
+'''
+def append_tiles(work_dir, kind, tile_ids, points, indices):
+    order = np.argsort(tile_ids, kind='stable')
+    unique, start = np.unique(tile_ids[order], return_index=True)
+    for tile, group in zip(unique.tolist(), np.split(order, start[1:])):
+        name = os.path.join(work_dir, "tile_%d.%s" % (tile, kind))
+        with open(name + ".points", 'ab') as f:
+            points[group].tofile(f)
+        with open(name + ".indices", 'ab') as f:
+            indices[group].tofile(f)
+
+
+'''
+Function:   read_tile
+Use:        the points and their indices stored for a tile
+'''
+def read_tile(work_dir, tile, kind):
+    name = os.path.join(work_dir, "tile_%d.%s" % (tile, kind))
+    if (not os.path.exists(name + ".points")):
+        return np.zeros((0, 3)), np.zeros(0, dtype=np.int64)
+    points = np.fromfile(name + ".points", dtype=float).reshape(-1, 3)
+    indices = np.fromfile(name + ".indices", dtype=np.int64)
+    # a point near several wide points is appended once for each of them
+    indices, first = np.unique(indices, return_index=True)
+    return points[first], indices
+
+
+'''
+Function:   read_box
+Use:        the points inside a box, from the interior files of the tiles it
+            overlaps
+Parameters...
+work_dir: directory of the tile files
+cuts: inner tile boundaries along each axis, from tile_cuts
+lower, upper: corners of the box
+'''
+def read_box(work_dir, cuts, lower, upper):
+    counts = [c.shape[0] + 1 for c in cuts]
+    first = [int(np.searchsorted(cuts[a], lower[a], side='right')) for a in range(3)]
+    last = [int(np.searchsorted(cuts[a], upper[a], side='right')) for a in range(3)]
+    boxes = [read_tile(work_dir, (i * counts[1] + j) * counts[2] + k, "interior")[0]
+             for i in range(first[0], last[0] + 1)
+             for j in range(first[1], last[1] + 1)
+             for k in range(first[2], last[2] + 1)]
+    candidates = np.concatenate(boxes)
+    return candidates[np.all((candidates >= lower) & (candidates <= upper), axis=1)]
+
+
+'''
+Function:   tile_radii
+Use:        neighborhood radii of the interior points of a tile against the
+            whole cloud, from the points of a box around them that grows until
+            it holds their k-NN (as parallel_bilateral.tile_radii)
+Parameters...
+work_dir: directory of the tile files
+cuts: inner tile boundaries along each axis, from tile_cuts
+interior: array of the interior points of the tile
+n: number of points in the whole cloud
+n_degree: how many levels of neighbors to include in normal calculations
+reach: smallest distance the box is grown by at first
+'''
+def tile_radii(work_dir, cuts, interior, n, n_degree, reach):
+    k = min(knn_size(n_degree), n)
+    # about the k-NN radius of points spread evenly over a surface patch
+    reach = max(reach, float(np.ptp(interior, axis=0).max()) *
+                np.sqrt(k / float(interior.shape[0])))
+
+    radius = np.empty(interior.shape[0])
+    pending = np.arange(interior.shape[0])
+    while (pending.shape[0] > 0):
+        centers = interior[pending]
+        lower = centers.min(axis=0) - reach
+        upper = centers.max(axis=0) + reach
+        candidates = read_box(work_dir, cuts, lower, upper)
+        dist = cKDTree(candidates).query(centers, k=k)[0].reshape(-1, k)
+
+        # the k-NN are exact once they are closer than the sides of the box
+        edge = np.minimum(centers - lower, upper - centers).min(axis=1)
+        done = dist[:, -1] <= edge
+        if (candidates.shape[0] == n):
+            done[:] = True
+        radius[pending[done]] = knn_radii(dist[done])
+        pending = pending[~done]
+        reach *= 2
+    return radius
+
+
+'''
+Function:   bucket_points
+Use:        append every point to the tiles whose region contains it
+Parameters...
+points: (memory-mapped) array of all the points
+cuts: inner tile boundaries along each axis, from tile_cuts
+work_dir: directory of the tile files
+kind: "interior" for the tile of each point, "halo" for the tiles whose halo
+      (but not interior) contains it
+halo: width of the halo around each tile, or array of the width of every
+      tile, for kind "halo"
+chunk_rows: how many points to bucket at a time
+'''
+def bucket_points(points, cuts, work_dir, kind, halo=0.0, chunk_rows=CHUNK_ROWS):
+    counts = [c.shape[0] + 1 for c in cuts]
+    bounds = [np.concatenate(([-np.inf], c, [np.inf])) for c in cuts]
+    widths = np.broadcast_to(halo, (counts[0] * counts[1] * counts[2],))
+    halo = widths.max(initial=0.0)
+    for start in range(0, points.shape[0], chunk_rows):
+        block = np.asarray(points[start:start + chunk_rows], dtype=float)
+        indices = np.arange(start, start + block.shape[0], dtype=np.int64)
+        own = [np.searchsorted(cuts[a], block[:, a], side='right') for a in range(3)]
+
+        if (kind == "interior"):
+            append_tiles(work_dir, kind, (own[0] * counts[1] + own[1]) * counts[2] + own[2],
+                         block, indices)
+            continue
+
+        # along each axis, the range of tiles whose interval grown by the halo
+        # contains the point
+        first = [np.searchsorted(cuts[a], block[:, a] - halo, side='right') for a in range(3)]
+        last = [np.searchsorted(cuts[a], block[:, a] + halo, side='right') for a in range(3)]
+        spans = [int((last[a] - first[a]).max()) + 1 for a in range(3)]
+        for di in range(spans[0]):
+            for dj in range(spans[1]):
+                for dk in range(spans[2]):
+                    i, j, k = first[0] + di, first[1] + dj, first[2] + dk
+                    selected = (i <= last[0]) & (j <= last[1]) & (k <= last[2]) & \
+                               ((i != own[0]) | (j != own[1]) | (k != own[2]))
+                    if (not np.any(selected)):
+                        continue
+                    tile_ids = (i * counts[1] + j) * counts[2] + k
+                    # the ranges are those of the widest halo, keep the points
+                    # within the halo of their tile
+                    width = widths[np.where(selected, tile_ids, 0)]
+                    for a, index in enumerate((i, j, k)):
+                        index = np.minimum(index, counts[a] - 1)
+                        selected &= ((block[:, a] >= bounds[a][index] - width) &
+                                     (block[:, a] < bounds[a][index + 1] + width))
+                    if (np.any(selected)):
+                        append_tiles(work_dir, kind, tile_ids[selected],
+                                     block[selected], indices[selected])
+
+
+'''
+Function:   bucket_wide
+Use:        append the points near the wide points of the tiles to their halo
+Parameters...
+points: (memory-mapped) array of all the points
+work_dir: directory of the tile files
+wide: (m, 3) array of the wide points
+reach: distance of the points appended around every wide point
+tile_ids: tile of every wide point
+chunk_rows: how many points to look at a time
+'''
+def bucket_wide(points, work_dir, wide, reach, tile_ids, chunk_rows=CHUNK_ROWS):
+    if (wide.shape[0] == 0):
+        return
+    tiles = np.unique(tile_ids)
+    for start in range(0, points.shape[0], chunk_rows):
+        block = np.asarray(points[start:start + chunk_rows], dtype=float)
+        tree = cKDTree(block)
+        for tile in tiles.tolist():
+            # a few wide points at a time, and every point once per tile
+            group = np.flatnonzero(tile_ids == tile)
+            hits = np.zeros(0, dtype=np.int64)
+            for first in range(0, group.shape[0], WIDE_QUERY):
+                part = group[first:first + WIDE_QUERY]
+                lists = tree.query_ball_point(wide[part], reach[part])
+                hits = np.union1d(hits, np.fromiter((i for l in lists for i in l),
+                                                    dtype=np.int64))
+            if (hits.shape[0] > 0):
+                append_tiles(work_dir, "halo", np.full(hits.shape[0], tile), block[hits],
+                             start + hits)
+
+
+'''
+Function:   bilateral_tile_denoiser
+Use:        the default tile denoiser, bilateral iterations in "kdtree" mode
+'''
+def bilateral_tile_denoiser(iterations, n_degree):
+    def denoise(points):
+        for i in range(iterations):
+            points = bilateral_iteration_batch(points, None, n_degree, "kdtree")
+        return points
+    return denoise
+
+
+'''
+Function:   tiled_denoise
+Use:        denoise a .xyz file one spatial tile at a time, with bounded memory
+Parameters...
+filename: the input .xyz file
+save_filename: the output .xyz file, with the points in the input order
+iterations: how many times to smooth the points
+n_degree: how many levels of neighbors to include in normal calculations
+tile_points: average number of interior points per tile
+halo: width of the halo around each tile, estimated per tile if not given
+halo_margin: factor applied to the neighborhood radii for the halos
+denoise: function denoising an array of points, the bilateral iterations if
+         not given (a halo must then be given as well)
+work_dir: directory for the temporary tile files, the system default if not given
+'''
+def tiled_denoise(filename, save_filename, iterations=2, n_degree=4,
+                  tile_points=TILE_POINTS, halo=None, halo_margin=1.5,
+                  denoise=None, work_dir=None):
+    if (denoise is None):
+        denoise = bilateral_tile_denoiser(iterations, n_degree)
+    elif (halo is None):
+        raise ValueError("A halo width is needed with a custom denoiser")
+
+    points = load_xyz_points(filename)
+    n = points.shape[0]
+    low, high = bounding_box(points)
+    tiles = tile_grid(np.stack((low, high)), max(int(np.ceil(n / float(tile_points))), 1))
+    print("Tiles: " + str(len(tiles)))
+
+    work_dir = tempfile.mkdtemp(prefix="tiles_", dir=work_dir)
+    try:
+        cuts = tile_cuts(tiles)
+        bucket_points(points, cuts, work_dir, "interior")
+
+        wide = [np.zeros((0, 3))]
+        reach = [np.zeros(0)]
+        wide_tiles = [np.zeros(0, dtype=np.int64)]
+        if (halo is None):
+            halo = np.zeros(len(tiles))
+            steps = max(iterations, 1)
+            # a floor for the radius search, for tiles of coincident points
+            floor = 1e-6 * float((high - low).max())
+            for t in range(len(tiles)):
+                interior, indices = read_tile(work_dir, t, "interior")
+                if (interior.shape[0] == 0):
+                    continue
+                # against the whole cloud, a sparse tile alone would cut the k-NN
+                radius = halo_margin * tile_radii(work_dir, cuts, interior, n, n_degree, floor)
+                covered = np.quantile(radius, HALO_QUANTILE)
+                halo[t] = steps * covered
+                # the first step from a wide point reaches its own radius
+                outside = radius > covered
+                wide.append(interior[outside])
+                reach.append(radius[outside] + (steps - 1) * covered)
+                wide_tiles.append(np.full(np.count_nonzero(outside), t, dtype=np.int64))
+        halo = np.broadcast_to(np.asarray(halo, dtype=float), (len(tiles),))
+        bucket_points(points, cuts, work_dir, "halo", halo)
+
+        # a wide point also feeds the later iterations of the tiles whose
+        # points (or wide points) reach it in fewer steps
+        wide, reach = np.concatenate(wide), np.concatenate(reach)
+        own = np.concatenate(wide_tiles)
+        if (wide.shape[0] > 0):
+            wide_tree = cKDTree(wide)
+            wide_index, wide_tiles = [], []
+            for t, (lower, upper) in enumerate(tiles):
+                width = halo[t] * (1.0 - 1.0 / max(iterations, 1))
+                assigned = np.flatnonzero((own == t) | np.all((wide >= lower - width) &
+                                                              (wide < upper + width), axis=1))
+                frontier = assigned
+                for step in range(max(iterations, 1) - 1):
+                    if (frontier.shape[0] == 0):
+                        break
+                    lists = wide_tree.query_ball_point(wide[frontier], reach[frontier])
+                    frontier = np.setdiff1d(np.fromiter((i for l in lists for i in l),
+                                                        dtype=np.intp), assigned)
+                    assigned = np.union1d(assigned, frontier)
+                wide_index.append(assigned)
+                wide_tiles.append(np.full(assigned.shape[0], t, dtype=np.int64))
+            wide_index = np.concatenate(wide_index)
+            bucket_wide(points, work_dir, wide[wide_index], reach[wide_index],
+                        np.concatenate(wide_tiles))
+
+        result = np.lib.format.open_memmap(os.path.join(work_dir, "result.npy"), mode='w+',
+                                           dtype=float, shape=(n, 3))
+        for t in range(len(tiles)):
+            interior, indices = read_tile(work_dir, t, "interior")
+            if (interior.shape[0] == 0):
+                continue
+            border, border_indices = read_tile(work_dir, t, "halo")
+            # the neighbors of wide points may lie inside the tile itself
+            border = border[~np.isin(border_indices, indices)]
+            print("Tile: %d (%d points, %d in the halo)" % (t, interior.shape[0],
+                                                          border.shape[0]))
+            moved = denoise(np.concatenate((interior, border)))
+            result[indices] = moved[:interior.shape[0]]
+        result.flush()
+
+        write_xyz(save_filename, result)
+        del result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,300 @@
+'''
+    Multi-process Bilateral Mesh Denoising
+
+    Every vertex update of the bilateral algorithm only depends on a local
+    neighborhood, so the cloud can be split into spatial tiles that are denoised
+    by separate processes:
+
+        - The bounding box of the cloud is cut into a grid of tiles. Each point
+            belongs to exactly one tile (its interior), and every tile also
+            reads the points within a halo margin around it.
+        - Before every iteration the points are bucketed into the tiles (one
+            sort by tile number), so a worker finds the points of any box by
+            looking at the few tiles it overlaps instead of the whole cloud.
+        - Every point has a neighborhood radius: the k-NN radius used by the
+            "kdtree" neighborhood mode or its 2 * sigma_c search, whichever is
+            larger (times a safety margin). Each worker computes the radii of
+            its interior points at their current positions, from the points
+            of a box around them that grows until it holds their k-NN.
+        - The halo of a tile covers the radii of almost all of its interior
+            points (HALO_QUANTILE), and the few points with wider radii
+            (outliers) add the points within their own radius, found with one
+            k-d tree query. With it, an interior point sees the same neighbors
+            as in a run on the whole cloud, and an outlier never widens a halo.
+        - The points are kept in two shared memory blocks, the current and the
+            next positions (plus a block of the point indices sorted by tile),
+            so the workers read and write them directly instead of receiving
+            pickled copies (pool workers share the resource tracker of this
+            process, which removes the blocks at the end). Each iteration is
+            one map over the tiles, which acts as the barrier before the blocks
+            are swapped.
+
+    The results match the serial batch engine in "kdtree" mode.
+'''
+from multiprocessing import Pool
+from multiprocessing import shared_memory
+from scipy.spatial import cKDTree
+import numpy as np
+import os
+from BilateralMeshDenoising import bilateral_iteration_batch
+from BilateralMeshDenoising import knn_size
+
+# fraction of the interior points of a tile whose radius the halo covers, the
+# points within the radius of the others are added one by one
+HALO_QUANTILE = 0.99
+
+'''
+Function:   tile_grid
+Use:        cut the bounding box of the points into a grid of about num_tiles tiles
+Parameters...
+points: array of the point positions
+num_tiles: number of tiles wanted
+
+Returns a list of (lower, upper) corners, the outer tiles are unbounded so
+every point is inside exactly one tile.
+'''
+def tile_grid(points, num_tiles):
+    low = points.min(axis=0)
+    extent = points.max(axis=0) - low
+    counts = np.ones(3, dtype=int)
+    # keep halving the longest tile side
+    while (counts.prod() < num_tiles):
+        counts[np.argmax(extent / counts)] *= 2
+
+    cuts = [low[a] + extent[a] * np.arange(1, counts[a]) / counts[a] for a in range(3)]
+    bounds = [np.concatenate(([-np.inf], c, [np.inf])) for c in cuts]
+
+    tiles = []
+    for i in range(counts[0]):
+        for j in range(counts[1]):
+            for k in range(counts[2]):
+                lower = np.array([bounds[0][i], bounds[1][j], bounds[2][k]])
+                upper = np.array([bounds[0][i+1], bounds[1][j+1], bounds[2][k+1]])
+                tiles.append((lower, upper))
+    return tiles
+
+
+'''
+Function:   tile_cuts
+Use:        the inner boundaries along each axis of the tiles from tile_grid
+'''
+def tile_cuts(tiles):
+    lower = np.array([t[0] for t in tiles])
+    return [np.unique(lower[:, a])[1:] for a in range(3)]
+
+
+'''
+Function:   tile_numbers
+Use:        number of the tile of every point, in the order of tile_grid
+Parameters...
+points: array of the point positions
+cuts: inner tile boundaries along each axis, from tile_cuts
+'''
+def tile_numbers(points, cuts):
+    counts = [c.shape[0] + 1 for c in cuts]
+    own = [np.searchsorted(cuts[a], points[:, a], side='right') for a in range(3)]
+    return (own[0] * counts[1] + own[1]) * counts[2] + own[2]
+
+
+'''
+Function:   box_points
+Use:        indices of the points inside a box, from the points bucketed by tile
+Parameters...
+points: array of the point positions
+order: point indices sorted by tile number
+starts: start of every tile in order (plus the end)
+cuts: inner tile boundaries along each axis
+lower, upper: corners of the box
+'''
+def box_points(points, order, starts, cuts, lower, upper):
+    counts = [c.shape[0] + 1 for c in cuts]
+    first = [int(np.searchsorted(cuts[a], lower[a], side='right')) for a in range(3)]
+    last = [int(np.searchsorted(cuts[a], upper[a], side='right')) for a in range(3)]
+    slices = [order[starts[t]:starts[t + 1]]
+              for i in range(first[0], last[0] + 1)
+              for j in range(first[1], last[1] + 1)
+              for t in range((i * counts[1] + j) * counts[2] + first[2],
+                             (i * counts[1] + j) * counts[2] + last[2] + 1)]
+    candidates = np.concatenate(slices)
+    inside = np.all((points[candidates] >= lower) & (points[candidates] <= upper), axis=1)
+    return np.sort(candidates[inside])
+
+
+'''
+Function:   knn_radii
+Use:        neighborhood radius of every point from its k-NN distances, see
+            neighborhood_radii
+'''
+def knn_radii(dist):
+    gaps = np.where(dist > 0, dist, np.inf).min(axis=1)
+    gaps[np.isinf(gaps)] = 1e10
+    return np.maximum(dist[:, -1], 2 * gaps)
+
+
+'''
+Function:   neighborhood_radii
+Use:        distance within which every point finds all its neighbors
+Parameters...
+points: array of the point positions
+n_degree: how many levels of neighbors to include in normal calculations
+
+Returns the radius of every point: its k-NN radius or its 2 * sigma_c ball
+(sigma_c being the smallest positive k-NN distance), whichever is larger.
+'''
+def neighborhood_radii(points, n_degree):
+    k = min(knn_size(n_degree), points.shape[0])
+    dist = cKDTree(points).query(points, k=k, workers=-1)[0]
+    return knn_radii(dist.reshape(points.shape[0], k))
+
+
+'''
+Function:   tile_radii
+Use:        neighborhood radii of the interior points of a tile, from the
+            points of a box around them that grows until it holds their k-NN
+Parameters...
+points: array of the point positions
+interior: indices of the interior points
+grid: (order, starts, cuts) of the points bucketed by tile, see box_points
+n_degree: how many levels of neighbors to include in normal calculations
+reach: smallest distance the box is grown by at first
+'''
+def tile_radii(points, interior, grid, n_degree, reach):
+    inner = points[interior]
+    k = min(knn_size(n_degree), points.shape[0])
+    # about the k-NN radius of points spread evenly over a surface patch
+    reach = max(reach, float(np.ptp(inner, axis=0).max()) * np.sqrt(k / float(inner.shape[0])))
+
+    radius = np.empty(inner.shape[0], dtype=points.dtype)
+    pending = np.arange(inner.shape[0])
+    while (pending.shape[0] > 0):
+        centers = inner[pending]
+        lower = centers.min(axis=0) - reach
+        upper = centers.max(axis=0) + reach
+        candidates = box_points(points, *grid, lower, upper)
+        dist = cKDTree(points[candidates]).query(centers, k=k)[0].reshape(-1, k)
+
+        # the k-NN are exact once they are closer than the sides of the box
+        edge = np.minimum(centers - lower, upper - centers).min(axis=1)
+        done = dist[:, -1] <= edge
+        if (candidates.shape[0] == points.shape[0]):
+            done[:] = True
+        radius[pending[done]] = knn_radii(dist[done])
+        pending = pending[~done]
+        reach *= 2
+    return radius
+
+
+'''
+Function:   tile_iteration
+Use:        worker task, run one iteration for the interior points of a tile
+Parameters...
+task: tuple of (current block name, next block name, order block name, shape,
+      dtype, tile starts, tile cuts, tile number, n_degree, halo margin,
+      smallest reach of the radius search)
+
+The halo covers the radii (margin included) of HALO_QUANTILE of the interior
+points, the points within the radius of the others are added to the region.
+'''
+def tile_iteration(task):
+    (current_name, next_name, order_name, shape, dtype, starts, cuts, tile,
+     n_degree, margin, reach) = task
+    current_block = shared_memory.SharedMemory(name=current_name)
+    next_block = shared_memory.SharedMemory(name=next_name)
+    order_block = shared_memory.SharedMemory(name=order_name)
+    try:
+        points = np.ndarray(shape, dtype=dtype, buffer=current_block.buf)
+        new_points = np.ndarray(shape, dtype=dtype, buffer=next_block.buf)
+        order = np.ndarray(shape[:1], dtype=np.int64, buffer=order_block.buf)
+        grid = (order, starts, cuts)
+
+        interior = order[starts[tile]:starts[tile + 1]]
+        count = interior.shape[0]
+        if (count > 0):
+            inner = points[interior]
+            radius = margin * tile_radii(points, interior, grid, n_degree, reach)
+            halo = np.quantile(radius, HALO_QUANTILE)
+            region = box_points(points, *grid, inner.min(axis=0) - halo,
+                                inner.max(axis=0) + halo)
+
+            wide = radius > halo
+            if (np.any(wide)):
+                centers, widths = inner[wide], radius[wide]
+                candidates = box_points(points, *grid, (centers - widths[:, None]).min(axis=0),
+                                        (centers + widths[:, None]).max(axis=0))
+                lists = cKDTree(points[candidates]).query_ball_point(centers, widths)
+                hits = np.fromiter((i for l in lists for i in l), dtype=np.intp)
+                region = np.union1d(region, candidates[hits])
+
+            moved = bilateral_iteration_batch(points[region], None, n_degree, "kdtree")
+            new_points[interior] = moved[np.searchsorted(region, interior)]
+            del inner
+        del points, new_points, order, grid, interior
+    finally:
+        current_block.close()
+        next_block.close()
+        order_block.close()
+    return count
+
+
+'''
+Function:   parallel_bilateral_denoise
+Use:        run the denoising iterations on spatial tiles in a process pool
+Parameters...
+points: array of point positions
+iterations: how many times to smooth the mesh
+n_degree: how many levels of neighbors to include in normal calculations
+processes: number of worker processes, all cores if not given
+num_tiles: number of tiles, a few per process if not given
+halo_margin: factor applied to the neighborhood radii for the halos
+
+The points are denoised in their own precision, float32 or float64 (anything
+else is converted to float64).
+'''
+def parallel_bilateral_denoise(points, iterations, n_degree, processes=None,
+                               num_tiles=None, halo_margin=1.5):
+    points = np.asarray(points)
+    if (points.dtype != np.float32):
+        points = points.astype(float, copy=False)
+    shape = points.shape
+    dtype = points.dtype
+
+    blocks = [shared_memory.SharedMemory(create=True, size=max(points.nbytes, 1))
+              for i in range(2)]
+    order_block = shared_memory.SharedMemory(create=True, size=max(8 * shape[0], 1))
+    try:
+        current = np.ndarray(shape, dtype=dtype, buffer=blocks[0].buf)
+        current[:] = points
+        del current
+
+        if (processes is None):
+            processes = os.cpu_count() or 1
+        if (num_tiles is None):
+            num_tiles = 4 * processes
+
+        with Pool(processes) as pool:
+            for i in range(iterations):
+                print("Iteration: " + str(i))
+                current = np.ndarray(shape, dtype=dtype, buffer=blocks[0].buf)
+                tiles = tile_grid(current, num_tiles)
+                cuts = tile_cuts(tiles)
+                numbers = tile_numbers(current, cuts)
+                order = np.ndarray(shape[:1], dtype=np.int64, buffer=order_block.buf)
+                order[:] = np.argsort(numbers, kind='stable')
+                starts = np.searchsorted(numbers[order], np.arange(len(tiles) + 1))
+                # a floor for the radius search, for tiles of coincident points
+                reach = 1e-6 * float(np.ptp(current, axis=0).max())
+                del current, order, numbers
+                tasks = [(blocks[0].name, blocks[1].name, order_block.name, shape, dtype.str,
+                          starts, cuts, t, n_degree, halo_margin, reach)
+                         for t in range(len(tiles))]
+                # every tile is done before the next iteration starts
+                pool.map(tile_iteration, tasks)
+                blocks.reverse()
+
+        result = np.ndarray(shape, dtype=dtype, buffer=blocks[0].buf).copy()
+    finally:
+        for block in blocks + [order_block]:
+            block.close()
+            block.unlink()
+
+    return result
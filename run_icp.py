@@ -1,6 +1,8 @@
-from ICPEval import *
+from evaluation import THRESHOLD
+from evaluation import evaluate_files
+from evaluation import print_scores
 
-# from ICPEval import load_xyz, icp_eval, draw_registration_result, paint, metrics_eval, p2p_icp, p2l_icp, init_para
+# the open3d version, with its drawing helpers, is in ICPEval.py
 
 '''
 Function:   run_icp
@@ -18,10 +20,9 @@ def run_icp(testing):
         f1 = input("xyz filename 1: ")
         f2 = input("xyz filename 2: ")
 
-    # files must be in xyz format
-    source, target = load_xyz(f1, f2)
-    threshold, trans_init = init_para()
-    icp_eval(source, target, threshold, trans_init)
+    # files must be in xyz format, the first is aligned to the second
+    for scores in evaluate_files(f2, [f1], THRESHOLD, icp=True):
+        print_scores(scores)
 
 '''
 Function:   main()
@@ -1,13 +1,234 @@
 from scipy.spatial import Delaunay
 import numpy as np
 import math
+import json
+import os
 import subprocess
-from cloud_to_gts import input_triangulation
+import sys
+import instrumentation
+from cloud_to_gts import MESH_EXTENSIONS
+from cloud_to_gts import load_triangulation
 from cloud_to_gts import gts_write
-from cloud_to_gts import gts_to_cloud
+from cloud_to_gts import mesh_faces
+from cloud_to_gts import mesh_to_cloud
+from cloud_to_gts import triangulate
+from cloud_to_gts import write_mesh
+from cloud_io import load_xyz_points
+from cloud_io import precision_dtype
+from cloud_io import write_xyz
+from non_iterative_smoothing import non_iterative_smooth
+from smoother_library import STAT_NAMES
+from smoother_library import library_smooth
 
+# whether each smoother program accepts binary meshes, see smoother_accepts_binary
+_binary_support = {}
 
-def run_non_iterative(testing):
+'''
+Function:   smoother_program
+Use:        path of the compiled smoother program for this system
+'''
+def smoother_program():
+    if (sys.platform == "darwin"):
+        return "./smoother_mac"
+    return "./smoother"
+
+
+'''
+Function:   smoother_accepts_binary
+Use:        whether a smoother program accepts binary meshes (-b), probed once
+            per program
+Parameters...
+program: path of the smoother program, see smoother_program
+
+Smoothers built before the binary format reject -b by printing their usage
+(without "[-b]") and exiting with 255. Any other result counts as accepted,
+so that a program that fails for another reason fails on the real run.
+'''
+def smoother_accepts_binary(program):
+    if (program not in _binary_support):
+        try:
+            done = subprocess.run([program, "1", "1", "1", "-b"], stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            rejected = (done.returncode == 255 and done.stderr.startswith(b"Usage") and
+                        b"[-b]" not in done.stderr)
+        except OSError:
+            rejected = False
+        _binary_support[program] = not rejected
+    return _binary_support[program]
+
+
+'''
+Function:   read_smoother_stats
+Use:        read the counters from the trailer of a mesh file (binary or GTS)
+            written by the smoother program, None if there is no trailer
+'''
+def read_smoother_stats(filename):
+    with open(filename, 'rb') as f:
+        # the trailer is the last line
+        f.seek(max(os.path.getsize(filename) - 4096, 0))
+        for line in reversed(f.read().decode(errors="replace").splitlines()):
+            if (line.startswith("# nifp_stats ")):
+                return json.loads(line[len("# nifp_stats "):])
+    return None
+
+
+'''
+Function:   smooth_mesh
+Use:        smooth triangulated points in process
+Parameters...
+points: (n, 3) array of the points
+tri: their triangulation
+sigma_f, sigma_g, dist_mode: see non_iterative_smoothing.non_iterative_smooth
+engine: "numpy" or "library", see smooth_file
+
+Returns (new_points, vertices): the smoothed points and the indices of the
+vertices of the surface.
+'''
+def smooth_mesh(points, tri, sigma_f, sigma_g, dist_mode, engine="numpy"):
+    faces = mesh_faces(tri, points.shape[0])
+    with instrumentation.stage("smoother"):
+        if (engine == "numpy"):
+            return non_iterative_smooth(points, faces, sigma_f, sigma_g, dist_mode)
+        new_points = library_smooth(points, faces, sigma_f, sigma_g, dist_mode)
+        return new_points, np.unique(faces)
+
+
+'''
+Function:   multires_file
+Use:        smooth the coarsest voxel level of a .xyz file and carry the
+            displacements of its surface vertices back onto every point
+Parameters...
+filename: the input .xyz file
+out_xyz: the output .xyz file, with every point of the input
+sigma_f, sigma_g, dist_mode: see non_iterative_smoothing.non_iterative_smooth
+subsample_rate: reduction factor of the coarsest level
+engine: "numpy" or "library", see smooth_file
+mesher, cache, precision: see cloud_to_gts.load_triangulation
+refine_levels: how many finer levels are smoothed again, on a local surface
+               mesh (surface_mesher.py) so they need no Delaunay triangulation
+'''
+def multires_file(filename, out_xyz, sigma_f, sigma_g, dist_mode, subsample_rate=5,
+                  engine="numpy", mesher="delaunay", cache=True, precision="double",
+                  refine_levels=0):
+    from multiresolution import multires_denoise
+    if (engine not in ("numpy", "library")):
+        raise ValueError("Multi-resolution smoothing needs the numpy or library engine")
+
+    with instrumentation.stage("load"):
+        points = load_xyz_points(filename, precision_dtype(precision))
+
+    def denoise(level):
+        return smooth_mesh(level, triangulate(level, mesher, cache), sigma_f, sigma_g,
+                           dist_mode, engine)
+
+    def refine(level):
+        return smooth_mesh(level, triangulate(level, "local"), sigma_f, sigma_g,
+                           dist_mode, engine)
+
+    points = multires_denoise(points, denoise, subsample_rate, refine_levels, refine)
+
+    with instrumentation.stage("write"):
+        write_xyz(out_xyz, points)
+
+
+'''
+Function:   smooth_file
+Use:        run the algorithm on a .xyz file without any prompts
+Parameters...
+filename: the input .xyz file
+out_xyz: the output .xyz file
+arg1: sigma_f, the spatial parameter
+arg2: sigma_g, the influence parameter
+dist_mode: 1 for gaussian, 2 for exponential, 3 for gamma
+subsample_rate: subsampling rate, 0 for none
+engine: "numpy" (default) to smooth in process, "library" to call the compiled
+        smoother library on the arrays, "binary" to run the compiled smoother
+        program on a mesh file
+mesher: "delaunay" (default) or "local", see cloud_to_gts.load_triangulation
+subsampling: "stride" (default), "voxel" or "poisson", see
+             cloud_to_gts.load_triangulation, or "multires" to smooth a voxel
+             level reduced by subsample_rate and interpolate the displacements
+             back onto every point ("numpy" and "library" engines), see
+             multiresolution.py
+gts_in: for the "binary" engine, the mesh file passed to the smoother
+        (bunny_mesh with the extension of the format if not given)
+gts_out: for the "binary" engine, the mesh file written by the smoother
+         (bunny_smooth with the extension of the format if not given)
+cache: reuse earlier Delaunay triangulations, see cloud_to_gts.load_triangulation
+precision: "double" (default) or "single" to smooth float32 points with the
+           "numpy" engine (and to pass float coordinates in binary meshes)
+mesh_format: for the "binary" engine, "gts" (default) to pass the mesh as GTS
+             text, "binary" for the binary format of cloud_to_gts.write_mesh
+             (GTS text is used instead if the smoother program does not
+             accept binary meshes)
+refine_levels: with "multires" subsampling, how many finer levels are smoothed
+               again on a local surface mesh after the coarse run
+'''
+def smooth_file(filename, out_xyz, arg1="1", arg2="1", dist_mode="1", subsample_rate=5,
+                engine="numpy", mesher="delaunay", subsampling="stride",
+                gts_in=None, gts_out=None, cache=True, precision="double",
+                mesh_format="gts", refine_levels=0):
+    if (mesh_format not in MESH_EXTENSIONS):
+        raise ValueError("Unknown mesh format: " + str(mesh_format))
+
+    if (subsampling == "multires"):
+        multires_file(filename, out_xyz, float(arg1), float(arg2), int(dist_mode),
+                      subsample_rate, engine, mesher, cache, precision, refine_levels)
+        return
+
+    tri, points = load_triangulation(filename, subsample_rate, mesher, subsampling, cache,
+                                     precision)
+
+    if (engine in ("numpy", "library")):
+        new_points, vertices = smooth_mesh(points, tri, float(arg1), float(arg2),
+                                           int(dist_mode), engine)
+
+        # like the smoother output, only the vertices of the surface are kept
+        with instrumentation.stage("write"):
+            write_xyz(out_xyz, new_points[vertices])
+        return
+
+    if (engine != "binary"):
+        raise ValueError("Unknown engine: " + str(engine))
+
+    gts_in = gts_in or "bunny_mesh" + MESH_EXTENSIONS[mesh_format]
+    gts_out = gts_out or "bunny_smooth" + MESH_EXTENSIONS[mesh_format]
+    command = [smoother_program(), str(arg1), str(arg2), str(dist_mode)]
+    if (mesh_format == "binary" and not smoother_accepts_binary(command[0])):
+        print("The smoother does not accept binary meshes, using GTS text")
+        mesh_format = "gts"
+        gts_in = os.path.splitext(gts_in)[0] + MESH_EXTENSIONS["gts"]
+        gts_out = os.path.splitext(gts_out)[0] + MESH_EXTENSIONS["gts"]
+    if (mesh_format == "binary"):
+        in_file = write_mesh(tri, points, gts_in)
+        command.append("-b")
+    else:
+        in_file = gts_write(tri, points, True, gts_in)
+
+    with instrumentation.stage("smoother"), open(in_file, 'rb') as f:
+        with open(gts_out, 'wb') as o:
+            done = subprocess.run(command, stdin=f, stdout=o)
+    if (done.returncode != 0):
+        raise subprocess.CalledProcessError(done.returncode, done.args)
+
+    if (instrumentation.enabled):
+        stats = read_smoother_stats(gts_out) or {}
+        for name in STAT_NAMES:
+            instrumentation.count(name, stats.get(name, 0))
+
+    with instrumentation.stage("write"):
+        mesh_to_cloud(gts_out, out_xyz)
+
+
+'''
+Function:   run_non_iterative
+Use:        to execute this algorithm from another script
+Parameters...
+testing: use the bunny defaults instead of prompting for parameters
+engine, mesher, subsampling, mesh_format: see smooth_file
+'''
+def run_non_iterative(testing, engine="numpy", mesher="delaunay", subsampling="stride",
+                      mesh_format="gts"):
     
     print("***************************************")
     print("Running Non Iterative Mesh Smoothing...")
@@ -16,6 +237,11 @@ def run_non_iterative(testing):
     arg1 = "1"
     arg2 = "1"
     dist_mode = "1"
+    filename = "bunny.xyz"
+    subsample_rate = 5
+    gts_in = "bunny_mesh" + MESH_EXTENSIONS.get(mesh_format, ".gts")
+    gts_out = "bunny_smooth" + MESH_EXTENSIONS.get(mesh_format, ".gts")
+    out_xyz = "bunny_nims_smoothed.xyz"
 
     if (not testing):
         print()
@@ -29,33 +255,15 @@ def run_non_iterative(testing):
         arg1 = input("sigma_f: ")
         arg2 = input("sigma_g: ")
 
-    tri, points = input_triangulation(testing)
-    gts_in = gts_write(tri, points, testing)
-
-    in_file = gts_in
+        filename = input("Input file name: ")
+        subsample_rate = int(input("Subsampling rate (0 for none): "))
 
-    out_file = "bunny_smooth.gts" 
-    if (not testing):
-        out_file = input("Smoothed GTS filename: ")
-
-    with open(in_file, 'r') as f:
-        with open(out_file, 'w') as o:
-            system_id = 0
-            print()
-            print("******** Select System *******")
-            print("1: Linux")
-            print("2: MacOS")
-            print("******************************")
-            system_id = int(input("Selection:  "))
-            print()
-            if (system_id == 2):
-                subprocess.run(["./smoother_mac", arg1, arg2, dist_mode], stdin=f, stdout=o) 
-            if (system_id == 1):
-                subprocess.run(["./smoother", arg1, arg2, dist_mode], stdin=f, stdout=o)
+        # the mesh files are only used by the compiled smoother program
+        if (engine == "binary"):
+            gts_in = input("Initial mesh filename: ")
+            gts_out = input("Smoothed mesh filename: ")
 
-    out_xyz = "bunny_nims_smoothed.xyz"
-    if (not testing):
         out_xyz = input("Output .xyz filename: ")
 
-    gts_to_cloud(out_file, out_xyz)
-
+    smooth_file(filename, out_xyz, arg1, arg2, dist_mode, subsample_rate, engine,
+                mesher, subsampling, gts_in, gts_out, mesh_format=mesh_format)
@@ -1,7 +1,9 @@
 #include <gts.h>
 #include <math.h>
 #include <time.h>
+#include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 
 ///////////////// NON ITERATIVE FEATURE PRESERVING MESH SMOOTHING /////////////////////////
 //
@@ -35,6 +37,20 @@
 //
 //	dist_mode:		The distribution function chosen. This determines which
 //				function is used to weight the modifications.
+//
+//	mollify_count:		Vertices mollified so far, for the status bar.
+//
+//	filter_count:		Vertices filtered so far, for the status bar.
+//
+//	verbose:		Whether to print statistics and status bars on stderr.
+//				Only the command line program does, library calls are quiet.
+//
+//	node_count:		Bounding box tree nodes visited by the last smoothing.
+//
+//	neighbor_count:		Triangles within the cutoff of a vertex, summed over the
+//				vertices of the last smoothing.
+//
+//	smooth_seconds:		Processor time taken by the last smoothing.
 
 
 static GHashTable *mollified_hash, *new_position_hash;
@@ -42,6 +58,41 @@ static gint num_verts;
 static GNode *tree;
 static gdouble sigma_f, sigma_g, sigma_m, cutoff;
 static int dist_mode;
+static gint mollify_count, filter_count;
+static gboolean verbose = FALSE;
+static long node_count, neighbor_count;
+static double smooth_seconds;
+
+
+///////////////////////// Binary Mesh Format //////////////////////////
+//
+//	The alternative to GTS text shared with cloud_to_gts.py (write_mesh
+//	and read_mesh). A 32 byte header:
+//
+//	magic:			"NMSH"
+//	version:		MESH_VERSION
+//	coordinate_size:	4 for float, 8 for double coordinates
+//	num_vertices, num_edges, num_faces
+//	reserved:		two zero words, the blocks start 8 byte aligned
+//
+//	followed by the vertex coordinates (num_vertices * 3), the edges
+//	(num_edges * 2 vertex indices) and the faces (num_faces * 3 edge
+//	indices, in the order of the edges of a GTS face). The indices are
+//	int32 starting at 0, and everything is little-endian, the byte order
+//	of the systems the smoother is built for.
+
+#define MESH_MAGIC "NMSH"
+#define MESH_VERSION 1
+
+typedef struct {
+  char magic[4];
+  guint32 version;
+  guint32 coordinate_size;
+  guint32 num_vertices;
+  guint32 num_edges;
+  guint32 num_faces;
+  guint32 reserved[2];
+} MeshHeader;
 
 
 ////////////////////////////////////////////////////////////////////
@@ -238,6 +289,8 @@ filter(GtsVertex *cur_vert, GtsVertex *weighted_pos, gdouble *k,
 {
   gdouble dmin, dmax;
 
+  node_count++;
+
   // calculate min and max distances 
   gts_bbox_point_distance2(GTS_BBOX(tree->data), GTS_POINT(cur_vert),
                            &dmin, &dmax);
@@ -252,6 +305,8 @@ filter(GtsVertex *cur_vert, GtsVertex *weighted_pos, gdouble *k,
     gdouble w = 0.0;
     gdouble area;
 
+    neighbor_count++;
+
     area = gts_triangle_area(t);
 
     gts_triangle_vertices(t, &v1, &v2, &v3);
@@ -346,12 +401,11 @@ mollify_vertex(gpointer item, gpointer data)
   gdouble k;
 
   // vertex counter
-  static gint vnum = 0;
+  gint vnum = ++mollify_count;
   gint i;
 
   // status bar 
-  vnum++;
-  if (!(vnum % 1000)) {
+  if (verbose && !(vnum % 1000)) {
     fprintf(stderr, "Mollifying:[");
     for(i = 0; i < (65 * vnum) / num_verts; i++) 
       fprintf(stderr, "#");
@@ -359,7 +413,7 @@ mollify_vertex(gpointer item, gpointer data)
       fprintf(stderr, " ");
     fprintf(stderr, "]\r");
   }
-  if (vnum == num_verts) fprintf(stderr, "\n");
+  if (verbose && vnum == num_verts) fprintf(stderr, "\n");
 
   new_pos = gts_vertex_new(gts_vertex_class(),
                            0.0, 0.0, 0.0);
@@ -403,12 +457,11 @@ filter_vertex(gpointer item, gpointer data)
   gdouble k;
 
   // vertex counter
-  static gint vnum = 0;
+  gint vnum = ++filter_count;
   gint i;
 
   // status bar 
-  vnum++;
-  if (!(vnum % 1000)) {
+  if (verbose && !(vnum % 1000)) {
     fprintf(stderr, "Moving:[");
     for(i = 0; i < (65 * vnum) / num_verts; i++) 
       fprintf(stderr, "#");
@@ -416,7 +469,7 @@ filter_vertex(gpointer item, gpointer data)
       fprintf(stderr, " ");
     fprintf(stderr, "]\r");
   }
-  if (vnum == num_verts) fprintf(stderr, "\n");
+  if (verbose && vnum == num_verts) fprintf(stderr, "\n");
 
   new_pos = gts_vertex_new(gts_vertex_class(),
                            0.0, 0.0, 0.0);
@@ -456,45 +509,55 @@ move_vertex(gpointer item, gpointer data)
   return (0);
 }
 
-int main (int argc, char * argv[])
-{
-  GtsFile *fp;
-  GtsSurface *s;
-  GtsSurfaceQualityStats qstats;
-  time_t start;
-  GSList *trilist = NULL;
+////////////////////////////////////////////////////////////////////
+//
+//	Name:	destroy_position
+//
+//	Use:	free a vertex stored as a value of the position hashes
+//
+//	Parameters...
+//	key:	original vertex
+//
+//	value:	vertex holding the stored position
 
+void
+destroy_position(gpointer key, gpointer value, gpointer data)
+{
+  gts_object_destroy(GTS_OBJECT(value));
+}
 
-  // Error message for wrong usage
-  if (argc != 4) {
-    fprintf(stderr, "Usage %s sigma_f sigma_g dist_mode < in.gts > out.gts\n",
-            argv[0]);
-    exit (-1);
-  }
+////////////////////////////////////////////////////////////////////
+//
+//	Name:	smooth_surface
+//
+//	Use:	run the whole smoothing algorithm on a surface, moving
+//		its vertices in place
+//
+//	Parameters...
+//	s:		surface to smooth
+//
+//	spatial:	sigma_f, in units of the mean edge length
+//
+//	influence:	sigma_g, in units of the mean edge length
+//
+//	mode:		distribution function (1 gaussian, 2 exponential, 3 gamma)
 
-  // read surface in 
-  s = gts_surface_new (gts_surface_class (),
-		       gts_face_class (),
-		       gts_edge_class (),
-		       gts_vertex_class ());
-  fp = gts_file_new (stdin);
-  if (gts_surface_read (s, fp)) {
-    fprintf(stderr, "input not a valid GTS file\n");
-    return 1; // failure 
-  }
+void
+smooth_surface(GtsSurface *s, gdouble spatial, gdouble influence, int mode)
+{
+  GtsSurfaceQualityStats qstats;
+  GSList *trilist = NULL;
+  clock_t start = clock();
 
   gts_surface_quality_stats(s, &qstats);
-  gts_surface_print_stats(s, stderr);
+  if (verbose)
+    gts_surface_print_stats(s, stderr);
 
-  // read command line arguments
-  sigma_f = atof(argv[1]);
-  sigma_g = atof(argv[2]);
-  dist_mode = atof(argv[3]);
-  //printf("# sigma_f %f   sigma_g %f\n", sigma_f, sigma_g);
+  dist_mode = mode;
 
   // scale by mean edge length
-  sigma_f *= qstats.edge_length.mean;
-  sigma_g *= qstats.edge_length.mean;
+  sigma_f = spatial * qstats.edge_length.mean;
+  sigma_g = influence * qstats.edge_length.mean;
 
   cutoff = 2.0 * sigma_f;
   sigma_m = sigma_f / 2.0;
@@ -509,8 +572,11 @@ int main (int argc, char * argv[])
   mollified_hash = g_hash_table_new(NULL, NULL);
   new_position_hash = g_hash_table_new(NULL, NULL);
   num_verts = gts_surface_vertex_number(s);
+  mollify_count = 0;
+  filter_count = 0;
+  node_count = 0;
+  neighbor_count = 0;
 
-  start = time(NULL);
   // generate 'mollified' normals
   gts_surface_foreach_vertex(s, mollify_vertex, NULL);
   // calculate changes based on 'mollified' normals
@@ -518,10 +584,484 @@ int main (int argc, char * argv[])
   // shift all points 
   gts_surface_foreach_vertex(s, move_vertex, NULL);
 
-  //printf("# time taken: %d secs\n", (guint) (time(NULL) - start));
+  // free everything so the library can be called again
+  g_hash_table_foreach(mollified_hash, destroy_position, NULL);
+  g_hash_table_foreach(new_position_hash, destroy_position, NULL);
+  g_hash_table_destroy(mollified_hash);
+  g_hash_table_destroy(new_position_hash);
+  gts_bb_tree_destroy(tree, TRUE);
+  g_slist_free(trilist);
+
+  smooth_seconds = (double) (clock() - start) / CLOCKS_PER_SEC;
+}
+
+////////////////////////////////////////////////////////////////////
+//
+//	Name:	nifp_stats
+//
+//	Use:	Shared library entry point. Reports the counters of the
+//		last smoothing, the same ones the command line program
+//		writes in its trailer.
+//
+//	Parameters...
+//	out:	4 values: vertices processed (mollified and filtered),
+//		neighbor triangles visited, tree nodes visited and the
+//		processor seconds taken
+
+void
+nifp_stats(double *out)
+{
+  out[0] = mollify_count + filter_count;
+  out[1] = neighbor_count;
+  out[2] = node_count;
+  out[3] = smooth_seconds;
+}
+
+////////////////////////////////////////////////////////////////////
+//
+//	Name:	connecting_edge
+//
+//	Use:	return the edge between two vertices, creating it if the
+//		vertices are not connected yet so faces share their edges
+//
+//	Parameters...
+//	v1, v2:	the two vertices
+
+GtsEdge *
+connecting_edge(GtsVertex *v1, GtsVertex *v2)
+{
+  GtsSegment *segment = gts_vertices_are_connected(v1, v2);
+
+  if (segment != NULL && GTS_IS_EDGE(segment))
+    return GTS_EDGE(segment);
+  return gts_edge_new(gts_edge_class(), v1, v2);
+}
+
+////////////////////////////////////////////////////////////////////
+//
+//	Name:	nifp_smooth
+//
+//	Use:	Shared library entry point. Smooths the mesh given by
+//		plain arrays and writes the new vertex positions into a
+//		buffer supplied by the caller, so no GTS text is involved.
+//		Vertices that are not part of any face are copied as they are.
+//
+//	Parameters...
+//	vertices:	n_vertices * 3 coordinates (x, y, z of each vertex)
+//
+//	faces:		n_faces * 3 vertex indices (starting at 0)
+//
+//	spatial:	sigma_f, in units of the mean edge length
+//
+//	influence:	sigma_g, in units of the mean edge length
+//
+//	mode:		distribution function (1 gaussian, 2 exponential, 3 gamma)
+//
+//	out:		n_vertices * 3 coordinates for the result, may be the
+//			same buffer as vertices
+//
+//	Returns 0 on success, -1 if a face refers to a missing vertex.
+
+int
+nifp_smooth(const double *vertices, int n_vertices,
+            const int *faces, int n_faces,
+            double spatial, double influence, int mode,
+            double *out)
+{
+  GtsSurface *s;
+  GtsVertex **verts;
+  gint i;
+
+  for (i = 0; i < 3 * n_faces; i++)
+    if (faces[i] < 0 || faces[i] >= n_vertices)
+      return -1;
+
+  // build the surface, faces that repeat a vertex can not be represented
+  s = gts_surface_new(gts_surface_class(),
+                      gts_face_class(),
+                      gts_edge_class(),
+                      gts_vertex_class());
+  verts = g_malloc(n_vertices * sizeof(GtsVertex *));
+  for (i = 0; i < n_vertices; i++)
+    verts[i] = gts_vertex_new(gts_vertex_class(),
+                              vertices[3*i], vertices[3*i+1], vertices[3*i+2]);
+  for (i = 0; i < n_faces; i++) {
+    GtsVertex *v1 = verts[faces[3*i]];
+    GtsVertex *v2 = verts[faces[3*i+1]];
+    GtsVertex *v3 = verts[faces[3*i+2]];
+    if (v1 == v2 || v2 == v3 || v3 == v1)
+      continue;
+    gts_surface_add_face(s, gts_face_new(gts_face_class(),
+                                         connecting_edge(v1, v2),
+                                         connecting_edge(v2, v3),
+                                         connecting_edge(v3, v1)));
+  }
+
+  smooth_surface(s, spatial, influence, mode);
+
+  // copy the results out, then free the vertices outside the surface
+  // (the others are destroyed along with the surface)
+  for (i = 0; i < n_vertices; i++) {
+    out[3*i] = GTS_POINT(verts[i])->x;
+    out[3*i+1] = GTS_POINT(verts[i])->y;
+    out[3*i+2] = GTS_POINT(verts[i])->z;
+    if (verts[i]->segments == NULL)
+      gts_object_destroy(GTS_OBJECT(verts[i]));
+  }
+  gts_object_destroy(GTS_OBJECT(s));
+  g_free(verts);
+
+  return 0;
+}
+
+////////////////////////////////////////////////////////////////////
+//
+//	Name:	index_vertex
+//
+//	Use:	number the vertices of a surface read from a GTS file and
+//		record their coordinates
+//
+//	Parameters...
+//	item:	vertex
+//
+//	data:	array of the vertex list, the index hash and the coordinates
+
+gint
+index_vertex(gpointer item, gpointer data)
+{
+  gpointer *arrays = data;
+  GPtrArray *vertex_list = arrays[0];
+  GHashTable *index_hash = arrays[1];
+  GArray *coordinates = arrays[2];
+  GtsPoint *p = GTS_POINT(item);
+
+  g_hash_table_insert(index_hash, item, GINT_TO_POINTER(vertex_list->len));
+  g_ptr_array_add(vertex_list, item);
+  g_array_append_val(coordinates, p->x);
+  g_array_append_val(coordinates, p->y);
+  g_array_append_val(coordinates, p->z);
+
+  return (0);
+}
+
+////////////////////////////////////////////////////////////////////
+//
+//	Name:	index_face
+//
+//	Use:	record the vertex indices of a face of a surface read
+//		from a GTS file
+//
+//	Parameters...
+//	item:	face
+//
+//	data:	array of the vertex list, the index hash and the face indices
+
+gint
+index_face(gpointer item, gpointer data)
+{
+  gpointer *arrays = data;
+  GHashTable *index_hash = arrays[1];
+  GArray *face_indices = arrays[3];
+  GtsVertex *v1, *v2, *v3;
+  gint i;
+
+  gts_triangle_vertices(GTS_TRIANGLE(item), &v1, &v2, &v3);
+  i = GPOINTER_TO_INT(g_hash_table_lookup(index_hash, v1));
+  g_array_append_val(face_indices, i);
+  i = GPOINTER_TO_INT(g_hash_table_lookup(index_hash, v2));
+  g_array_append_val(face_indices, i);
+  i = GPOINTER_TO_INT(g_hash_table_lookup(index_hash, v3));
+  g_array_append_val(face_indices, i);
+
+  return (0);
+}
+
+////////////////////////////////////////////////////////////////////
+//
+//	Name:	read_mesh_binary
+//
+//	Use:	read a mesh in the binary format (see MeshHeader)
+//
+//	Parameters...
+//	fp:		file to read from
+//
+//	header:		filled with the header read
+//
+//	coordinates:	set to the num_vertices * 3 coordinates, as doubles
+//
+//	edges:		set to the num_edges * 2 vertex indices
+//
+//	faces:		set to the num_faces * 3 edge indices
+//
+//	Returns 0 on success, -1 if the input is not a valid binary mesh
+//	(nothing is allocated then).
+
+int
+read_mesh_binary(FILE *fp, MeshHeader *header, gdouble **coordinates,
+                 gint **edges, gint **faces)
+{
+  gsize i, n_coordinates, n_edges, n_faces;
+  gpointer raw;
+  gboolean valid;
+
+  if (fread(header, sizeof(MeshHeader), 1, fp) != 1 ||
+      memcmp(header->magic, MESH_MAGIC, 4) != 0 ||
+      header->version != MESH_VERSION ||
+      (header->coordinate_size != 4 && header->coordinate_size != 8))
+    return -1;
+
+  n_coordinates = 3 * (gsize) header->num_vertices;
+  n_edges = 2 * (gsize) header->num_edges;
+  n_faces = 3 * (gsize) header->num_faces;
+  raw = g_malloc(n_coordinates * header->coordinate_size);
+  *coordinates = g_malloc(n_coordinates * sizeof(gdouble));
+  *edges = g_malloc(n_edges * sizeof(gint));
+  *faces = g_malloc(n_faces * sizeof(gint));
+
+  // each block is read at once, the coordinates as stored
+  valid = (fread(raw, header->coordinate_size, n_coordinates, fp) == n_coordinates &&
+           fread(*edges, sizeof(gint), n_edges, fp) == n_edges &&
+           fread(*faces, sizeof(gint), n_faces, fp) == n_faces);
+
+  if (valid) {
+    for (i = 0; i < n_coordinates; i++)
+      (*coordinates)[i] = (header->coordinate_size == 4) ?
+        ((gfloat *) raw)[i] : ((gdouble *) raw)[i];
+
+    // every index has to point into its block
+    for (i = 0; valid && i < n_edges; i++)
+      valid = ((*edges)[i] >= 0 && (guint32) (*edges)[i] < header->num_vertices);
+    for (i = 0; valid && i < n_faces; i++)
+      valid = ((*faces)[i] >= 0 && (guint32) (*faces)[i] < header->num_edges);
+  }
+  g_free(raw);
+
+  if (!valid) {
+    g_free(*coordinates);
+    g_free(*edges);
+    g_free(*faces);
+    return -1;
+  }
+  return 0;
+}
+
+////////////////////////////////////////////////////////////////////
+//
+//	Name:	write_mesh_binary
+//
+//	Use:	write a mesh in the binary format (see MeshHeader), with
+//		the coordinates in the size the header gives
+//
+//	Parameters...
+//	fp:		file to write to
+//
+//	header:		header of the mesh
+//
+//	coordinates:	the num_vertices * 3 coordinates
+//
+//	edges:		the num_edges * 2 vertex indices
+//
+//	faces:		the num_faces * 3 edge indices
+
+void
+write_mesh_binary(FILE *fp, const MeshHeader *header, const gdouble *coordinates,
+                  const gint *edges, const gint *faces)
+{
+  gsize i, n_coordinates = 3 * (gsize) header->num_vertices;
+  gfloat *single;
+
+  fwrite(header, sizeof(MeshHeader), 1, fp);
+  if (header->coordinate_size == 4) {
+    single = g_malloc(n_coordinates * sizeof(gfloat));
+    for (i = 0; i < n_coordinates; i++)
+      single[i] = (gfloat) coordinates[i];
+    fwrite(single, sizeof(gfloat), n_coordinates, fp);
+    g_free(single);
+  }
+  else
+    fwrite(coordinates, sizeof(gdouble), n_coordinates, fp);
+  fwrite(edges, sizeof(gint), 2 * (gsize) header->num_edges, fp);
+  fwrite(faces, sizeof(gint), 3 * (gsize) header->num_faces, fp);
+}
+
+////////////////////////////////////////////////////////////////////
+//
+//	Name:	face_vertices
+//
+//	Use:	turn the edge indices of the faces into vertex indices,
+//		in the order gts_triangle_vertices gives them for a face
+//		read from a GTS file
+//
+//	Parameters...
+//	edges:		num_edges * 2 vertex indices
+//
+//	faces:		n_faces * 3 edge indices
+//
+//	n_faces:	number of faces
+//
+//	out:		n_faces * 3 vertex indices for the result
+
+void
+face_vertices(const gint *edges, const gint *faces, gsize n_faces, gint *out)
+{
+  gsize i;
+
+  for (i = 0; i < n_faces; i++) {
+    const gint *e1 = edges + 2 * faces[3*i];
+    const gint *e2 = edges + 2 * faces[3*i+1];
+
+    if (e1[1] == e2[0]) {
+      out[3*i] = e1[0]; out[3*i+1] = e1[1]; out[3*i+2] = e2[1];
+    }
+    else if (e1[1] == e2[1]) {
+      out[3*i] = e1[0]; out[3*i+1] = e1[1]; out[3*i+2] = e2[0];
+    }
+    else if (e1[0] == e2[0]) {
+      out[3*i] = e1[1]; out[3*i+1] = e1[0]; out[3*i+2] = e2[1];
+    }
+    else {
+      out[3*i] = e1[1]; out[3*i+1] = e1[0]; out[3*i+2] = e2[0];
+    }
+  }
+}
+
+////////////////////////////////////////////////////////////////////
+//
+//	Name:	print_stats
+//
+//	Use:	write the machine readable trailer with the counters of
+//		the run, a comment line GTS readers skip (and readers of
+//		the binary format ignore, it follows the blocks)
+//
+//	Parameters...
+//	fp:	file to write to
+
+void
+print_stats(FILE *fp)
+{
+  fprintf(fp, "# nifp_stats {\"vertices_processed\": %d, \"neighbors_visited\": %ld, "
+          "\"tree_nodes_visited\": %ld, \"seconds\": %.3f}\n",
+          mollify_count + filter_count, neighbor_count, node_count, smooth_seconds);
+}
+
+////////////////////////////////////////////////////////////////////
+//
+//	Name:	smooth_binary
+//
+//	Use:	the command line program for binary meshes: reads one on
+//		stdin, smooths it with nifp_smooth and writes it on stdout
+//		with the new vertex positions, followed by the trailer
+//
+//	Parameters...
+//	spatial, influence, mode:	see nifp_smooth
+//
+//	Returns the exit status of the program.
+
+int
+smooth_binary(double spatial, double influence, int mode)
+{
+  MeshHeader header;
+  gdouble *coordinates;
+  gint *edges, *faces, *triangles;
+
+  if (read_mesh_binary(stdin, &header, &coordinates, &edges, &faces)) {
+    fprintf(stderr, "input not a valid binary mesh\n");
+    return 1; // failure
+  }
+
+  triangles = g_malloc(3 * (gsize) header.num_faces * sizeof(gint));
+  face_vertices(edges, faces, header.num_faces, triangles);
+
+  verbose = TRUE;
+  nifp_smooth(coordinates, header.num_vertices, triangles, header.num_faces,
+              spatial, influence, mode, coordinates);
+
+  write_mesh_binary(stdout, &header, coordinates, edges, faces);
+  // the trailer starts on a line of its own
+  printf("\n");
+  print_stats(stdout);
+
+  g_free(triangles);
+  g_free(coordinates);
+  g_free(edges);
+  g_free(faces);
+  return 0; // success
+}
+
+////////////////////////////////////////////////////////////////////
+//
+//	Name:	main
+//
+//	Use:	command line program, reads a GTS surface on stdin, runs
+//		it through nifp_smooth and writes the result on stdout,
+//		followed by a comment line with the counters of the run
+//		as JSON ("# nifp_stats {...}"). With -b the surface is
+//		read and written in the binary format instead.
+
+int main (int argc, char * argv[])
+{
+  GtsFile *fp;
+  GtsSurface *s;
+  GPtrArray *vertex_list;
+  GHashTable *index_hash;
+  GArray *coordinates, *face_indices;
+  gpointer arrays[4];
+  guint i;
+
+
+  // Error message for wrong usage
+  if (argc != 4 && !(argc == 5 && strcmp(argv[4], "-b") == 0)) {
+    fprintf(stderr, "Usage %s sigma_f sigma_g dist_mode [-b] < in.gts > out.gts\n",
+            argv[0]);
+    exit (-1);
+  }
+
+  if (argc == 5)
+    return smooth_binary(atof(argv[1]), atof(argv[2]), atof(argv[3]));
+
+  // read surface in 
+  s = gts_surface_new (gts_surface_class (),
+		       gts_face_class (),
+		       gts_edge_class (),
+		       gts_vertex_class ());
+  fp = gts_file_new (stdin);
+  if (gts_surface_read (s, fp)) {
+    fprintf(stderr, "input not a valid GTS file\n");
+    return 1; // failure 
+  }
+
+  // turn the surface into the plain arrays of the library entry point
+  vertex_list = g_ptr_array_new();
+  index_hash = g_hash_table_new(NULL, NULL);
+  coordinates = g_array_new(FALSE, FALSE, sizeof(gdouble));
+  face_indices = g_array_new(FALSE, FALSE, sizeof(gint));
+  arrays[0] = vertex_list;
+  arrays[1] = index_hash;
+  arrays[2] = coordinates;
+  arrays[3] = face_indices;
+  gts_surface_foreach_vertex(s, index_vertex, arrays);
+  gts_surface_foreach_face(s, index_face, arrays);
+
+  verbose = TRUE;
+
+  // smooth, writing the new positions over the old ones
+  nifp_smooth((gdouble *) coordinates->data, vertex_list->len,
+              (gint *) face_indices->data, face_indices->len / 3,
+              atof(argv[1]), atof(argv[2]), atof(argv[3]),
+              (gdouble *) coordinates->data);
+
+  // move the vertices of the surface read in and write it out
+  for (i = 0; i < vertex_list->len; i++) {
+    GtsPoint *p = GTS_POINT(g_ptr_array_index(vertex_list, i));
+    p->x = g_array_index(coordinates, gdouble, 3*i);
+    p->y = g_array_index(coordinates, gdouble, 3*i+1);
+    p->z = g_array_index(coordinates, gdouble, 3*i+2);
+  }
 
   gts_surface_write(s, stdout);
 
+  // machine readable trailer, GTS readers skip comment lines
+  print_stats(stdout);
+
   return 0; // success 
 }
-
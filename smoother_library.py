@@ -0,0 +1,104 @@
+import ctypes
+import os
+import sys
+import threading
+import numpy as np
+from numpy.ctypeslib import ndpointer
+import instrumentation
+
+'''
+This python utility calls the smoothing code of smoother.c as a shared library.
+
+The library entry point nifp_smooth takes the vertex coordinates and the
+triangle indices as plain arrays and writes the new positions into an output
+array, so the NumPy arrays are handed over without any copy and without the
+GTS text format and the subprocess the smoother program needs.
+
+The library is compiled from smoother.c like the program, see compilecommand.txt.
+'''
+
+# library file for each system, next to this script
+LIBRARY_NAMES = {"linux": "libsmoother.so", "darwin": "libsmoother.dylib"}
+
+# counters reported by nifp_stats and the trailer of the smoother program
+STAT_NAMES = ("vertices_processed", "neighbors_visited", "tree_nodes_visited")
+
+_library = None
+
+# nifp_smooth keeps its state in static globals of smoother.c, and ctypes
+# releases the GIL during the call, so one run at a time
+_library_lock = threading.Lock()
+
+'''
+Function:   load_smoother_library
+Use:        load the compiled smoother library once and declare its entry point
+Parameters...
+path: library file, the one for this system next to this script if not given
+'''
+def load_smoother_library(path=None):
+    global _library
+    if (path is None and _library is not None):
+        return _library
+
+    if (path is None):
+        name = LIBRARY_NAMES.get(sys.platform.rstrip("0123456789"))
+        if (name is None):
+            raise OSError("No smoother library for system " + sys.platform)
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
+    library = ctypes.CDLL(path)
+    library.nifp_smooth.restype = ctypes.c_int
+    library.nifp_smooth.argtypes = [
+        ndpointer(dtype=np.float64, ndim=2, flags="C_CONTIGUOUS"), ctypes.c_int,
+        ndpointer(dtype=np.int32, ndim=2, flags="C_CONTIGUOUS"), ctypes.c_int,
+        ctypes.c_double, ctypes.c_double, ctypes.c_int,
+        ndpointer(dtype=np.float64, ndim=2, flags="C_CONTIGUOUS,WRITEABLE")]
+    library.nifp_stats.restype = None
+    library.nifp_stats.argtypes = [ndpointer(dtype=np.float64, ndim=1,
+                                             flags="C_CONTIGUOUS,WRITEABLE")]
+
+    _library = library
+    return library
+
+
+'''
+Function:   library_smooth
+Use:        smooth a triangle mesh with the compiled smoother
+Parameters...
+points: (n, 3) array of the vertex positions
+faces: (m, 3) array of the vertex indices of each triangle
+sigma_f: spatial parameter, in mean edge lengths
+sigma_g: influence parameter, in mean edge lengths
+dist_mode: 1 for gaussian, 2 for exponential, 3 for gamma
+out: (n, 3) float64 array for the result, allocated if not given (may be points)
+library: library loaded with load_smoother_library, loaded here if not given
+
+Float64 points and int32 faces in C order are passed as they are, other arrays
+are converted first. Vertices that are not part of any face are not moved.
+The library is not reentrant, so concurrent calls (e.g. from the threads of
+denoise_service.py) wait for each other.
+'''
+def library_smooth(points, faces, sigma_f, sigma_g, dist_mode, out=None, library=None):
+    if (library is None):
+        library = load_smoother_library()
+
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    faces = np.ascontiguousarray(faces, dtype=np.int32)
+    if (out is None):
+        out = np.empty_like(points)
+
+    stats = None
+    with _library_lock:
+        status = library.nifp_smooth(points, points.shape[0], faces, faces.shape[0],
+                                     float(sigma_f), float(sigma_g),
+                                     int(float(dist_mode)), out)
+        if (status == 0 and instrumentation.enabled):
+            stats = np.zeros(4)
+            library.nifp_stats(stats)
+    if (status != 0):
+        raise ValueError("A face refers to a vertex that does not exist")
+
+    if (stats is not None):
+        for name, value in zip(STAT_NAMES, stats[:3]):
+            instrumentation.count(name, value)
+    return out
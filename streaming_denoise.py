@@ -0,0 +1,419 @@
+'''
+    Streaming Bilateral Mesh Denoising
+
+    Scanners deliver points in batches. Instead of waiting for the whole cloud,
+    the StreamingDenoiser takes the batches as they arrive and only does work
+    near each new batch:
+
+        - The raw points are kept in a spatial hash grid that grows with every
+            batch, so the points near a batch are found without touching the
+            rest of the cloud.
+        - Every point keeps its own neighborhood radius: the distance within
+            which the "kdtree" neighborhood mode finds all its neighbors (its
+            k-NN radius or its 2 * sigma_c ball, see
+            parallel_bilateral.neighborhood_radii), times a safety margin since
+            the points move a little at every iteration (the radii are those
+            of the raw points). The radii of the new points and of the old
+            points near them are recomputed exactly with every batch, so
+            sparse regions get wide radii and dense ones narrow radii wherever
+            they arrive.
+        - The points whose result changes are found backwards from the new
+            points, once per iteration: first the points that have a new point
+            within their radius, then the points that have one of those within
+            theirs, and so on. The grid cells are grouped by the largest
+            radius of their points, so a single outlier with a huge radius is
+            only looked up as itself instead of widening the search around
+            every point.
+        - Those points (the update) are denoised again with the "kdtree" batch
+            engine, run on the raw points reached forwards through the radii
+            in as many steps (the context), which gives them the same result
+            as a run on the whole cloud so far, as long as the margin covers
+            the moves of the points (check_streaming compares the two).
+        - A point that has not been updated for a number of batches
+            (patience) is considered out of range of future batches, and it is
+            emitted as finalized. Finalized points still serve as context for
+            their neighbors, but are not changed again.
+
+    The grid cells are sized to the median radius of the first batch unless
+    given, so the work per batch is proportional to the batch size (times the
+    local point density), not to the size of the cloud so far:
+
+        python3 streaming_denoise.py bunny_noisy.xyz --batch 5000
+'''
+from collections import deque
+from scipy.spatial import cKDTree
+import numpy as np
+import argparse
+import sys
+from BilateralMeshDenoising import bilateral_iteration_batch
+from BilateralMeshDenoising import knn_size
+from cloud_io import load_xyz_points
+from parallel_bilateral import neighborhood_radii
+
+# offset and stride used to pack 3 grid coordinates into one integer key
+GRID_OFFSET = 1 << 20
+GRID_STRIDE = 1 << 21
+
+# ring of grid cells the radius of a point is first searched within, doubled
+# until it holds the k nearest neighbors
+START_RING = 2
+
+# largest ring of grid cells a radius is counted as, covering every cell
+MAX_RING = GRID_OFFSET
+
+
+class StreamingDenoiser:
+    '''
+    Class:  StreamingDenoiser
+    Use:    denoise a point cloud that arrives in batches
+    Parameters...
+    iterations: how many times to smooth each neighborhood
+    n_degree: how many levels of neighbors to include in normal calculations
+    cell_size: size of the grid cells, the median neighborhood radius of the
+               first batch if not given
+    patience: batches a point must stay out of reach before it is finalized
+    margin: factor applied to the neighborhood radii, for the moves of the
+            points during the iterations
+    '''
+    def __init__(self, iterations=2, n_degree=2, cell_size=None, patience=1, margin=2.0):
+        self.iterations = iterations
+        self.n_degree = n_degree
+        self.cell_size = cell_size
+        self.patience = patience
+        self.margin = margin
+
+        self.num_points = 0
+        self._raw = np.zeros((0, 3))
+        self._denoised = np.zeros((0, 3))
+        self._radius = np.zeros(0)
+        self._finalized = np.zeros(0, dtype=bool)
+        self._last_touched = np.zeros(0, dtype=np.int64)
+
+        self._grid = {}
+        # ring of every cell (how many cells its largest radius spans), and
+        # the cells of every ring
+        self._cell_ring = {}
+        self._ring_cells = {}
+        self._batch_number = 0
+        # (batch number, indices) of the points updated by each batch
+        self._pending = deque()
+
+    '''
+    Function:   _cells
+    Use:        integer grid coordinates of every point
+    '''
+    def _cells(self, points):
+        return np.floor(points / self.cell_size).astype(np.int64)
+
+    '''
+    Function:   _pack
+    Use:        grid cell key of every row of grid coordinates
+    '''
+    def _pack(self, cells):
+        cells = cells + GRID_OFFSET
+        return (cells[:, 0] * GRID_STRIDE + cells[:, 1]) * GRID_STRIDE + cells[:, 2]
+
+    '''
+    Function:   _rings
+    Use:        how many grid cells each radius spans
+    '''
+    def _rings(self, radius):
+        return np.minimum(np.ceil(radius / self.cell_size), MAX_RING).astype(np.int64)
+
+    '''
+    Function:   _grow
+    Use:        make room for count more points, doubling the storage as needed
+    '''
+    def _grow(self, count):
+        needed = self.num_points + count
+        if (needed <= self._raw.shape[0]):
+            return
+        size = max(needed, 2 * self._raw.shape[0], 1024)
+        for name, fill in (("_raw", 0.0), ("_denoised", 0.0), ("_radius", 0.0),
+                           ("_finalized", False), ("_last_touched", 0)):
+            old = getattr(self, name)
+            new = np.full((size,) + old.shape[1:], fill, dtype=old.dtype)
+            new[:self.num_points] = old[:self.num_points]
+            setattr(self, name, new)
+
+    '''
+    Function:   _insert
+    Use:        add points to the storage and the spatial grid
+    '''
+    def _insert(self, batch):
+        self._grow(batch.shape[0])
+        indices = np.arange(self.num_points, self.num_points + batch.shape[0])
+        self._raw[indices] = batch
+        self._denoised[indices] = batch
+        self.num_points += batch.shape[0]
+
+        keys = self._pack(self._cells(batch))
+        unique, inverse = np.unique(keys, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        groups = np.split(indices[order], np.cumsum(np.bincount(inverse))[:-1])
+        for key, group in zip(unique.tolist(), groups):
+            self._grid.setdefault(key, []).extend(group.tolist())
+        return indices
+
+    '''
+    Function:   _near_cells
+    Use:        keys of the cells of a pool within a ring of cells around any
+                of the given cells
+    Parameters...
+    cells: (m, 3) array of grid coordinates
+    ring: how many cells away from them to look
+    pool: dict or set of the cell keys to pick from
+
+    The whole pool is returned when it is smaller than the cells to look at,
+    the points are filtered by their distances afterwards anyway.
+    '''
+    def _near_cells(self, cells, ring, pool):
+        if ((2 * ring + 1) ** 3 * cells.shape[0] > len(pool)):
+            return list(pool)
+        span = np.arange(-ring, ring + 1)
+        offsets = np.stack(np.meshgrid(span, span, span, indexing='ij'), axis=-1).reshape(-1, 3)
+        keys = np.unique(self._pack((cells[:, None, :] + offsets).reshape(-1, 3)))
+        return [k for k in keys.tolist() if k in pool]
+
+    '''
+    Function:   _members
+    Use:        indices of the points of some grid cells
+    '''
+    def _members(self, keys):
+        if (len(keys) == 0):
+            return np.zeros(0, dtype=np.intp)
+        return np.concatenate([np.asarray(self._grid[k], dtype=np.intp) for k in keys])
+
+    '''
+    Function:   _neighborhood_radii
+    Use:        exact neighborhood radii (margin included) of stored points,
+                like parallel_bilateral.neighborhood_radii on all the points
+    '''
+    def _neighborhood_radii(self, indices):
+        radius = np.full(indices.shape[0], np.inf)
+        k = knn_size(self.n_degree)
+        # while the k-NN hold every point, every new point changes them
+        if (self.num_points <= k):
+            return radius
+
+        pending = np.arange(indices.shape[0])
+        ring = START_RING
+        while (pending.shape[0] > 0):
+            points = self._raw[indices[pending]]
+            keys = self._near_cells(np.unique(self._cells(points), axis=0), ring, self._grid)
+            candidates = self._members(keys)
+            dist = cKDTree(self._raw[candidates]).query(points, k=k)[0].reshape(-1, k)
+
+            # the k-NN are exact once they all lie within the searched cells
+            done = dist[:, -1] <= ring * self.cell_size
+            if (len(keys) == len(self._grid)):
+                done[:] = True
+            gaps = np.where(dist > 0, dist, np.inf).min(axis=1)
+            gaps[np.isinf(gaps)] = 1e10
+            radius[pending[done]] = self.margin * np.maximum(dist[done, -1], 2 * gaps[done])
+            pending = pending[~done]
+            ring *= 2
+        return radius
+
+    '''
+    Function:   _set_radii
+    Use:        store the radii of some points and move their cells to the
+                ring of their new largest radius
+    '''
+    def _set_radii(self, indices, radius):
+        self._radius[indices] = radius
+        keys = np.unique(self._pack(self._cells(self._raw[indices])))
+        for key in keys.tolist():
+            ring = int(self._rings(self._radius[self._grid[key]].max()))
+            old = self._cell_ring.get(key)
+            if (old == ring):
+                continue
+            if (old is not None):
+                self._ring_cells[old].discard(key)
+                if (len(self._ring_cells[old]) == 0):
+                    del self._ring_cells[old]
+            self._ring_cells.setdefault(ring, set()).add(key)
+            self._cell_ring[key] = ring
+
+    '''
+    Function:   _reaching
+    Use:        indices of the stored points that have any of the sources
+                within their radius
+    '''
+    def _reaching(self, sources):
+        points = self._raw[sources]
+        cells = np.unique(self._cells(points), axis=0)
+        candidates = [self._members(self._near_cells(cells, ring, keys))
+                      for ring, keys in self._ring_cells.items()]
+        candidates = np.concatenate(candidates + [np.zeros(0, dtype=np.intp)])
+        if (candidates.shape[0] == 0):
+            return candidates
+        dist = cKDTree(points).query(self._raw[candidates])[0]
+        return np.unique(candidates[dist <= self._radius[candidates]])
+
+    '''
+    Function:   _reached
+    Use:        indices of the stored points within the radius of any of the
+                sources
+    '''
+    def _reached(self, sources):
+        rings = self._rings(self._radius[sources])
+        reached = [sources]
+        for ring in np.unique(rings).tolist():
+            group = sources[rings == ring]
+            keys = self._near_cells(np.unique(self._cells(self._raw[group]), axis=0),
+                                    ring, self._grid)
+            candidates = self._members(keys)
+            lists = cKDTree(self._raw[candidates]).query_ball_point(self._raw[group],
+                                                                    self._radius[group])
+            hits = np.fromiter((i for l in lists for i in l), dtype=np.intp)
+            reached.append(candidates[hits])
+        return np.unique(np.concatenate(reached))
+
+    '''
+    Function:   _take_finalized
+    Use:        mark and return the points that stayed out of reach long enough
+    '''
+    def _take_finalized(self):
+        ready = []
+        while (self._pending and
+               self._batch_number - self._pending[0][0] >= self.patience):
+            number, indices = self._pending.popleft()
+            # points touched again since then are still pending in a later group
+            indices = indices[(self._last_touched[indices] == number) &
+                              ~self._finalized[indices]]
+            ready.append(indices)
+        if (len(ready) == 0):
+            return np.zeros(0, dtype=np.intp)
+        ready = np.concatenate(ready)
+        self._finalized[ready] = True
+        return ready
+
+    '''
+    Function:   add_batch
+    Use:        add newly arrived points, denoise them and the points near them
+    Parameters...
+    batch: (m, 3) array of the new points
+
+    Returns (indices, points): the arrival indices and denoised positions of
+    the points finalized by this batch.
+    '''
+    def add_batch(self, batch):
+        batch = np.asarray(batch, dtype=float).reshape(-1, 3)
+        self._batch_number += 1
+        if (batch.shape[0] == 0):
+            indices = self._take_finalized()
+            return indices, self._denoised[indices]
+
+        if (self.cell_size is None):
+            radius = neighborhood_radii(batch, self.n_degree)
+            radius = radius[radius < 1e10]
+            self.cell_size = self.margin * np.median(radius) if radius.shape[0] > 0 else 0.0
+            if (not self.cell_size > 0):
+                self.cell_size = float(np.ptp(batch, axis=0).max()) or 1.0
+
+        new = self._insert(batch)
+        self._set_radii(new, self._neighborhood_radii(new))
+
+        # the points whose result changes: those with a new point within their
+        # radius, then those with one of these within theirs, once per
+        # iteration (the old radii only shrink with new points, so they are
+        # safe to search with)
+        affected = new
+        frontier = new
+        for i in range(max(self.iterations, 1)):
+            frontier = np.setdiff1d(self._reaching(frontier), affected)
+            if (frontier.shape[0] == 0):
+                break
+            affected = np.union1d(affected, frontier)
+        old = np.setdiff1d(affected, new)
+        self._set_radii(old, self._neighborhood_radii(old))
+
+        # the raw points the update depends on, once per iteration
+        update = affected[~self._finalized[affected]]
+        context = update
+        frontier = update
+        for i in range(self.iterations):
+            frontier = np.setdiff1d(self._reached(frontier), context)
+            if (frontier.shape[0] == 0):
+                break
+            context = np.union1d(context, frontier)
+
+        local = self._raw[context]
+        for i in range(self.iterations):
+            local = bilateral_iteration_batch(local, None, self.n_degree, "kdtree")
+        self._denoised[update] = local[np.searchsorted(context, update)]
+
+        self._last_touched[update] = self._batch_number
+        self._pending.append((self._batch_number, update))
+
+        indices = self._take_finalized()
+        return indices, self._denoised[indices]
+
+    '''
+    Function:   flush
+    Use:        finalize and return all the points that are not finalized yet,
+                once no more batches will arrive
+
+    Returns (indices, points) like add_batch.
+    '''
+    def flush(self):
+        indices = np.flatnonzero(~self._finalized[:self.num_points])
+        self._finalized[indices] = True
+        self._pending.clear()
+        return indices, self._denoised[indices]
+
+
+'''
+Function:   check_streaming
+Use:        compare a streamed run with a run of the batch engine on the whole
+            cloud
+Parameters...
+points: (n, 3) array of the points, in arrival order
+batch_size: number of points per batch
+iterations: how many times to smooth the mesh
+n_degree: how many levels of neighbors to include in normal calculations
+
+No point is finalized before the end, since a finalized point is not updated
+by later batches. Returns the largest distance between the two results.
+'''
+def check_streaming(points, batch_size, iterations=2, n_degree=2):
+    points = np.asarray(points, dtype=float)
+    starts = range(0, points.shape[0], batch_size)
+    denoiser = StreamingDenoiser(iterations, n_degree, patience=len(starts) + 1)
+    for start in starts:
+        denoiser.add_batch(points[start:start + batch_size])
+    indices, streamed = denoiser.flush()
+
+    whole = points
+    for i in range(iterations):
+        whole = bilateral_iteration_batch(whole, None, n_degree, "kdtree")
+    return float(np.linalg.norm(streamed - whole[indices], axis=1).max(initial=0.0))
+
+
+'''
+Function:   main()
+Use:        check the streamed result on a cloud from the command line
+Parameters...
+argv: the command line arguments, those of the process if not given
+'''
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare streamed and whole-cloud denoising")
+    parser.add_argument("filename", help="the .xyz file, streamed in row order")
+    parser.add_argument("--batch", type=int, default=5000, help="points per batch")
+    parser.add_argument("--iterations", type=int, default=2)
+    parser.add_argument("--n-degree", type=int, default=2)
+    parser.add_argument("--shuffle", action="store_true",
+                        help="stream the points in a random order")
+    args = parser.parse_args(argv)
+
+    points = np.array(load_xyz_points(args.filename), dtype=float)
+    if (args.shuffle):
+        points = points[np.random.default_rng(0).permutation(points.shape[0])]
+    difference = check_streaming(points, args.batch, args.iterations, args.n_degree)
+    print("Largest difference from the whole-cloud run: %g" % difference)
+    return 0 if difference <= 1e-9 * np.ptp(points, axis=0).max() else 1
+
+
+if __name__=="__main__":
+    sys.exit(main())
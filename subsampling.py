@@ -0,0 +1,240 @@
+'''
+    Spatially Aware Subsampling
+
+    Keeping every k-th line of the file (points[::k]) keeps dense regions
+    oversampled and drops sparse features, so the rate has to be conservative.
+    The methods here thin the cloud according to where the points are:
+
+        - voxel grid: the points are binned into cubes of a given size and
+            every occupied cube is replaced by the centroid of its points
+        - Poisson disk: points are kept in random order as long as no kept
+            point is closer than a given radius, which gives an even spread of
+            original points. The hash grid cells are small enough to hold at
+            most one kept point, and cells 3 apart along every axis cannot
+            conflict, so the 27 groups of such cells are filled one after the
+            other, all cells of a group at once
+
+    Both work on integer cell keys of the whole array, so they are a handful
+    of linear passes plus one sort of the keys. Either can be given a size
+    (voxel size or disk radius) or a target number of points, in which case
+    the size is adjusted until the result is close to the target.
+    voxel_indices keeps the original point closest to each voxel centroid
+    instead, so the subset can be mapped back to the full cloud (see
+    multiresolution.py).
+'''
+import numpy as np
+
+# offset and stride used to pack 3 grid coordinates into one integer key
+GRID_OFFSET = 1 << 20
+GRID_STRIDE = 1 << 21
+
+'''
+Function:   cell_keys
+Use:        integer key of the grid cell of every point
+Parameters...
+cells: (n, 3) integer grid coordinates
+'''
+def cell_keys(cells):
+    cells = cells + GRID_OFFSET
+    return (cells[:, 0] * GRID_STRIDE + cells[:, 1]) * GRID_STRIDE + cells[:, 2]
+
+
+'''
+Function:   grid_cells
+Use:        integer grid coordinates of every point, for cubes of the given size
+'''
+def grid_cells(points, size):
+    return np.floor((points - points.min(axis=0)) / size).astype(np.int64)
+
+
+'''
+Function:   voxel_subsample
+Use:        replace the points of every occupied voxel by their centroid
+Parameters...
+points: array of the point positions
+voxel_size: side length of the voxels
+'''
+def voxel_subsample(points, voxel_size):
+    points = np.asarray(points, dtype=float)
+    if (points.shape[0] == 0):
+        return points.copy()
+    keys = cell_keys(grid_cells(points, voxel_size))
+    unique, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse)
+    centroids = np.stack([np.bincount(inverse, weights=points[:, i]) for i in range(3)], axis=1)
+    return centroids / counts[:, None]
+
+
+'''
+Function:   voxel_indices
+Use:        indices of the point closest to the centroid of every occupied voxel,
+            a voxel grid subset made of original points
+Parameters...
+points: array of the point positions
+voxel_size: side length of the voxels
+'''
+def voxel_indices(points, voxel_size):
+    points = np.asarray(points)
+    if (points.shape[0] == 0):
+        return np.zeros(0, dtype=np.intp)
+    keys = cell_keys(grid_cells(points, voxel_size))
+    unique, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse)
+    centroids = np.stack([np.bincount(inverse, weights=points[:, i]) for i in range(3)], axis=1)
+    gap = points - centroids[inverse] / counts[inverse, None]
+
+    # the points sorted by voxel, closest to the centroid first
+    order = np.lexsort((np.einsum('ij,ij->i', gap, gap), inverse))
+    first = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return np.sort(order[first])
+
+
+'''
+Function:   poisson_disk_indices
+Use:        indices of a subset of the points in which no two points are closer
+            than the radius, and every dropped point is within it of a kept one
+Parameters...
+points: array of the point positions
+radius: minimum distance between kept points
+seed: seed of the random order in which points are considered
+'''
+def poisson_disk_indices(points, radius, seed=None):
+    points = np.asarray(points, dtype=float)
+    n = points.shape[0]
+    if (n == 0):
+        return np.zeros(0, dtype=np.intp)
+
+    # the cell diagonal is the radius, so a cell holds at most one kept point
+    # and the conflicting points are at most 2 cells away
+    cells = grid_cells(points, radius / np.sqrt(3))
+    keys = cell_keys(cells)
+
+    # group the points by cell, in random order within each cell
+    priority = np.random.default_rng(seed).permutation(n)
+    order = np.lexsort((priority, keys))
+    unique, start, count = np.unique(keys[order], return_index=True, return_counts=True)
+    first = order[start]
+    phase = (cells[first, 0] % 3) * 9 + (cells[first, 1] % 3) * 3 + cells[first, 2] % 3
+
+    span = np.arange(-2, 3)
+    offsets = np.stack(np.meshgrid(span, span, span, indexing='ij'), axis=-1).reshape(-1, 3)
+    offsets = offsets[np.any(offsets != 0, axis=1)]
+    offset_keys = cell_keys(offsets) - cell_keys(np.zeros((1, 3), dtype=np.int64))
+
+    # the kept point of each cell, -1 for none yet
+    kept = np.full(unique.shape[0], -1, dtype=np.intp)
+    radius2 = radius * radius
+    for p in range(27):
+        pending = np.flatnonzero(phase == p)
+
+        # occupied neighboring cells of the cells of this group, as
+        # (cell, neighbor cell) pairs
+        neighbor = (unique[pending][:, None] + offset_keys[None, :]).ravel()
+        slot = np.minimum(np.searchsorted(unique, neighbor), unique.shape[0] - 1)
+        found = unique[slot] == neighbor
+        pair_cell = np.repeat(np.arange(pending.shape[0]), offset_keys.shape[0])[found]
+        pair_neighbor = slot[found]
+
+        attempt = 0
+        while (pending.shape[0] > 0):
+            candidates = order[start[pending] + attempt]
+
+            # reject candidates too close to a point kept in a neighboring cell
+            other = kept[pair_neighbor]
+            close = other >= 0
+            gap = points[other[close]] - points[candidates[pair_cell[close]]]
+            rejected = pair_cell[close][np.einsum('ij,ij->i', gap, gap) < radius2]
+            ok = np.ones(pending.shape[0], dtype=bool)
+            ok[rejected] = False
+
+            kept[pending[ok]] = candidates[ok]
+            attempt += 1
+
+            # cells still empty try their next point, if they have one left
+            retry = ~ok & (count[pending] > attempt)
+            renumber = np.cumsum(retry) - 1
+            pairs = retry[pair_cell]
+            pair_cell = renumber[pair_cell[pairs]]
+            pair_neighbor = pair_neighbor[pairs]
+            pending = pending[retry]
+
+    return np.sort(kept[kept >= 0])
+
+
+'''
+Function:   poisson_disk_subsample
+Use:        the points of a Poisson disk subset, see poisson_disk_indices
+'''
+def poisson_disk_subsample(points, radius, seed=None):
+    points = np.asarray(points, dtype=float)
+    return points[poisson_disk_indices(points, radius, seed)]
+
+
+'''
+Function:   subsample_to_count
+Use:        adjust the voxel size or disk radius until about target points are left
+Parameters...
+points: array of the point positions
+target: number of points wanted
+subsample: function of (points, size) returning the subsampled points
+tolerance: accepted relative difference to the target
+max_steps: how many sizes to try at most
+size: first size to try, by default the spacing of target points spread over
+      the largest face of the bounding box
+
+Returns (subsampled points, size) of the size closest to the target.
+'''
+def subsample_to_count(points, target, subsample, tolerance=0.05, max_steps=10, size=None):
+    if (size is None):
+        extent = points.max(axis=0) - points.min(axis=0)
+        size = np.sqrt(np.sort(extent)[1:].prod() / target)
+    best, best_size, best_error = None, size, np.inf
+    for i in range(max_steps):
+        result = subsample(points, size)
+        error = abs(result.shape[0] - target) / float(target)
+        if (error < best_error):
+            best, best_size, best_error = result, size, error
+        if (error <= tolerance):
+            break
+        # a surface loses points with the square of the size
+        size *= np.sqrt(result.shape[0] / float(target))
+    return best, best_size
+
+
+'''
+Function:   subsample_points
+Use:        reduce the cloud with the selected method
+Parameters...
+points: array of the point positions
+method: "stride" (every rate-th point), "voxel" or "poisson"
+rate: for "stride" the stride, for the other methods the reduction factor
+      that sets the target count (len(points) // rate) when size is not given
+size: voxel size or disk radius
+seed: seed of the Poisson disk order
+'''
+def subsample_points(points, method="stride", rate=0, size=None, seed=None):
+    if (method == "stride"):
+        if (rate > 0):
+            return points[::rate]
+        return points
+
+    if (method == "voxel"):
+        subsample = voxel_subsample
+    elif (method == "poisson"):
+        subsample = lambda p, s: poisson_disk_subsample(p, s, seed)
+    else:
+        raise ValueError("Unknown subsampling: " + str(method))
+
+    points = np.asarray(points, dtype=float)
+    if (size is not None):
+        return subsample(points, size)
+    if (rate <= 1):
+        return points
+
+    target = max(points.shape[0] // rate, 1)
+    result, size = subsample_to_count(points, target, voxel_subsample)
+    if (method == "poisson"):
+        # the cheap voxel grid gives the first guess, a disk covers about as
+        # many points as a voxel 1.5 times its radius wide
+        result, size = subsample_to_count(points, target, subsample, size=size / 1.5)
+    return result
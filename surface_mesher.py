@@ -0,0 +1,134 @@
+'''
+    Local Surface Meshing
+
+    The scipy Delaunay triangulation of a whole cloud is a 3D tetrahedralization,
+    which is far more than we need (gts_write only uses one face of each
+    tetrahedron) and is slow enough that the clouds had to be subsampled.
+
+    This mesher builds a triangle mesh of the surface from k-NN neighborhoods
+    instead, for all points at once:
+
+        - the tangent plane of each point is fitted to its k nearest neighbors
+        - the neighbors are projected onto the plane, and only those that are
+            Gabriel neighbors in the plane (no other neighbor inside the circle
+            whose diameter is the edge) are kept, which approximates the edges
+            of a local 2D Delaunay triangulation
+        - the kept neighbors are sorted by angle around the point, and each pair
+            of consecutive neighbors forms a triangle with the point, unless the
+            angle between them is too wide (at a boundary)
+        - the triangles proposed by the different points are merged
+
+    The cost is one k-NN query and O(k^2) array work per point, so it runs in
+    O(n*log(n)). The triangles are wound counter-clockwise around normals that
+    point away from the center of the cloud.
+
+    The result is a (m, 3) array of faces, which is used through a MeshTopology
+    by both BilateralMeshDenoising ("topology" mode) and cloud_to_gts.gts_write.
+'''
+from scipy.spatial import cKDTree
+import numpy as np
+
+# points processed at a time in the O(k^2) neighbor test
+CHUNK_POINTS = 16384
+
+'''
+Function:   tangent_frames
+Use:        fit the tangent plane of every point to its nearest neighbors
+Parameters...
+points: array of the point positions
+nearest: (n, k) indices of the nearest neighbors of each point
+
+Returns (normals, u, v): the normal and two tangent directions of each point.
+'''
+def tangent_frames(points, nearest):
+    local = points[nearest] - points[nearest].mean(axis=1)[:, None, :]
+    covariance = np.einsum('ijk,ijl->ikl', local, local)
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    normals = eigenvectors[:, :, 0]
+
+    # point the normals away from the center of the cloud
+    outward = points - points.mean(axis=0)
+    flip = np.einsum('ij,ij->i', normals, outward) < 0
+    normals[flip] = -normals[flip]
+
+    u = eigenvectors[:, :, 2]
+    v = np.cross(normals, u)
+    return normals, u, v
+
+
+'''
+Function:   gabriel_neighbors
+Use:        find which projected neighbors have no other neighbor inside the
+            circle whose diameter is the edge to them
+Parameters...
+q: (n, k, 2) neighbor positions in the tangent plane of each point
+'''
+def gabriel_neighbors(q):
+    n, k = q.shape[0], q.shape[1]
+    keep = np.zeros((n, k), dtype=bool)
+    # the test compares all pairs of neighbors, done in blocks to bound memory
+    for start in range(0, n, CHUNK_POINTS):
+        block = q[start:start + CHUNK_POINTS]
+        centers = block / 2
+        radius2 = np.einsum('ijk,ijk->ij', centers, centers)
+        gap = block[:, None, :, :] - centers[:, :, None, :]
+        inside = np.einsum('ijlk,ijlk->ijl', gap, gap) < radius2[:, :, None]
+        inside[:, np.arange(k), np.arange(k)] = False
+        keep[start:start + CHUNK_POINTS] = ~inside.any(axis=2)
+    return keep
+
+
+'''
+Function:   local_surface_mesh
+Use:        build a triangle mesh of the surface through the points
+Parameters...
+points: array of the point positions
+k: number of nearest neighbors considered around each point
+max_angle: largest angle (radians) between consecutive neighbors that still
+           forms a triangle, wider gaps are treated as a boundary
+min_votes: how many of its points must propose a triangle for it to be kept
+'''
+def local_surface_mesh(points, k=12, max_angle=0.75 * np.pi, min_votes=1):
+    points = np.asarray(points, dtype=float)
+    n = points.shape[0]
+    k = min(k, n - 1)
+    if (k < 2):
+        return np.zeros((0, 3), dtype=np.int32)
+
+    dist, nearest = cKDTree(points).query(points, k=k + 1)
+    neighbors = nearest[:, 1:]
+    normals, u, v = tangent_frames(points, nearest)
+
+    # neighbors in the tangent plane of each point
+    offsets = points[neighbors] - points[:, None, :]
+    q = np.stack((np.einsum('ijk,ik->ij', offsets, u),
+                  np.einsum('ijk,ik->ij', offsets, v)), axis=2)
+
+    keep = gabriel_neighbors(q)
+
+    # sort the kept neighbors by angle, dropped ones go to the end
+    angles = np.arctan2(q[:, :, 1], q[:, :, 0])
+    angles[~keep] = np.inf
+    order = np.argsort(angles, axis=1)
+    angles = np.take_along_axis(angles, order, axis=1)
+    ring = np.take_along_axis(neighbors, order, axis=1)
+    count = keep.sum(axis=1)
+
+    # consecutive pairs around the point, the last one wraps to the first
+    following = (np.arange(k)[None, :] + 1) % np.maximum(count, 1)[:, None]
+    next_angles = np.take_along_axis(angles, following, axis=1)
+    next_ring = np.take_along_axis(ring, following, axis=1)
+    with np.errstate(invalid='ignore'):
+        step = np.mod(next_angles - angles, 2 * np.pi)
+    valid = (np.arange(k)[None, :] < count[:, None]) & (count[:, None] >= 3) & \
+            (step > 0) & (step < max_angle)
+
+    centers = np.repeat(np.arange(n), k).reshape(n, k)
+    faces = np.stack((centers[valid], ring[valid], next_ring[valid]), axis=1)
+
+    # each triangle is usually proposed by several of its points, keep one
+    # copy of those proposed by at least min_votes points
+    key = np.sort(faces, axis=1)
+    unique, first, votes = np.unique(key, axis=0, return_index=True, return_counts=True)
+    first = first[votes >= min_votes]
+    return faces[np.sort(first)].astype(np.int32)
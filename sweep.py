@@ -0,0 +1,326 @@
+'''
+    Parameter Sweeps
+
+    Runs one of the methods on a cloud for every combination of a grid of
+    parameters, scores every result against a reference cloud and prints them
+    ranked:
+
+        python3 sweep.py bunny_noisy.xyz --reference bunny.xyz --method non_iterative \
+            --grid sigma_f=1,2 sigma_g=1,2 dist_mode=1,2 --processes 4
+
+    The swept parameters are
+        non_iterative:  sigma_f, sigma_g, dist_mode (as for run_non_iterative)
+        bilateral:      iterations, n_degree (as for run_bilateral_denoising)
+
+    What the runs have in common is computed only once:
+
+        - the cloud is loaded, subsampled and triangulated once in this
+            process, and for the non-iterative method the surface vertices,
+            mean edge length and triangle centroid tree are set up once
+            (SmoothingMesh in non_iterative_smoothing.py), before the worker
+            processes start and receive them
+        - the runs are grouped so that a worker computes the mollified normals
+            of a (sigma_f, dist_mode) once for all the sigma_g of the group
+        - for the bilateral method, a group runs the iterations of an n_degree
+            once up to the largest iteration count, and every smaller count is
+            a snapshot along the way
+        - the reference KD-tree and normals (evaluation.py) are built once
+
+    Every run records its own time, and the time of the work it shares with
+    the other runs of its group. The results are ranked by one of the scores
+    (chamfer by default, fitness ranks highest first) and can be written as
+    JSON, and with --output-dir every result is also written as .xyz.
+'''
+from multiprocessing import Pool
+import numpy as np
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from BilateralMeshDenoising import bilateral_iteration_batch
+from cloud_io import load_xyz_points
+from cloud_io import write_xyz
+from cloud_to_gts import load_triangulation
+from cloud_to_gts import mesh_faces
+from evaluation import THRESHOLD
+from evaluation import ReferenceCloud
+from mesh_topology import as_topology
+from non_iterative_smoothing import SmoothingMesh
+
+PARAMETERS = {"non_iterative": ("sigma_f", "sigma_g", "dist_mode"),
+              "bilateral": ("iterations", "n_degree")}
+
+# the README's recommended values and their neighbors
+DEFAULT_GRIDS = {"non_iterative": {"sigma_f": [1, 2, 3], "sigma_g": [1, 2], "dist_mode": [1, 2]},
+                 "bilateral": {"iterations": [1, 2, 3], "n_degree": [2, 4]}}
+
+# scores ranked from the highest, the others rank from the lowest
+HIGHER_IS_BETTER = ("fitness",)
+
+# what the runs of a worker share, set by init_worker
+_state = None
+
+'''
+Function:   init_worker
+Use:        keep the shared intermediates in a worker process
+'''
+def init_worker(state):
+    global _state
+    _state = state
+
+
+'''
+Function:   run_name
+Use:        a name of a run made of its parameters, e.g. sigma_f-2_sigma_g-1_dist_mode-1
+'''
+def run_name(params):
+    return "_".join("%s-%s" % (key, params[key]) for key in params)
+
+
+'''
+Function:   finish_run
+Use:        score the points of a run and write them if asked to
+Parameters...
+params: the parameters of the run
+points: the resulting points
+seconds: time of the work of this run only
+shared_seconds: time of the work shared with the other runs of the group
+'''
+def finish_run(params, points, seconds, shared_seconds):
+    result = {"params": params, "seconds": seconds, "shared_seconds": shared_seconds}
+
+    start = time.time()
+    if (_state["reference"] is not None):
+        result["scores"] = _state["reference"].evaluate(points, _state["threshold"])
+    result["score_seconds"] = time.time() - start
+
+    if (_state["output_dir"]):
+        result["output"] = os.path.join(_state["output_dir"], run_name(params) + ".xyz")
+        write_xyz(result["output"], points)
+    return result
+
+
+'''
+Function:   smoothing_group
+Use:        the non-iterative runs of one (sigma_f, dist_mode), sharing the
+            mollified normals
+Parameters...
+task: (sigma_f, dist_mode, list of sigma_g)
+'''
+def smoothing_group(task):
+    sigma_f, dist_mode, sigmas_g = task
+    mesh = _state["mesh"]
+
+    start = time.time()
+    mesh.mollified_normals(sigma_f, dist_mode)
+    shared_seconds = time.time() - start
+
+    results = []
+    for sigma_g in sigmas_g:
+        start = time.time()
+        new_points = mesh.smooth(sigma_f, sigma_g, dist_mode)
+        seconds = time.time() - start
+        # like the smoother output, only the vertices of the surface are kept
+        results.append(finish_run({"sigma_f": sigma_f, "sigma_g": sigma_g, "dist_mode": dist_mode},
+                                  new_points[mesh.vertices], seconds, shared_seconds))
+    return results
+
+
+'''
+Function:   bilateral_group
+Use:        the bilateral runs of one n_degree, iterated once up to the largest
+            iteration count
+Parameters...
+task: (n_degree, list of iteration counts)
+'''
+def bilateral_group(task):
+    n_degree, counts = task
+    points = _state["points"]
+
+    results = []
+    done = 0
+    shared_seconds = 0.0
+    for iterations in sorted(counts):
+        start = time.time()
+        for i in range(done, iterations):
+            points = bilateral_iteration_batch(points, _state["tri"], n_degree,
+                                               _state["neighborhood"])
+        done = iterations
+        # the iterations of the smaller counts are shared with those runs
+        seconds = time.time() - start
+        results.append(finish_run({"iterations": iterations, "n_degree": n_degree},
+                                  points, seconds, shared_seconds))
+        shared_seconds += seconds
+    return results
+
+
+'''
+Function:   group_tasks
+Use:        split the grid into the groups of runs that share their work
+Parameters...
+method: "non_iterative" or "bilateral"
+grid: dictionary of the list of values of every parameter
+'''
+def group_tasks(method, grid):
+    for key in grid:
+        if (key not in PARAMETERS[method]):
+            raise ValueError("Unknown sweep parameter: " + str(key))
+    grid = dict(DEFAULT_GRIDS[method], **grid)
+
+    if (method == "non_iterative"):
+        return [(sigma_f, dist_mode, list(grid["sigma_g"]))
+                for sigma_f, dist_mode in itertools.product(grid["sigma_f"], grid["dist_mode"])]
+    return [(n_degree, list(grid["iterations"])) for n_degree in grid["n_degree"]]
+
+
+'''
+Function:   rank_results
+Use:        sort the results by a score, best first (unscored runs keep their order)
+'''
+def rank_results(results, rank_by="chamfer"):
+    if (not all("scores" in r for r in results)):
+        return list(results)
+    sign = -1.0 if (rank_by in HIGHER_IS_BETTER) else 1.0
+    return sorted(results, key=lambda r: sign * r["scores"][rank_by])
+
+
+'''
+Function:   sweep
+Use:        run a method for every combination of a grid of parameters
+Parameters...
+filename: the input .xyz file
+method: "non_iterative" or "bilateral"
+grid: dictionary of the list of values of every swept parameter, the
+      DEFAULT_GRIDS values for those not given
+reference: .xyz file the results are scored against, no scores if not given
+sub_sampling: subsampling rate, 0 for none
+mesher, subsampling: see cloud_to_gts.load_triangulation
+neighborhood: "simplex", "topology" or "kdtree" for the bilateral method
+threshold: inlier distance of the scores
+processes: number of worker processes, all cores if not given
+output_dir: directory every result is written to as .xyz, none if not given
+rank_by: score the results are ranked by
+
+Returns the results ranked, each with its "params", "scores" (if there is a
+reference), "seconds", "shared_seconds" and "score_seconds".
+'''
+def sweep(filename, method="non_iterative", grid=None, reference=None, sub_sampling=5,
+          mesher="delaunay", subsampling="stride", neighborhood="simplex",
+          threshold=THRESHOLD, processes=None, output_dir=None, rank_by="chamfer"):
+    if (method not in PARAMETERS):
+        raise ValueError("Unknown method: " + str(method))
+    tasks = group_tasks(method, grid or {})
+
+    tri, points = load_triangulation(filename, sub_sampling, mesher, subsampling)
+    points = np.asarray(points, dtype=float)
+
+    state = {"threshold": threshold, "output_dir": output_dir, "reference": None}
+    if (reference is not None):
+        state["reference"] = ReferenceCloud(load_xyz_points(reference))
+        state["reference"].normals()
+    if (method == "non_iterative"):
+        state["mesh"] = SmoothingMesh(points, mesh_faces(tri, points.shape[0]))
+        function = smoothing_group
+    else:
+        if (neighborhood == "topology"):
+            tri = as_topology(tri, points.shape[0])
+        state.update(points=points, tri=tri, neighborhood=neighborhood)
+        function = bilateral_group
+    if (output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+    if (processes is None):
+        processes = os.cpu_count() or 1
+    processes = max(min(processes, len(tasks)), 1)
+    print("Runs: %d in %d groups, %d processes" % (
+        sum(len(t[-1]) for t in tasks), len(tasks), processes))
+
+    if (processes == 1):
+        init_worker(state)
+        groups = [function(task) for task in tasks]
+    else:
+        with Pool(processes, initializer=init_worker, initargs=(state,)) as pool:
+            groups = pool.map(function, tasks)
+
+    return rank_results([r for group in groups for r in group], rank_by)
+
+
+'''
+Function:   print_results
+Use:        print the ranked results as a table
+'''
+def print_results(results, rank_by="chamfer"):
+    print()
+    print("*************** Sweep Results ***************")
+    for rank, result in enumerate(results):
+        line = "%3d  %-40s" % (rank + 1, run_name(result["params"]))
+        if ("scores" in result):
+            scores = result["scores"]
+            line += "  fitness %.4f  chamfer %.6g  hausdorff %.6g" % (
+                scores["fitness"], scores["chamfer"], scores["hausdorff"])
+            if (rank_by not in ("fitness", "chamfer", "hausdorff")):
+                line += "  %s %.6g" % (rank_by, scores[rank_by])
+        line += "  %.2f s (+%.2f s shared)" % (result["seconds"], result["shared_seconds"])
+        print(line)
+    print("*********************************************")
+
+
+'''
+Function:   parse_grid
+Use:        the grid of command line arguments like sigma_f=1,2
+'''
+def parse_grid(arguments):
+    grid = {}
+    for argument in arguments:
+        if ("=" not in argument):
+            raise ValueError("Grid values are given as name=value,value: " + argument)
+        key, values = argument.split("=", 1)
+        grid[key] = [json.loads(v) for v in values.split(",")]
+    return grid
+
+
+'''
+Function:   main()
+Use:        run a sweep from the command line
+Parameters...
+argv: the command line arguments, those of the process if not given
+'''
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a method for a grid of parameters")
+    parser.add_argument("input", help="the input .xyz file")
+    parser.add_argument("--method", default="non_iterative", choices=sorted(PARAMETERS))
+    parser.add_argument("--grid", nargs="*", default=[],
+                        help="swept values, e.g. sigma_f=1,2 sigma_g=1,2 dist_mode=1,2")
+    parser.add_argument("--reference", default=None, help="ground truth .xyz file to score against")
+    parser.add_argument("--sub-sampling", type=int, default=5, help="subsampling rate, 0 for none")
+    parser.add_argument("--mesher", default="delaunay", choices=("delaunay", "local"))
+    parser.add_argument("--subsampling", default="stride", choices=("stride", "voxel", "poisson"))
+    parser.add_argument("--neighborhood", default="simplex",
+                        choices=("simplex", "topology", "kdtree"))
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="inlier distance of the scores (default: %g)" % THRESHOLD)
+    parser.add_argument("--processes", type=int, default=None,
+                        help="worker processes (default: all cores)")
+    parser.add_argument("--rank-by", default="chamfer",
+                        choices=("chamfer", "hausdorff", "fitness", "inlier_rmse",
+                                 "point_to_plane_rmse"))
+    parser.add_argument("--output-dir", default=None, help="directory to write every result to")
+    parser.add_argument("--output", default=None, help="JSON file the results are written to")
+    args = parser.parse_args(argv)
+
+    results = sweep(args.input, args.method, parse_grid(args.grid), args.reference,
+                    args.sub_sampling, args.mesher, args.subsampling, args.neighborhood,
+                    args.threshold, args.processes, args.output_dir, args.rank_by)
+    print_results(results, args.rank_by)
+
+    if (args.output):
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Results written to " + args.output)
+    return 0
+
+
+if __name__=="__main__":
+    sys.exit(main())
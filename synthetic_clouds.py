@@ -0,0 +1,289 @@
+'''
+    Synthetic Clouds
+
+    Generates clean and noisy pairs of clouds of any size, to test the
+    methods and their scaling beyond the included datasets:
+
+        python3 synthetic_clouds.py torus --points 10000 100000 1000000 --noise gaussian
+        python3 synthetic_clouds.py bunny.xyz --points 2000000 --noise gaussian impulse
+
+    The clean cloud is either
+        - sampled uniformly (by area) from an analytic surface: "sphere",
+            "torus", "cube" (flat faces meeting at sharp edges) or "creases"
+            (a sheet folded into ridges and valleys of constant slope), all
+            about 2 units wide times --scale
+        - or an existing .xyz scan upsampled to the point count: every new
+            point is a random point of the triangle of an original point and
+            two of its nearest neighbors, so it lies on the scanned surface
+
+    and the noisy cloud is the clean one with any of these noise modes:
+        gaussian:   every point moved by normal noise of deviation sigma
+        uniform:    every point moved by at most sigma in a random direction
+                    (the "random and limited vertex displacement" of the
+                    included noisy datasets)
+        impulse:    a fraction of the points moved by the amplitude in a
+                    random direction
+        outliers:   a fraction of the point count added as random points of
+                    the bounding box
+
+    sigma and the amplitude are fractions of the diagonal of the bounding box
+    of the clean cloud. Everything is drawn from one seed (--seed), the clean
+    points and the noise from separate streams, so changing the noise keeps
+    the clean cloud. Every step works on whole arrays, in blocks of points
+    for the large temporaries, so 10 million points take seconds to
+    generate.
+
+    The pair is written as NAME.xyz and NAME_noisy.xyz (NAME is the surface,
+    or the scan name followed by _upsampled, then _POINTS when several counts
+    are asked for), each with its binary sidecar (see
+    cloud_io.write_cloud), so the pipelines, benchmark.py and evaluation.py
+    load them without parsing.
+'''
+from scipy.spatial import cKDTree
+import numpy as np
+import argparse
+import os
+import sys
+from cloud_io import load_xyz_points
+from cloud_io import write_cloud
+
+NOISE_MODES = ("gaussian", "uniform", "impulse", "outliers")
+
+# default deviation of the noise and amplitude of the impulses, as fractions
+# of the bounding box diagonal
+NOISE_SIGMA = 0.005
+IMPULSE_AMPLITUDE = 0.05
+
+# default fraction of the points moved by impulses or added as outliers
+NOISE_FRACTION = 0.01
+
+# nearest neighbors the new points of an upsampled scan are placed among
+UPSAMPLE_NEIGHBORS = 8
+
+# points generated at a time
+CHUNK_POINTS = 1 << 20
+
+'''
+Function:   random_directions
+Use:        (n, 3) array of uniformly distributed unit vectors
+'''
+def random_directions(n, rng):
+    directions = rng.standard_normal((n, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    return directions
+
+
+'''
+Function:   sample_sphere
+Use:        n points of the unit sphere
+'''
+def sample_sphere(n, rng):
+    return random_directions(n, rng)
+
+
+'''
+Function:   sample_torus
+Use:        n points of a torus of radii 0.7 and 0.3, uniform by area
+'''
+def sample_torus(n, rng, major=0.7, minor=0.3):
+    # the outer side of the tube has more area, so angles around the tube are
+    # kept with probability proportional to the distance from the axis
+    u = np.zeros(0)
+    v = np.zeros(0)
+    while (u.shape[0] < n):
+        count = int((n - u.shape[0]) * (major + minor) / major) + 16
+        tube = rng.uniform(0.0, 2.0 * np.pi, count)
+        keep = rng.uniform(0.0, major + minor, count) < major + minor * np.cos(tube)
+        u = np.concatenate((u, rng.uniform(0.0, 2.0 * np.pi, np.count_nonzero(keep))))
+        v = np.concatenate((v, tube[keep]))
+    u, v = u[:n], v[:n]
+    ring = major + minor * np.cos(v)
+    return np.stack((ring * np.cos(u), ring * np.sin(u), minor * np.sin(v)), axis=1)
+
+
+'''
+Function:   sample_cube
+Use:        n points of the faces of the cube [-1, 1]^3
+'''
+def sample_cube(n, rng):
+    points = rng.uniform(-1.0, 1.0, (n, 3))
+    # every face has the same area, pick one and move the points onto it
+    face = rng.integers(0, 6, n)
+    axis = face % 3
+    points[np.arange(n), axis] = np.where(face < 3, -1.0, 1.0)
+    return points
+
+
+'''
+Function:   sample_creases
+Use:        n points of a square sheet folded into 4 ridges, with sharp
+            creases between faces of slope 1
+'''
+def sample_creases(n, rng, folds=4):
+    points = rng.uniform(-1.0, 1.0, (n, 3))
+    # every face has the same slope, so uniform points of the square are
+    # uniform on the sheet
+    period = 2.0 / folds
+    phase = np.mod(points[:, 0] + 1.0, period) / period
+    points[:, 2] = period * (0.5 - np.abs(phase - 0.5)) - period / 4.0
+    return points
+
+
+SURFACES = {"sphere": sample_sphere, "torus": sample_torus, "cube": sample_cube,
+            "creases": sample_creases}
+
+'''
+Function:   upsample_cloud
+Use:        a cloud of n points on the surface of a scan
+Parameters...
+points: (m, 3) array of the scanned points
+n: number of points wanted, the scan is subsampled if it has more
+rng: numpy random Generator
+k: how many nearest neighbors of a point the new points near it are placed
+   among
+
+Returns the (n, 3) points: the scanned points, then the new ones.
+'''
+def upsample_cloud(points, n, rng, k=UPSAMPLE_NEIGHBORS):
+    points = np.asarray(points, dtype=float)
+    m = points.shape[0]
+    if (n <= m):
+        return points[np.sort(rng.choice(m, n, replace=False))]
+
+    k = min(k, m)
+    nearest = cKDTree(points).query(points, k=k, workers=-1)[1].reshape(m, k)
+
+    result = np.empty((n, 3))
+    result[:m] = points
+    for start in range(m, n, CHUNK_POINTS):
+        count = min(CHUNK_POINTS, n - start)
+        base = rng.integers(0, m, count)
+        first = nearest[base, rng.integers(1 if k > 1 else 0, k, count)]
+        second = nearest[base, rng.integers(1 if k > 1 else 0, k, count)]
+
+        # uniform point of the triangle (base, first, second)
+        a = rng.uniform(0.0, 1.0, count)
+        b = rng.uniform(0.0, 1.0, count)
+        outside = a + b > 1.0
+        a[outside] = 1.0 - a[outside]
+        b[outside] = 1.0 - b[outside]
+        result[start:start + count] = (points[base] + a[:, None] * (points[first] - points[base]) +
+                                       b[:, None] * (points[second] - points[base]))
+    return result
+
+
+'''
+Function:   add_noise
+Use:        a noisy copy of a clean cloud
+Parameters...
+points: (n, 3) array of the clean points
+rng: numpy random Generator
+modes: noise modes to apply, in order, see NOISE_MODES
+sigma: deviation (gaussian) or largest displacement (uniform), as a fraction
+       of the bounding box diagonal
+fraction: fraction of the points moved (impulse) or added (outliers)
+amplitude: displacement of the impulses, as a fraction of the diagonal
+
+Returns the noisy points: the clean ones moved, then the outliers.
+'''
+def add_noise(points, rng, modes=("gaussian",), sigma=NOISE_SIGMA, fraction=NOISE_FRACTION,
+              amplitude=IMPULSE_AMPLITUDE):
+    for mode in modes:
+        if (mode not in NOISE_MODES):
+            raise ValueError("Unknown noise: " + str(mode))
+
+    low, high = points.min(axis=0), points.max(axis=0)
+    diagonal = float(np.linalg.norm(high - low))
+    noisy = np.array(points, dtype=float)
+    n = noisy.shape[0]
+
+    for mode in modes:
+        if (mode == "outliers"):
+            count = int(round(fraction * n))
+            noisy = np.concatenate((noisy, rng.uniform(low, high, (count, 3))))
+            continue
+        if (mode == "impulse"):
+            index = np.sort(rng.choice(n, int(round(fraction * n)), replace=False))
+            noisy[index] += amplitude * diagonal * random_directions(index.shape[0], rng)
+            continue
+
+        for start in range(0, n, CHUNK_POINTS):
+            block = noisy[start:start + CHUNK_POINTS]
+            if (mode == "gaussian"):
+                block += rng.normal(0.0, sigma * diagonal, block.shape)
+            else:
+                # uniform in the ball of radius sigma
+                radius = sigma * diagonal * np.cbrt(rng.uniform(0.0, 1.0, block.shape[0]))
+                block += radius[:, None] * random_directions(block.shape[0], rng)
+    return noisy
+
+
+'''
+Function:   generate_pair
+Use:        a clean cloud and its noisy copy
+Parameters...
+source: name of a surface (see SURFACES) or a .xyz file to upsample
+n: number of clean points
+seed: seed of the random streams
+scale: factor the surfaces are scaled by (not the scans)
+modes, sigma, fraction, amplitude: see add_noise
+
+Returns (clean points, noisy points).
+'''
+def generate_pair(source, n, seed=None, scale=1.0, modes=("gaussian",), sigma=NOISE_SIGMA,
+                  fraction=NOISE_FRACTION, amplitude=IMPULSE_AMPLITUDE):
+    clean_rng, noise_rng = [np.random.default_rng(s)
+                            for s in np.random.SeedSequence(seed).spawn(2)]
+    if (source in SURFACES):
+        clean = SURFACES[source](n, clean_rng) * scale
+    elif (os.path.isfile(source)):
+        clean = upsample_cloud(load_xyz_points(source), n, clean_rng)
+    else:
+        raise ValueError("Unknown surface: " + str(source))
+    return clean, add_noise(clean, noise_rng, modes, sigma, fraction, amplitude)
+
+
+'''
+Function:   main()
+Use:        generate pairs of clouds from the command line
+Parameters...
+argv: the command line arguments, those of the process if not given
+'''
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate clean and noisy clouds")
+    parser.add_argument("source", help="surface (%s) or .xyz file to upsample"
+                                       % ", ".join(sorted(SURFACES)))
+    parser.add_argument("--points", type=int, nargs="+", default=[100000],
+                        help="number of clean points, one pair per count")
+    parser.add_argument("--noise", nargs="*", default=["gaussian"], choices=NOISE_MODES)
+    parser.add_argument("--sigma", type=float, default=NOISE_SIGMA,
+                        help="noise deviation, fraction of the bounding box diagonal "
+                             "(default: %g)" % NOISE_SIGMA)
+    parser.add_argument("--fraction", type=float, default=NOISE_FRACTION,
+                        help="fraction of impulses and outliers (default: %g)" % NOISE_FRACTION)
+    parser.add_argument("--amplitude", type=float, default=IMPULSE_AMPLITUDE,
+                        help="impulse displacement, fraction of the bounding box diagonal "
+                             "(default: %g)" % IMPULSE_AMPLITUDE)
+    parser.add_argument("--scale", type=float, default=1.0, help="scale of the surfaces")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None,
+                        help="name of the output files (default: the source name)")
+    args = parser.parse_args(argv)
+
+    # an upsampled scan never replaces the scan itself
+    name = args.output or os.path.splitext(os.path.basename(args.source))[0]
+    if (args.output is None and args.source not in SURFACES):
+        name += "_upsampled"
+    for n in args.points:
+        prefix = name if len(args.points) == 1 else "%s_%d" % (name, n)
+        clean, noisy = generate_pair(args.source, n, args.seed, args.scale, args.noise,
+                                     args.sigma, args.fraction, args.amplitude)
+        write_cloud(prefix + ".xyz", clean)
+        write_cloud(prefix + "_noisy.xyz", noisy)
+        print("Written %s.xyz (%d points) and %s_noisy.xyz (%d points)" % (
+            prefix, clean.shape[0], prefix, noisy.shape[0]))
+    return 0
+
+
+if __name__=="__main__":
+    sys.exit(main())
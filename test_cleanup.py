@@ -1,7 +1,12 @@
+import glob
 import os
 
 # names of all files created from running auto_test.py
-test_files = ["bunny_bms_denoised.xyz", "bunny_nims_smoothed.xyz", "bunny_mesh.gts", "bunny_smooth.gts"]
+test_files = ["bunny_bms_denoised.xyz", "bunny_nims_smoothed.xyz", "bunny_mesh.gts", "bunny_smooth.gts",
+              "bunny_mesh.bmesh", "bunny_smooth.bmesh"]
+
+# binary caches of the loaded .xyz files
+test_files += glob.glob("bunny.xyz.*.npy")
 
 for f in test_files:
     if os.path.exists(f):
@@ -0,0 +1,208 @@
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import scipy
+from scipy.spatial import Delaunay
+import instrumentation
+from mesh_topology import MeshTopology
+from mesh_topology import as_topology
+
+'''
+This python utility keeps the Delaunay triangulations of point arrays on disk,
+so that runs on the same (subsampled) cloud skip qhull entirely, e.g. while
+tuning the iterations, the neighbor range or the smoother parameters.
+
+The cache is content addressed: an entry is found by the SHA-1 hash of the
+point array (its shape, type and bytes), the qhull options and the scipy and
+numpy versions (the entries hold private attributes of the Delaunay object,
+which may change between versions), so it is reused whatever file the points
+came from, and never for points that changed. Each
+entry is a directory of .npy files, which are memory-mapped when loaded:
+
+    the state of the scipy Delaunay object (simplices, neighbors, equations,
+        the barycentric transforms used by find_simplex, ...), the same
+        state pickle would store, with its scalars in state.json
+    the MeshTopology of the triangulation (its simplices and the vertex to
+        simplex and vertex to vertex adjacency), which as_topology returns
+        instead of building it again
+
+The size of the cache is capped: after an entry is written the least recently
+used entries are removed until the cache is below CACHE_BYTES. Entries are
+written to a temporary directory and renamed into place, so concurrent runs
+(e.g. batch jobs) never see partial entries.
+'''
+
+# directory of the cache, relative to the working directory
+CACHE_DIR = "triangulation_cache"
+
+# size the cache is trimmed to after every write
+CACHE_BYTES = 1 << 30
+
+# qhull options of the triangulations, QJ ensures all points are used
+QHULL_OPTIONS = "Qbb Qc Qz Q12 QJ Qt"
+
+# bumped when the layout of the entries changes, so old entries are not read
+CACHE_VERSION = 1
+
+'''
+Function:   cache_key
+Use:        hash identifying the triangulation of a point array
+Parameters...
+points: array of the triangulated points
+qhull_options: options passed to qhull
+'''
+def cache_key(points, qhull_options):
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    digest = hashlib.sha1()
+    digest.update(("%d %s %s %s %s " % (CACHE_VERSION, scipy.__version__, np.__version__,
+                                          qhull_options, points.shape)).encode())
+    digest.update(points.data)
+    return digest.hexdigest()
+
+
+'''
+Function:   save_entry
+Use:        write the arrays and scalars of a triangulation and its topology
+Parameters...
+path: directory of the entry, must not exist yet
+tri: scipy Delaunay triangulation
+topology: MeshTopology of the triangulation
+'''
+def save_entry(path, tri, topology):
+    # compute the transforms find_simplex needs, so loads do not redo them
+    tri.transform
+
+    state = {}
+    for name, value in tri.__dict__.items():
+        if (isinstance(value, np.ndarray)):
+            np.save(os.path.join(path, "delaunay." + name + ".npy"), value)
+        elif (name != "_qhull"):
+            state[name] = value
+    state["num_points"] = topology.num_points
+    with open(os.path.join(path, "state.json"), 'w') as f:
+        json.dump(state, f)
+
+    np.save(os.path.join(path, "topology_simplices.npy"), topology.simplices)
+    for name in ("vertex_simplex", "vertex_vertex"):
+        indptr, indices = getattr(topology, name)
+        np.save(os.path.join(path, name + "_indptr.npy"), indptr)
+        np.save(os.path.join(path, name + "_indices.npy"), indices)
+
+
+'''
+Function:   load_entry
+Use:        rebuild a triangulation, with its topology attached, from an entry
+Parameters...
+path: directory of the entry
+'''
+def load_entry(path):
+    load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode='c')
+
+    with open(os.path.join(path, "state.json"), 'r') as f:
+        state = json.load(f)
+    num_points = state.pop("num_points")
+
+    tri = Delaunay.__new__(Delaunay)
+    tri.__dict__.update(state)
+    tri._qhull = None
+    for filename in os.listdir(path):
+        if (filename.startswith("delaunay.")):
+            name = filename[len("delaunay."):-len(".npy")]
+            setattr(tri, name, load("delaunay." + name))
+
+    tri.topology = MeshTopology(load("topology_simplices"), num_points,
+                                (load("vertex_simplex_indptr"), load("vertex_simplex_indices")),
+                                (load("vertex_vertex_indptr"), load("vertex_vertex_indices")))
+    return tri
+
+
+'''
+Function:   entry_size
+Use:        bytes used by the files of an entry
+'''
+def entry_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+'''
+Function:   evict
+Use:        remove the least recently used entries until the cache fits the cap
+Parameters...
+cache_dir: directory of the cache
+max_bytes: size the cache is trimmed to
+keep: entry never removed (the one just written)
+'''
+def evict(cache_dir, max_bytes, keep=None):
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        # skip the temporary directories of entries being written
+        if (os.path.isdir(path) and not name.startswith(".")):
+            try:
+                entries.append((os.path.getmtime(path), entry_size(path), path))
+            except OSError:
+                continue
+
+    total = sum(e[1] for e in entries)
+    for mtime, size, path in sorted(entries):
+        if (total <= max_bytes):
+            break
+        if (path != keep):
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+'''
+Function:   cached_delaunay
+Use:        return the Delaunay triangulation of the points, from the cache if
+            it holds it, otherwise computed with qhull and added to the cache
+Parameters...
+points: array of the points to triangulate
+num_points: number of points of the attached topology, defaults to the number
+            of triangulated points (our pipelines leave out the last point)
+qhull_options: options passed to qhull
+cache_dir: directory of the cache, None to always triangulate
+max_bytes: size the cache is trimmed to after a write
+
+The returned triangulation has a MeshTopology for num_points attached as its
+"topology", which as_topology uses.
+'''
+def cached_delaunay(points, num_points=None, qhull_options=QHULL_OPTIONS,
+                    cache_dir=CACHE_DIR, max_bytes=CACHE_BYTES):
+    if (num_points is None):
+        num_points = points.shape[0]
+
+    if (cache_dir is None):
+        return Delaunay(points, qhull_options=qhull_options)
+
+    path = os.path.join(cache_dir, cache_key(points, qhull_options) + "_" + str(num_points))
+    if (os.path.isdir(path)):
+        try:
+            tri = load_entry(path)
+            # refresh the time the entry was last used, for the eviction
+            os.utime(path)
+            instrumentation.count("triangulation_cache_hits")
+            return tri
+        except (OSError, ValueError, KeyError):
+            # an entry removed by another run, or left by an older version
+            shutil.rmtree(path, ignore_errors=True)
+
+    instrumentation.count("triangulation_cache_misses")
+    tri = Delaunay(points, qhull_options=qhull_options)
+    topology = as_topology(tri, num_points)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    temp = tempfile.mkdtemp(prefix=".entry_", dir=cache_dir)
+    try:
+        save_entry(temp, tri, topology)
+        os.rename(temp, path)
+    except OSError:
+        # another run wrote the same entry first, or the disk is full
+        shutil.rmtree(temp, ignore_errors=True)
+    evict(cache_dir, max_bytes, keep=path)
+
+    tri.topology = topology
+    return tri